@@ -8,78 +8,535 @@ from itertools import chain
 import logging
 import os
 import calendar
+import stat
+import mmap
+import threading
 import time
 from datetime import datetime
-from shutil import copytree
+from shutil import copy2, copyfile, rmtree
+from subprocess import Popen, PIPE
+from tempfile import mkstemp
 
-from citools.git import fetch_repository
-from citools.version import retrieve_current_branch, get_git_last_hash
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from citools.git import get_clean_git_environment
+from citools.gitdb import md5
+from citools.pool import map_in_pool
+from citools.version import retrieve_current_branch, get_git_last_hash, DependencySession, get_dependency_session
 
 logger = logging.getLogger(__name__)
 
-def copy_images(repositories, static_dir):
+# jinja2 syntax starting expression, statement or comment; files without it are no templates
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+
+# jinja2 environments per root directory, shared by all renderings in process
+_template_environments = {}
+_template_environments_lock = threading.Lock()
+
+# digest of template source -> names of variables it references
+_template_variable_names = {}
+_template_variable_names_lock = threading.Lock()
+
+def get_blob_hash(file_path, chunk_size=65536):
+    """ Return git blob id of file content (as git hash-object does), reading file in chunks """
+    digest = sha1("blob %d\0" % os.path.getsize(file_path))
+    f = open(file_path, 'rb')
+    try:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunk_size)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def get_tree_blob_hashes(repository_directory, path):
+    """
+    Return dictionary mapping regular files committed under path in HEAD of repository
+    (relative to path, separated by /) to their (blob id, size), as listed by git ls-tree,
+    so their content does not have to be read to know it.
+    Return empty dictionary if repository_directory is not a git checkout.
+    """
+    try:
+        proc = Popen(["git", "ls-tree", "-r", "-l", "-z", "HEAD", "--", path], stdout=PIPE, stderr=PIPE, cwd=repository_directory, env=get_clean_git_environment())
+    except OSError:
+        return {}
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        return {}
+
+    prefix = path.rstrip('/') + '/'
+    blobs = {}
+    for entry in stdout.split('\0'):
+        if not entry:
+            continue
+        info, name = entry.split('\t', 1)
+        mode, type, sha, size = info.split()
+        if type == 'blob' and mode in ('100644', '100755') and name.startswith(prefix):
+            blobs[name[len(prefix):]] = (sha, int(size))
+    return blobs
+
+def get_copy_report():
+    """
+    Return empty report of copying static files: number of 'files' in source,
+    bytes 'copied', 'linked' and 'unchanged' and number of stale files 'removed'
+    """
+    return {'files' : 0, 'copied' : 0, 'linked' : 0, 'unchanged' : 0, 'removed' : 0}
+
+def _replace_with_directory(path):
+    if os.path.isdir(path):
+        return
+    if os.path.lexists(path):
+        os.remove(path)
+    os.makedirs(path)
+
+def walk_following_links(top, _ancestors=()):
+    """
+    Like os.walk, but follow symlinked directories (like shutil.copytree does);
+    links to directory being walked already (cycles) are skipped.
+    """
+    top_stat = os.stat(top)
+    key = (top_stat.st_dev, top_stat.st_ino)
+    if key in _ancestors:
+        logger.warning("Not following %s, it links to it's parent directory" % top)
+        return
+    _ancestors = _ancestors + (key,)
+
+    try:
+        names = os.listdir(top)
+    except OSError:
+        return
+
+    dirnames, filenames = [], []
+    for name in names:
+        if os.path.isdir(os.path.join(top, name)):
+            dirnames.append(name)
+        else:
+            filenames.append(name)
+
+    yield top, dirnames, filenames
+
+    for dirname in dirnames:
+        for entry in walk_following_links(os.path.join(top, dirname), _ancestors):
+            yield entry
+
+def iter_tree_files(source_dir, target_dir):
+    """
+    Yield (name, source path, target path) for every file in source_dir (including
+    symlinked directories), name being path relative to source_dir separated by /.
+    Directories are created in target_dir as they're walked, replacing files of the same name.
+    """
+    for dirpath, dirnames, filenames in walk_following_links(source_dir):
+        relative_dir = dirpath[len(source_dir):].strip(os.sep)
+        target_subdir = os.path.join(target_dir, relative_dir)
+        _replace_with_directory(target_subdir)
+
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            if not os.path.isfile(source):
+                continue
+
+            target = os.path.join(target_subdir, filename)
+            if os.path.isdir(target) and not os.path.islink(target):
+                rmtree(target)
+
+            yield "/".join([part for part in relative_dir.split(os.sep) + [filename] if part]), source, target
+
+def remove_stale_files(source_dir, target_dir):
+    """ Remove files and directories from target_dir not present in source_dir; return number of removed files """
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(target_dir, topdown=False):
+        relative_dir = dirpath[len(target_dir):].strip(os.sep)
+        for filename in filenames:
+            if not os.path.isfile(os.path.join(source_dir, relative_dir, filename)):
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+        if relative_dir and not os.path.isdir(os.path.join(source_dir, relative_dir)):
+            os.rmdir(dirpath)
+    return removed
+
+def get_manifest_path(manifest_directory, target_dir):
+    """
+    Return path of manifest of files synchronized to target_dir, kept in manifest_directory
+    (outside of target_dir, so it's not published with it)
+    """
+    target_dir = os.path.abspath(target_dir)
+    return os.path.join(manifest_directory, "%s-%s.manifest" % (os.path.basename(target_dir), md5(target_dir).hexdigest()[:12]))
+
+def read_manifest(manifest_path):
+    """
+    Return dictionary mapping files (separated by /) to their (blob id, size, modification time)
+    as recorded by write_manifest, or empty dictionary if manifest is missing.
+    """
+    manifest = {}
+    try:
+        f = open(manifest_path)
+    except IOError:
+        return manifest
+    try:
+        for line in f:
+            fields = line.rstrip('\n').split('\t', 3)
+            if len(fields) == 4:
+                manifest[fields[3]] = tuple(fields[:3])
+    finally:
+        f.close()
+    return manifest
+
+def write_manifest(manifest_path, manifest):
+    """ Atomically write manifest read by read_manifest """
+    manifest_directory = os.path.dirname(manifest_path) or os.curdir
+    if not os.path.isdir(manifest_directory):
+        try:
+            os.makedirs(manifest_directory)
+        except OSError:
+            # created by other thread meanwhile
+            if not os.path.isdir(manifest_directory):
+                raise
+    fd, tmp_path = mkstemp(dir=manifest_directory, prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            for name in sorted(manifest.keys()):
+                if '\n' not in name:
+                    f.write("\t".join(list(manifest[name]) + [name]) + "\n")
+        finally:
+            f.close()
+        os.rename(tmp_path, manifest_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def get_manifest_entry(blob_id, file_stat):
+    return (blob_id, str(file_stat.st_size), repr(file_stat.st_mtime))
+
+def sync_tree(source_dir, target_dir, checksum=False, blobs=None, manifest_path=None):
+    """
+    Make target_dir a copy of source_dir, like rsync --delete does: copy only files
+    that differ in size and modification time (or in content, with checksum),
+    and remove files not present in source_dir.
+
+    blobs may map files (relative to source_dir, separated by /) to their
+    (blob id, size) (see get_tree_blob_hashes); those files are compared by content
+    without reading the source, as modification times of fresh checkouts say nothing.
+    With manifest_path, blob ids of synchronized files are recorded there (see get_manifest_path),
+    so files whose size and modification time did not change since are not read again either.
+    Files are replaced through atomic rename. Return report dictionary (see get_copy_report).
+    """
+    blobs = blobs or {}
+    report = get_copy_report()
+    old_manifest = {}
+    if manifest_path:
+        old_manifest = read_manifest(manifest_path)
+    manifest = {}
+
+    for name, source, target in iter_tree_files(source_dir, target_dir):
+        source_stat = os.stat(source)
+        report['files'] += 1
+        blob_id = None
+        if blobs.has_key(name) and blobs[name][1] == source_stat.st_size:
+            blob_id = blobs[name][0]
+
+        if os.path.isfile(target):
+            target_stat = os.stat(target)
+            if target_stat.st_size == source_stat.st_size:
+                if blob_id is not None:
+                    entry = get_manifest_entry(blob_id, target_stat)
+                    unchanged = old_manifest.get(name) == entry or get_blob_hash(target) == blob_id
+                elif checksum:
+                    unchanged = get_blob_hash(target) == get_blob_hash(source)
+                else:
+                    unchanged = int(target_stat.st_mtime) == int(source_stat.st_mtime)
+
+                if unchanged:
+                    if blob_id is not None:
+                        manifest[name] = entry
+                    report['unchanged'] += source_stat.st_size
+                    continue
+
+        fd, tmp_path = mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        os.close(fd)
+        try:
+            copy2(source, tmp_path)
+            os.rename(tmp_path, target)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        report['copied'] += source_stat.st_size
+        if blob_id is not None:
+            manifest[name] = get_manifest_entry(blob_id, os.stat(target))
+
+    report['removed'] += remove_stale_files(source_dir, target_dir)
+    if manifest_path and (manifest or old_manifest):
+        write_manifest(manifest_path, manifest)
+    return report
+
+class StaticStore(object):
     """
-    For every repository, copy images from "static" dir in downloaded repository
-    to static_dir/project, if directory exists
+    Content-addressed store of static files, shared by all dependencies and builds.
+    Every content is stored once (per file mode), under it's git blob id, and target trees are made
+    of hardlinks to stored files, so unchanged files are neither copied nor written.
+
+    Stored files are read-only: changing one in place (including it's mode) would change
+    it in every tree. Files with different modes are stored separately, so executables
+    stay executable, just without write permission.
+    Files are stored through atomic rename, so store may be filled concurrently.
     """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def get_object_path(self, digest, mode=0444):
+        return os.path.join(self.directory, digest[:2], "%s-%o" % (digest[2:], mode))
+
+    def _make_directory(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by other process meanwhile
+                if not os.path.isdir(directory):
+                    raise
+
+    def add(self, file_path, digest=None):
+        """
+        Store file unless it's content is stored already with it's mode (minus write permissions);
+        return (stored file path, blob id it's stored under, bytes copied).
+
+        digest is blob id file is expected to have (i.e. committed one), used only to find
+        file already stored; otherwise file is hashed and copied only if it's content
+        is not stored yet, under id of content really copied, so modified checkouts
+        never put wrong content under committed id.
+        """
+        mode = stat.S_IMODE(os.stat(file_path).st_mode) & ~0222
+        if digest is not None:
+            object_path = self.get_object_path(digest, mode)
+            if os.path.exists(object_path):
+                return object_path, digest, 0
+
+        source_digest = get_blob_hash(file_path)
+        if digest is not None and source_digest != digest:
+            logger.debug("%s differs from it's committed content %s, storing it as %s" % (file_path, digest, source_digest))
+        object_path = self.get_object_path(source_digest, mode)
+        if os.path.exists(object_path):
+            return object_path, source_digest, 0
+
+        self._make_directory(os.path.dirname(object_path))
+        fd, tmp_path = mkstemp(dir=os.path.dirname(object_path), prefix='.tmp-')
+        os.close(fd)
+        try:
+            copyfile(file_path, tmp_path)
+            copied = os.path.getsize(tmp_path)
+            # file may change while being copied
+            stored_digest = get_blob_hash(tmp_path)
+            if stored_digest != source_digest:
+                object_path = self.get_object_path(stored_digest, mode)
+                self._make_directory(os.path.dirname(object_path))
+
+            if os.path.exists(object_path):
+                # stored by other process meanwhile
+                os.remove(tmp_path)
+            else:
+                os.chmod(tmp_path, mode)
+                os.rename(tmp_path, object_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return object_path, stored_digest, copied
+
+    def materialize(self, source_dir, target_dir, blobs=None):
+        """
+        Make target_dir contain all files from source_dir, as hardlinks to stored files
+        (or copies of them where hardlinks are not possible, like across filesystems).
+        Files already linked to their content are left untouched, files not present
+        in source_dir are removed.
+
+        blobs may map files (relative to source_dir, separated by /) to their committed
+        (blob id, size) (see get_tree_blob_hashes); files already stored under those ids
+        are not read at all, other files are hashed as they're stored.
+        Return report dictionary (see get_copy_report).
+        """
+        blobs = blobs or {}
+        report = get_copy_report()
+
+        for name, source, target in iter_tree_files(source_dir, target_dir):
+            size = os.path.getsize(source)
+            digest = None
+            if blobs.has_key(name) and blobs[name][1] == size:
+                digest = blobs[name][0]
+
+            object_path, digest, copied = self.add(source, digest)
+            report['files'] += 1
+            report['copied'] += copied
+
+            if os.path.exists(target):
+                if os.path.samefile(target, object_path) or (os.path.getsize(target) == size and os.stat(target).st_mode == os.stat(object_path).st_mode and get_blob_hash(target) == digest):
+                    report['unchanged'] += size
+                    continue
+                os.remove(target)
+
+            try:
+                os.link(object_path, target)
+                report['linked'] += size
+            except OSError:
+                copy2(object_path, target)
+                report['copied'] += size
+
+        report['removed'] += remove_stale_files(source_dir, target_dir)
+        return report
+
+def format_copy_report(report):
+    return "%(files)s static files: %(copied)s bytes copied, %(linked)s bytes linked, %(unchanged)s bytes unchanged, %(removed)s stale files removed" % report
+
+def copy_images(repositories, static_dir, shallow=False, mirror_directory=None, session=None, store_directory=None, checksum=False, workers=None, manifest_directory=None):
+    """
+    For every repository, synchronize images from "static" dir in downloaded repository
+    to static_dir/project, if directory exists: only changed files are copied
+    and files no longer present are removed (see sync_tree). Blob ids of copied files
+    are recorded in manifests kept in manifest_directory (.static-manifests
+    in session workdir by default), so unchanged files are not read on next build.
+    With shallow, only current revision of repositories is fetched; with mirror_directory,
+    repositories are cloned from bare mirrors kept there.
+    Repositories already fetched in given DependencySession are not fetched again.
+
+    With store_directory, files are not copied but hardlinked from StaticStore kept there,
+    deduplicated by content across dependencies and builds; such files are read-only
+    and shared by all builds, so they must not be changed in place.
+    Repositories are synchronized by at most workers threads.
+    Return report dictionary, see get_copy_report.
+    """
+    if session is None:
+        session = DependencySession(fetch_options={
+            'shallow' : shallow,
+            'mirror_directory' : mirror_directory,
+        })
+
+    if manifest_directory is None:
+        manifest_directory = os.path.join(session.workdir, '.static-manifests')
+
+    store = None
+    if store_directory:
+        store = StaticStore(store_directory)
+
+    # session is not thread safe, so repositories are fetched before synchronizing
+    jobs = []
     for repository in repositories:
         if repository.has_key('branch'):
             branch = repository['branch']
         else:
             branch = retrieve_current_branch(repository_directory=os.curdir, fix_environment=True)
-        dir = fetch_repository(repository['url'], workdir=os.curdir, branch=branch)
+        dir = session.get_directory(repository, branch)
         package_static_dir = os.path.join(dir, repository['package_name'], 'static')
         if os.path.exists(package_static_dir):
-            copytree(package_static_dir, os.path.join(static_dir, repository['package_name']))
-    
+            jobs.append((dir, repository['package_name'], package_static_dir))
+
+    def synchronize(job):
+        dir, package_name, package_static_dir = job
+        blobs = get_tree_blob_hashes(dir, "%s/static" % package_name)
+        target_dir = os.path.join(static_dir, package_name)
+        if store:
+            return store.materialize(package_static_dir, target_dir, blobs)
+        return sync_tree(package_static_dir, target_dir, checksum=checksum, blobs=blobs, manifest_path=get_manifest_path(manifest_directory, target_dir))
+
+    report = get_copy_report()
+    for repository_report in map_in_pool(synchronize, jobs, workers=workers):
+        for key, value in repository_report.items():
+            report[key] += value
+    return report
+
 class CopyDependencyImages(config):
 
     description = "copy all dependency static files into one folder"
 
     user_options = [
+        ("shallow", None, "Fetch only current revision of dependencies"),
+        ("mirror-directory=", None, "Directory with shared bare mirrors of dependency repositories"),
+        ("static-store=", None, "Directory with content-addressed store to hardlink static files from; linked files are shared, read-only and must not be modified (or chmod-ed) in place"),
+        ("checksum", None, "Compare static files by content instead of size and modification time"),
+        ("workers=", None, "Number of dependency static directories synchronized concurrently"),
     ]
 
+    boolean_options = ["shallow", "checksum"]
+
     def initialize_options(self):
-        pass
+        self.shallow = False
+        self.mirror_directory = None
+        self.static_store = None
+        self.checksum = False
+        self.workers = None
 
     def finalize_options(self):
-        pass
+        self.workers = self.workers and int(self.workers) or None
 
     def run(self):
         try:
-            copy_images(self.distribution.dependencies_git_repositories, 'static')
+            session = get_dependency_session(self.distribution, fetch_options={
+                'shallow' : self.shallow,
+                'mirror_directory' : self.mirror_directory,
+            })
+            report = copy_images(self.distribution.dependencies_git_repositories, 'static', session=session, store_directory=self.static_store, checksum=self.checksum, workers=self.workers)
+            print format_copy_report(report)
         except Exception:
             import traceback
             traceback.print_exc()
             raise
 
-def _replace_template(file_path, variables):
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            from jinja2 import Template
-            rendered = Template(f.read().decode('utf-8')).render(**variables)
+def get_template_environment(root_directory):
+    """
+    Return jinja2 Environment loading templates from root_directory, shared
+    by all renderings in process. Compiled templates are kept in bytecode cache
+    keyed by their source, so unchanged templates are not compiled again.
+    """
+    root_directory = os.path.abspath(root_directory)
+    _template_environments_lock.acquire()
+    try:
+        if not _template_environments.has_key(root_directory):
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            _template_environments[root_directory] = Environment(
+                loader=FileSystemLoader(root_directory),
+                bytecode_cache=FileSystemBytecodeCache(),
+                # templates are overwritten in place, possibly within mtime resolution,
+                # so don't keep loaded ones; bytecode cache checks source itself
+                cache_size=0,
+            )
+        return _template_environments[root_directory]
+    finally:
+        _template_environments_lock.release()
 
-        f = open(file_path, 'w')
-        f.write(rendered.encode('utf-8'))
+def is_template_file(file_path):
+    """
+    Return True if file contains jinja2 markup. File is memory-mapped and searched
+    for TEMPLATE_MARKERS, so large files are never read into memory.
+    """
+    if os.path.getsize(file_path) == 0:
+        return False
+
+    f = open(file_path, 'rb')
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for marker in TEMPLATE_MARKERS:
+                if mapped.find(marker) != -1:
+                    return True
+            return False
+        finally:
+            mapped.close()
+    finally:
         f.close()
 
-def replace_template_files(root_directory, variables=None, template_files=None, subdirs=None):
+def get_template_manifest(root_directory, template_files=None, subdirs=None):
     """
-    For given root_directory, walk through files specified in template_files (or default ones)
-    and every file in given subdirectories ('debian' by default, pass [] to skip this step). 
-    Treat them as jinja2 templates, overwriting current content with rendered one,
-    using variables provided in given variables argument (or default ones, mostly retrieved from git repo). 
+    Return names (paths relative to root_directory, separated by /) of files
+    that are real templates: those of template_files (or default ones) and files
+    in subdirs ('debian' by default) that exist and contain template markup.
     """
-    variables = variables or {
-        'branch' : retrieve_current_branch(repository_directory=root_directory, fix_environment=True),
-    }
-    
-    templates = template_files or ["requirements.txt", "setup.py", "pavement.py"]
-    
-    for template in templates:
-        fp = os.path.join(root_directory, template)
-        _replace_template(fp, variables)
-    
+    templates = list(template_files or ["requirements.txt", "setup.py", "pavement.py"])
+
     if subdirs is None:
         subdirs = ['debian']
 
@@ -90,20 +547,180 @@ def replace_template_files(root_directory, variables=None, template_files=None,
                 for file in os.listdir(dp):
                     fp = os.path.join(root_directory, subdir, file)
                     if os.path.isfile(fp):
-                        _replace_template(fp, variables)
-        
+                        templates.append("%s/%s" % (subdir, file))
+
+    manifest = []
+    seen = set()
+    for template in templates:
+        fp = get_template_path(root_directory, template)
+        if os.path.normpath(template) not in seen and os.path.isfile(fp) and is_template_file(fp):
+            seen.add(os.path.normpath(template))
+            manifest.append(template)
+    return manifest
+
+def get_template_path(root_directory, template_name):
+    """ Return path of template_name, relative to root_directory (separated by /) or absolute """
+    if os.path.isabs(template_name):
+        return template_name
+    return os.path.join(root_directory, *template_name.split('/'))
+
+def is_template_inside(template_name):
+    """ Return True if template_name is relative path inside root directory, so loader finds it """
+    return not os.path.isabs(template_name) and '..' not in template_name.split('/')
+
+def get_render_record_path(environment, file_path):
+    """ Return path of record of last rendering of file_path, kept next to environment bytecode cache """
+    return os.path.join(environment.bytecode_cache.directory, "__citools_rendered_%s" % md5(file_path).hexdigest())
+
+def get_render_record(environment, file_path):
+    """
+    Return (digest of rendered content, digest of variables) of last rendering
+    of file_path, in this or previous build, or None if it's not known
+    """
+    try:
+        f = open(get_render_record_path(environment, file_path))
+    except IOError:
+        return None
+    try:
+        record = tuple(f.read().split())
+    finally:
+        f.close()
+    if len(record) != 2:
+        return None
+    return record
+
+def store_render_record(environment, file_path, record):
+    """ Atomically store record read by get_render_record """
+    record_path = get_render_record_path(environment, file_path)
+    fd, tmp_path = mkstemp(dir=os.path.dirname(record_path), prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(" ".join(record))
+        finally:
+            f.close()
+        os.rename(tmp_path, record_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def get_variables_digest(variables):
+    return md5(repr(sorted(variables.items()))).hexdigest()
+
+def get_template_variables(environment, source, variables):
+    """
+    Return dictionary of variables to render template source with. From BuildContext,
+    only variables referenced by template are taken (and so computed); dictionaries
+    are returned as they are.
+    """
+    if not isinstance(variables, BuildContext):
+        return variables
+    return variables.get_variables(get_template_variable_names(environment, source))
+
+def get_template_variable_names(environment, source):
+    """ Return set of variables referenced by template source, parsing every source only once """
+    if isinstance(source, unicode):
+        digest = md5(source.encode('utf-8')).hexdigest()
+    else:
+        digest = md5(source).hexdigest()
+    _template_variable_names_lock.acquire()
+    try:
+        if _template_variable_names.has_key(digest):
+            return _template_variable_names[digest]
+    finally:
+        _template_variable_names_lock.release()
+
+    from jinja2 import meta
+    names = meta.find_undeclared_variables(environment.parse(source))
+
+    _template_variable_names_lock.acquire()
+    try:
+        _template_variable_names[digest] = names
+    finally:
+        _template_variable_names_lock.release()
+    return names
+
+def _replace_template(root_directory, template_name, variables, variables_digest=None):
+    """
+    Render file template_name (path relative to root_directory, separated by /)
+    (or absolute path) in place. Return True if file was rewritten, False if it does
+    not exist, if it was rendered with same variables before (in this or previous build,
+    see get_render_record) and did not change since, or if rendered content is the same
+    as current one (file is not touched then).
+    """
+    file_path = os.path.abspath(get_template_path(root_directory, template_name))
+    if not os.path.exists(file_path):
+        return False
+
+    f = open(file_path, 'rb')
+    content = f.read()
+    f.close()
+
+    environment = get_template_environment(root_directory)
+    if isinstance(variables, BuildContext):
+        variables = get_template_variables(environment, content.decode('utf-8'), variables)
+        variables_digest = None
+    variables_digest = variables_digest or get_variables_digest(variables)
+
+    if get_render_record(environment, file_path) == (md5(content).hexdigest(), variables_digest):
+        return False
+
+    if is_template_inside(template_name):
+        template = environment.get_template(template_name)
+    else:
+        # loader would not look outside root_directory
+        template = environment.from_string(content.decode('utf-8'))
+    rendered = template.render(**variables).encode('utf-8')
+
+    changed = rendered != content
+    if changed:
+        f = open(file_path, 'w')
+        f.write(rendered)
+        f.close()
+
+    store_render_record(environment, file_path, (md5(rendered).hexdigest(), variables_digest))
+    return changed
+
+def replace_template_files(root_directory, variables=None, template_files=None, subdirs=None, workers=None):
+    """
+    For given root_directory, walk through files specified in template_files (or default ones)
+    and every file in given subdirectories ('debian' by default, pass [] to skip this step). 
+    Treat them as jinja2 templates, overwriting current content with rendered one,
+    using variables provided in given variables argument (or default ones, mostly retrieved from git repo). 
+    Variables may be dictionary or BuildContext, from which only variables used by templates are computed.
+
+    Only files containing template markup are rendered (see get_template_manifest),
+    by at most workers threads; files rendered before with the same variables and
+    not changed since (even by previous build) are skipped. Files are rewritten only if their content changes,
+    so their mtimes do not change needlessly. Return list of rewritten files.
+    """
+    variables = variables or {
+        'branch' : retrieve_current_branch(repository_directory=root_directory, fix_environment=True),
+    }
+
+    templates = get_template_manifest(root_directory, template_files=template_files, subdirs=subdirs)
+    logger.debug("Rendering templates %s in %s" % (", ".join(templates), root_directory))
+
+    variables_digest = None
+    if not isinstance(variables, BuildContext):
+        variables_digest = get_variables_digest(variables)
+    rewritten = map_in_pool(lambda template: _replace_template(root_directory, template, variables, variables_digest), templates, workers=workers)
+
+    return [template for template, was_rewritten in zip(templates, rewritten) if was_rewritten]
+
 def rename_template_files(root_directory, variables=None, subdirs=None):
     """
     In given root directory, walk through subdirs ("." allowed) and treat filename
     of every file present in given subdir as jinja2 template, renaming current
     file to new name, retrieved from rendering using variables given in variables
-    argument (or default ones, mostly retrieved from git repo).
+    argument (or default ones, mostly retrieved from git repo, or BuildContext).
     """
-    from jinja2 import Template
-    
     variables = variables or {
         'branch' : retrieve_current_branch(repository_directory=root_directory, fix_environment=True),
     }
+
+    environment = get_template_environment(root_directory)
     
     subdirs = subdirs or ['debian']
     
@@ -117,7 +734,7 @@ def rename_template_files(root_directory, variables=None, subdirs=None):
                 if not os.access(fp, os.R_OK|os.W_OK):
                     logging.error("Not handling file %s, unsufficient permissions (rw required)" % str(fp))
                 
-                newname = Template(fn).render(**variables)
+                newname = environment.from_string(fn).render(**get_template_variables(environment, fn, variables))
                 
                 os.rename(fp, os.path.join(os.path.join(root_directory, dir, newname)))
 
@@ -146,23 +763,119 @@ def _get_now_date_rfc():
     
     return now_date
 
-def get_common_variables(distribution):
-    variables = {
-        'version' : distribution.version if hasattr(distribution, "version") and distribution.version else distribution.get_version(),
-        'build_date' : _get_now_date_rfc(),
-        'revision_key' : get_git_last_hash()     
-    }
+class BuildContext(object):
+    """
+    Variables for templates rendered during one build. Values may be given lazily,
+    as callables computing them; they are computed only when some template
+    references them and remembered for the rest of the build, unless set with
+    memoize=False (then they're computed every time they're asked for).
+    Lazy value raising KeyError is considered undefined.
 
-    probe = getattr(distribution.metadata, "template_attributes", [
-        "branch_suffix",
-        "dependency_versions",
-    ])
-    
-    for var in probe:
-        if hasattr(distribution.metadata, var):
-            variables[var] = getattr(distribution.metadata, var)
-    
-    return variables
+    Names of variables templates asked for are in used_variables.
+    Context is thread safe, so templates may be rendered concurrently.
+    """
+
+    def __init__(self, variables=None):
+        self.values = dict(variables or {})
+        self.factories = {}
+        self.volatile = set()
+        self.used_variables = set()
+        self._lock = threading.RLock()
+
+    def set_lazy(self, name, factory, memoize=True):
+        self._lock.acquire()
+        try:
+            self.values.pop(name, None)
+            self.factories[name] = factory
+            if memoize:
+                self.volatile.discard(name)
+            else:
+                self.volatile.add(name)
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, name, value):
+        self._lock.acquire()
+        try:
+            self.factories.pop(name, None)
+            self.volatile.discard(name)
+            self.values[name] = value
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, name):
+        self._lock.acquire()
+        try:
+            if name in self.volatile:
+                value = self.factories[name]()
+            else:
+                if not self.values.has_key(name) and self.factories.has_key(name):
+                    self.values[name] = self.factories[name]()
+                    del self.factories[name]
+                value = self.values[name]
+            self.used_variables.add(name)
+            return value
+        finally:
+            self._lock.release()
+
+    def __contains__(self, name):
+        return self.values.has_key(name) or self.factories.has_key(name)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(set(self.values.keys()) | set(self.factories.keys()))
+
+    def get_computed(self):
+        """ Return dictionary of variables known so far, without computing lazy ones """
+        return dict(self.values)
+
+    def get_variables(self, names):
+        """ Return dictionary of given variables, computing them if needed; undefined ones are left out """
+        variables = {}
+        for name in names:
+            try:
+                variables[name] = self[name]
+            except KeyError:
+                pass
+        return variables
+
+def _get_metadata_attribute(metadata, name):
+    if not hasattr(metadata, name):
+        raise KeyError(name)
+    return getattr(metadata, name)
+
+def get_build_context(distribution):
+    """
+    Return BuildContext shared by all commands run for distribution, with
+    common template variables: version, build_date, revision_key and attributes of
+    distribution.metadata listed in it's template_attributes (branch_suffix and
+    dependency_versions by default), all computed on first use. Version is not
+    remembered, as commands may set distribution.version later in the build.
+    """
+    context = getattr(distribution, 'build_context', None)
+    if context is None:
+        context = BuildContext()
+        context.set_lazy('version', lambda: distribution.version if hasattr(distribution, "version") and distribution.version else distribution.get_version(), memoize=False)
+        context.set_lazy('build_date', _get_now_date_rfc)
+        context.set_lazy('revision_key', get_git_last_hash)
+
+        probe = getattr(distribution.metadata, "template_attributes", [
+            "branch_suffix",
+            "dependency_versions",
+        ])
+
+        for var in probe:
+            context.set_lazy(var, lambda var=var: _get_metadata_attribute(distribution.metadata, var))
+
+        distribution.build_context = context
+    return context
+
+def get_common_variables(distribution):
+    """ Return dictionary of common template variables for distribution, see get_build_context """
+    context = get_build_context(distribution)
+    return context.get_variables(context.keys())
 
 def validate_template_files_directories(dist, attr, value):
     pass
@@ -186,14 +899,15 @@ class ReplaceTemplateFiles(Command):
                                     ('build_lib', 'build_lib'))
 
     def run(self):
-        vars = get_common_variables(self.distribution)
-        vars['build_lib'] = self.build_lib
+        context = get_build_context(self.distribution)
+        context['build_lib'] = self.build_lib
 
         replace_template_files(
             root_directory=os.curdir,
-            variables=vars,
+            variables=context,
             subdirs=getattr(self.distribution, "template_files_directories", None)
         )
+        logger.info("Template variables used: %s" % ", ".join(sorted(context.used_variables)))
 
 class RenameTemplateFiles(Command):
     description = "Files named using jinja2 syntax, rename them using variable substitution."
@@ -208,4 +922,6 @@ class RenameTemplateFiles(Command):
         pass
 
     def run(self):
-        rename_template_files(root_directory=os.curdir, variables=get_common_variables(self.distribution))
+        context = get_build_context(self.distribution)
+        rename_template_files(root_directory=os.curdir, variables=context)
+        logger.info("Template variables used: %s" % ", ".join(sorted(context.used_variables)))
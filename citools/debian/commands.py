@@ -10,8 +10,11 @@ from distutils.core import Command
 
 from citools.build import ReplaceTemplateFiles, RenameTemplateFiles
 from citools.debian.control import ControlFile, Dependency
-from citools.git import fetch_repository
-from citools.version import get_git_describe, compute_version, compute_meta_version, get_git_head_hash, retrieve_current_branch
+from citools.debian.graph import DependencyGraph
+from citools.version import (
+    get_git_describe, compute_version, compute_meta_version, get_git_head_hash, retrieve_current_branch,
+    DependencySession, get_dependency_session, get_dependency_pattern,
+)
 
 
 __all__ = (
@@ -43,9 +46,10 @@ class BuildDebianPackage(Command):
         check_call(['dpkg-buildpackage', '-rfakeroot-tcp', '-us', '-uc'])
 
 
-def get_new_dependencies(dir, accepted_tag_pattern=None, branch="master"):
+def get_new_dependencies(dir, accepted_tag_pattern=None, branch="master", version=None):
     
-    version = compute_version(get_git_describe(repository_directory=dir, fix_environment=True, accepted_tag_pattern=accepted_tag_pattern))
+    if version is None:
+        version = compute_version(get_git_describe(repository_directory=dir, fix_environment=True, accepted_tag_pattern=accepted_tag_pattern))
     control = os.path.join(dir, 'debian', 'control')
 
     version = ".".join(map(str, version))
@@ -66,25 +70,87 @@ def get_new_dependencies(dir, accepted_tag_pattern=None, branch="master"):
 
     return packages
 
-def fetch_new_dependencies(repository, workdir=None):
+def get_dependency_branch(repository, workdir=None):
+    """ Return branch of dependency repository to use: configured one, or the one we're on """
     if repository.has_key('branch'):
-        branch = repository['branch']
+        return repository['branch']
     else:
         if workdir:
-            branch = retrieve_current_branch(repository_directory=workdir, fix_environment=True)
+            return retrieve_current_branch(repository_directory=workdir, fix_environment=True)
         else:
-            branch = retrieve_current_branch()
-    repo = fetch_repository(
-        repository=repository['url'], branch=branch
-    )
+            return retrieve_current_branch()
+
+def fetch_new_dependencies(repository, workdir=None, shallow=False, mirror_directory=None, session=None):
+    """
+    Return packages from debian/control of dependency repository, versioned by it's version.
+    If DependencySession is given, repository, it's version and packages are shared
+    with other build steps (and shallow and mirror_directory are taken from it instead).
+    """
+    branch = get_dependency_branch(repository, workdir)
+
+    if session is None:
+        session = DependencySession(fetch_options={
+            'shallow' : shallow,
+            'mirror_directory' : mirror_directory,
+        })
+
     #FIXME: This should not be hardcoded
-    project_pattern = "%s-[0-9]*" % repository['package_name']
-    
-    deps = get_new_dependencies(repo, accepted_tag_pattern=project_pattern, branch=branch)
+    project_pattern = get_dependency_pattern(repository)
+
+    deps = session.get_value('packages', repository, branch, lambda: get_new_dependencies(
+        session.get_directory(repository, branch),
+        accepted_tag_pattern=project_pattern,
+        branch=branch,
+        version=session.get_version(repository, branch)
+    ))
 
     return deps
 
 
+def build_dependency_graph(repositories, workdir=None, session=None):
+    """
+    Return DependencyGraph of packages from debian/control files of all dependency
+    repositories, versioned by version of their repository. Repositories are
+    fetched (and their control files rendered) through session, once per build.
+    """
+    session = session or DependencySession()
+    graph = DependencyGraph()
+
+    for repository in repositories:
+        branch = get_dependency_branch(repository, workdir)
+        # renders templates in debian/control, so it must go first
+        fetch_new_dependencies(repository, workdir, session=session)
+
+        control_file = session.get_value('control', repository, branch, lambda: ControlFile(
+            filename=join(session.get_directory(repository, branch), 'debian', 'control')
+        ))
+        version = ".".join(map(str, session.get_version(repository, branch)))
+        graph.add_control_file(control_file, version=version, origin=repository['url'])
+
+    return graph
+
+def update_dependency_graph(graph_path, repositories, control_file, version, workdir=None, session=None):
+    """
+    Build DependencyGraph of dependency repositories and our control_file (versioned
+    by version), store it into graph_path and return changes against graph stored
+    there by previous build (see DependencyGraph.get_changes).
+    """
+    graph = build_dependency_graph(repositories, workdir=workdir, session=session)
+    graph.add_control_file(control_file, version=version)
+
+    if exists(graph_path):
+        f = open(graph_path)
+        try:
+            previous = DependencyGraph.load(f)
+        finally:
+            f.close()
+    else:
+        previous = DependencyGraph()
+
+    changes = graph.get_changes(previous)
+    graph.dump(graph_path)
+    return changes
+
 def replace_versioned_packages(control_path, version, workdir=None):
     workdir = workdir or os.curdir
     cfile = ControlFile(filename=control_path)
@@ -111,13 +177,21 @@ def replace_versioned_debian_files(debian_path, original_version, new_version, c
 
                     os.remove(os.path.join(path, file))
 
-def update_dependency_versions(repositories, control_path, workdir=None, accepted_tag_pattern=None):
+def update_dependency_versions(repositories, control_path, workdir=None, accepted_tag_pattern=None, shallow=False, mirror_directory=None, session=None, graph_path=None):
     """
     Update control_path (presumably debian/control) with package version collected
     by parsing debian/controls in dependencies.
     Also updates with change of my path.
 
+    With shallow, dependencies are fetched as shallow clones, with mirror_directory, they're
+    cloned from bare mirrors kept there (see citools.git.fetch_repository).
+
+    Every dependency is fetched only once, using given DependencySession (or new one).
+
     If any versioned dependencies are present, replace them too, as well as debian files
+
+    With graph_path, dependency graph is updated there and changes since previous
+    build are returned (see update_dependency_graph)
     """
     workdir = workdir or os.curdir
     cfile = ControlFile(filename=control_path)
@@ -126,12 +200,17 @@ def update_dependency_versions(repositories, control_path, workdir=None, accepte
 
     cfile_meta_version = '0.0.0.0'
 
+    if session is None:
+        session = DependencySession(fetch_options={
+            'shallow' : shallow,
+            'mirror_directory' : mirror_directory,
+        })
+
     for repository in repositories:
-        deps = fetch_new_dependencies(repository, workdir)
+        deps = fetch_new_dependencies(repository, workdir, session=session)
         deps_from_repositories.extend(deps)
 
-    #FIXME: This will download deps again, fix it
-    meta_version = compute_meta_version(repositories, workdir=workdir, accepted_tag_pattern=accepted_tag_pattern)
+    meta_version = compute_meta_version(repositories, workdir=workdir, accepted_tag_pattern=accepted_tag_pattern, session=session)
     meta_version_string = ".".join(map(str, meta_version))
     
 
@@ -150,16 +229,26 @@ def update_dependency_versions(repositories, control_path, workdir=None, accepte
 
     cfile.dump(control_path)
 
+    if graph_path:
+        return update_dependency_graph(graph_path, repositories, cfile, meta_version_string, workdir=workdir, session=session)
+
 
 class UpdateDependencyVersions(Command):
 
     description = "parse and update versions in debian control file"
 
     user_options = [
+        ("shallow", None, "Fetch only as much of dependencies history as needed for their versions"),
+        ("mirror-directory=", None, "Directory with shared bare mirrors of dependency repositories"),
+        ("dependency-graph=", None, "File with dependency graph; packages affected since previous build are reported"),
     ]
 
+    boolean_options = ["shallow"]
+
     def initialize_options(self):
-        pass
+        self.shallow = False
+        self.mirror_directory = None
+        self.dependency_graph = None
 
     def finalize_options(self):
         pass
@@ -167,7 +256,14 @@ class UpdateDependencyVersions(Command):
     def run(self):
         try:
             format = "%s-[0-9]*" % self.distribution.metadata.get_name()
-            update_dependency_versions(self.distribution.dependencies_git_repositories, os.path.join('debian', 'control'), accepted_tag_pattern=format)
+            session = get_dependency_session(self.distribution, fetch_options={
+                'shallow' : self.shallow,
+                'mirror_directory' : self.mirror_directory,
+            })
+            changes = update_dependency_versions(self.distribution.dependencies_git_repositories, os.path.join('debian', 'control'), accepted_tag_pattern=format, session=session, graph_path=self.dependency_graph)
+            if changes:
+                for key in ('added', 'removed', 'changed', 'affected'):
+                    print "%s packages: %s" % (key.capitalize(), ", ".join(changes[key]) or "none")
         except:
             import traceback
             traceback.print_exc()
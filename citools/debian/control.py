@@ -2,14 +2,237 @@ from pyparsing import (
         ParserElement, LineEnd, CharsNotIn, Group, Word,
         alphanums, Literal, Combine, ZeroOrMore, nums,
         Optional, delimitedList, restOfLine,
-        Or, _ustr, MatchFirst
+        _ustr, MatchFirst
 )
 from itertools import chain
+import re
 
 
 DEPENDENCY_DELIMITERS = PROVIDES_DELIMITERS = [',']
 DEPENDENCY_INTERLIMITERS = ['|']
 
+# longest first, so that ">=" is not matched as ">"
+DEPENDENCY_SIGNS = ('>=', '<=', '>', '<', '=')
+
+# newlines are significant in control files
+GRAMMAR_WHITESPACE_CHARS = ' \t\r'
+
+# fast path patterns, matching what the grammars below accept for well-formed input
+FIELD_LINE_PATTERN = re.compile(r"^([A-Za-z0-9-]+):[ ]*(.*)$")
+RELATION_PATTERN = r"^[ \t\r]*([A-Za-z0-9.${}:-]+)[ \t\r]*(?:\([ \t\r]*(>=|<=|>|<|=)?[ \t\r]*(%s)[ \t\r]*\)[ \t\r]*)?$"
+DEPENDS_PATTERN = re.compile(RELATION_PATTERN % r"[0-9.-]+(?:~[A-Za-z0-9+]+)?")
+PROVIDES_PATTERN = re.compile(RELATION_PATTERN % r"[0-9.-]+")
+
+# upstream version and revision characters, as accepted by dpkg
+VERSION_PART_PATTERN = re.compile(r"^[A-Za-z0-9.+~:-]+$")
+REVISION_PATTERN = re.compile(r"^[A-Za-z0-9.+~]+$")
+VERSION_COMPONENT_PATTERN = re.compile(r"(\D*)(\d*)")
+
+_grammars = {}
+_version_keys = {}
+
+def get_grammar(builder, *args):
+    """
+    Return grammar built by builder(*args), building it only once per process.
+
+    Grammars are built with GRAMMAR_WHITESPACE_CHARS; pyparsing's global default
+    is restored afterwards, so other pyparsing users are not affected.
+    """
+    key = (builder,) + args
+    if key not in _grammars:
+        default_whitespace = ParserElement.DEFAULT_WHITE_CHARS
+        ParserElement.setDefaultWhitespaceChars(GRAMMAR_WHITESPACE_CHARS)
+        try:
+            grammar = builder(*args)
+        finally:
+            ParserElement.setDefaultWhitespaceChars(default_whitespace)
+        grammar.streamline()
+        _grammars[key] = grammar
+    return _grammars[key]
+
+def build_paragraph_grammar():
+    EOL = LineEnd().suppress()
+    comment = Literal('#') + Optional( restOfLine ) + EOL
+    string = CharsNotIn("\n")
+    line = Group(
+        Word(alphanums + '-')('key') + Literal(':').suppress() + Optional(Combine(string + ZeroOrMore(EOL + Literal(' ') + string)))("value") + EOL
+    )
+    group = ZeroOrMore(line)
+    group.ignore(comment)
+    return group
+
+def build_relation_grammar(factory, version):
+    """
+    Grammar for single "name" or "name (sign version)" relation, parsed into factory(name, sign, version).
+    Name is matched only once, so relations without version do not need backtracking.
+    """
+    package_name = Word(alphanums + '.-${}:')('name')
+    sign = MatchFirst(map(Literal, DEPENDENCY_SIGNS))('sign')
+    return (
+        package_name +
+        Optional(
+            Literal('(').suppress() +
+            Optional(sign)('sign') +
+            version +
+            Literal(')').suppress()
+        )
+    ).setParseAction(lambda x: factory(x.name, x.sign, x.version))
+
+def build_provides_grammar(delimiters):
+    provider = build_relation_grammar(get_provider, Word(nums + '.-')('version'))
+    return Optional(delimitedList(provider, MatchFirst(map(Literal, delimiters))))
+
+def build_depends_grammar(delimiters, interlimiters):
+    version = Combine(
+        Word(nums + '.-') + Optional(Literal('~') + Word(alphanums + '+'))
+    )('version')
+    dependency = build_relation_grammar(get_dependency, version)
+
+    delim = MatchFirst(map(Literal, delimiters + interlimiters))
+
+    dlName = _ustr(dependency)+" ["+_ustr(delim)+" "+_ustr(dependency)+"]..."
+    return Optional((dependency + ZeroOrMore(delim + dependency)).setName(dlName))
+
+def _get_char_order(char):
+    """ dpkg's ordering of non-digit characters: tilde before everything, then letters, then the rest """
+    if char == '~':
+        return -1
+    elif char.isalpha():
+        return ord(char)
+    else:
+        return ord(char) + 256
+
+def _get_version_part_key(part):
+    """
+    Return tuple sorting like dpkg's verrevcmp sorts upstream version or revision.
+
+    dpkg compares alternating non-digit and digit runs; flattened, that's
+    comparing sequences of character orders, zero ending every non-digit run,
+    and numbers, with shorter sequence padded by zeros. To get the padding
+    right in plain tuple comparison, only non-zero items are kept, along with
+    their positions.
+    """
+    items = []
+    position = 0
+    for nondigits, digits in VERSION_COMPONENT_PATTERN.findall(part):
+        values = [_get_char_order(char) for char in nondigits] + [0, int(digits or 0)]
+        for value in values:
+            # item present where other version has zero: positive wins, negative loses
+            if value > 0:
+                items.append((1, -position, value))
+            elif value < 0:
+                items.append((-1, position, value))
+            position += 1
+    # end of version sorts as zeros, so above negative and below positive items
+    items.append((0,))
+    return tuple(items)
+
+def get_version_key(version):
+    """
+    Return key sorting Debian versions the way dpkg compares them (epoch,
+    upstream version, revision; "~" sorting before anything, even end of version),
+    for use like sorted(versions, key=get_version_key).
+
+    Keys are cached per version string. Raise ValueError for invalid version.
+    """
+    if version not in _version_keys:
+        epoch, upstream, revision = '0', version, ''
+        if ':' in upstream:
+            epoch, upstream = upstream.split(':', 1)
+        if '-' in upstream:
+            upstream, revision = upstream.rsplit('-', 1)
+            if not REVISION_PATTERN.match(revision):
+                raise ValueError("Invalid version '%s'" % version)
+
+        if not epoch.isdigit() or not VERSION_PART_PATTERN.match(upstream):
+            raise ValueError("Invalid version '%s'" % version)
+
+        _version_keys[version] = (int(epoch), _get_version_part_key(upstream), _get_version_part_key(revision))
+    return _version_keys[version]
+
+def compare_versions(version, other):
+    """ Return negative, zero or positive number as version is lower, equal or higher than other, like dpkg --compare-versions """
+    return cmp(get_version_key(version), get_version_key(other))
+
+def iter_paragraph_sources(lines):
+    """
+    Generator yielding sources of deb822 paragraphs from iterable of lines
+    (like opened Packages file), paragraphs being separated by empty lines.
+    Only one paragraph is held in memory at time.
+    """
+    paragraph = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line:
+            paragraph.append(line)
+        elif paragraph:
+            yield '\n'.join(paragraph)
+            paragraph = []
+    if paragraph:
+        yield '\n'.join(paragraph)
+
+def tokenize_paragraph(source):
+    """
+    Return list of (key, value) fields of paragraph without pyparsing,
+    or None if source is not simple enough (tabs, carriage returns, comments
+    between continuation lines...) and must be parsed by full grammar.
+    """
+    if '\t' in source or '\r' in source:
+        return None
+
+    lines = source.split('\n')
+    while lines and not lines[-1]:
+        lines.pop()
+
+    fields = []
+    key, value = None, None
+    for i, line in enumerate(lines):
+        if line.startswith(' '):
+            # continuation, joined with it's leading space
+            if not value or len(line) < 2:
+                return None
+            value += line
+        elif line.startswith('#'):
+            # comment must be followed by another field
+            if i + 1 == len(lines) or lines[i+1].startswith(' ') or lines[i+1].startswith('#') or not lines[i+1]:
+                return None
+        else:
+            match = FIELD_LINE_PATTERN.match(line)
+            if not match or match.group(2).startswith('#'):
+                return None
+            if key is not None:
+                fields.append((key, value))
+            key, value = match.groups()
+
+    if key is not None:
+        fields.append((key, value))
+    return fields
+
+def tokenize_relations(value, pattern, factory, delimiters, interlimiters=(), keep_delimiters=True):
+    """
+    Return list of relations (as created by factory(name, sign, version)) from
+    Depends-like value without pyparsing, interleaved with delimiters if keep_delimiters.
+    Return None if value does not look well-formed and must be parsed by full grammar.
+    """
+    if not value.strip(' \t\r'):
+        return []
+
+    separators = list(delimiters) + list(interlimiters)
+    parts = re.split("(%s)" % "|".join(map(re.escape, separators)), value)
+
+    relations = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            if keep_delimiters:
+                relations.append(part)
+            continue
+        match = pattern.match(part)
+        if not match:
+            return None
+        name, sign, version = match.groups()
+        relations.append(factory(name, sign or '', version or ''))
+    return relations
+
 class ControlFileParagraph(dict):
     def __init__(self, source):
         self.provides_delimiters = self.dependency_delimiters = DEPENDENCY_DELIMITERS
@@ -21,23 +244,17 @@ class ControlFileParagraph(dict):
         super(ControlFileParagraph, self).__init__()
 
     def _parse_items(self, source):
-        ParserElement.setDefaultWhitespaceChars(' \t\r')
-        EOL = LineEnd().suppress()
-        comment = Literal('#') + Optional( restOfLine ) + EOL
-        string = CharsNotIn("\n")
-        line = Group(
-            Word(alphanums + '-')('key') + Literal(':').suppress() + Optional(Combine(string + ZeroOrMore(EOL + Literal(' ') + string)))("value") + EOL
-        )
-        group = ZeroOrMore(line)
-        group.ignore(comment)
-        return group.parseString(source, True)
+        items = tokenize_paragraph(source)
+        if items is None:
+            rows = get_grammar(build_paragraph_grammar).parseString(source, True)
+            items = [(row.key, row.value) for row in rows]
+        return items
 
     def _att_key(self, key):
         return key.lower().replace('-', '_')
 
     def _parse(self, source):
-        for row in self._parse_items(source):
-            key, value = row.key, row.value
+        for key, value in self._parse_items(source):
             att_key = self._att_key(key)
             if hasattr(self, 'parse_%s' % att_key):
                 value = getattr(self, 'parse_%s' % att_key)(value)
@@ -75,6 +292,8 @@ class ControlFileParagraph(dict):
             super(ControlFileParagraph, self).__setitem__(att_key, value)
 
 class Dependency(object):
+    __slots__ = ('name', 'version', 'sign')
+
     def __init__(self, name, version='', sign=''):
         self.name, self.version, self.sign = name, version, sign
 
@@ -93,9 +312,89 @@ class Dependency(object):
         return bool(self.version and not self.sign)
 
 class Provider(Dependency):
+    __slots__ = ()
+
     def __repr__(self):
         return '<Provider(%r, %r, %r)>' % (self.name, self.version, self.sign)
 
+class Alternatives(list):
+    """ OR-group of relations, any of which satisfies it, like "a | b" """
+    __slots__ = ()
+
+    def __str__(self):
+        return (' %s ' % DEPENDENCY_INTERLIMITERS[0]).join([str(relation) for relation in self])
+
+    def __repr__(self):
+        return '<Alternatives(%s)>' % list.__repr__(self)
+
+class RelationList(list):
+    """
+    Relations of paragraph field, like "Depends"; tells paragraph about changes
+    made in place, so that ControlFile indexes of the field are dropped.
+    Alternatives are tracked as items, so replace them instead of changing them in place.
+    """
+    __slots__ = ('paragraph', 'field')
+
+    def __init__(self, relations=(), paragraph=None, field=None):
+        super(RelationList, self).__init__(relations)
+        self.paragraph, self.field = paragraph, field
+
+    def _changed(self):
+        if self.paragraph is not None:
+            self.paragraph.relations_changed(self.field)
+
+    def _changing(method):
+        def changing(self, *args):
+            result = method(self, *args)
+            self._changed()
+            return result
+        changing.__name__ = method.__name__
+        return changing
+
+    __setitem__ = _changing(list.__setitem__)
+    __delitem__ = _changing(list.__delitem__)
+    __setslice__ = _changing(list.__setslice__)
+    __delslice__ = _changing(list.__delslice__)
+    __iadd__ = _changing(list.__iadd__)
+    __imul__ = _changing(list.__imul__)
+    append = _changing(list.append)
+    extend = _changing(list.extend)
+    insert = _changing(list.insert)
+    pop = _changing(list.pop)
+    remove = _changing(list.remove)
+    reverse = _changing(list.reverse)
+    sort = _changing(list.sort)
+    del _changing
+
+def group_relations(tokens, interlimiters=DEPENDENCY_INTERLIMITERS):
+    """
+    Return list of relations, where relations separated by interlimiters
+    are grouped into Alternatives, from list of relations interleaved
+    with delimiter strings (as tokenized)
+    """
+    relations = []
+    alternative = False
+    for token in tokens:
+        if isinstance(token, basestring):
+            alternative = token in interlimiters
+        elif alternative:
+            if not isinstance(relations[-1], Alternatives):
+                relations[-1] = Alternatives([relations[-1]])
+            relations[-1].append(token)
+            alternative = False
+        else:
+            relations.append(token)
+    return relations
+
+def iter_relations(relations):
+    """ Generator yielding all Dependency objects from list of relations, including members of Alternatives """
+    for relation in relations or ():
+        if isinstance(relation, Alternatives):
+            for alternative in relation:
+                yield alternative
+        else:
+            yield relation
+
 def get_versioned_package(name, klass, sign='', version=''):
     if version and not sign:
         sign = '='
@@ -119,75 +418,62 @@ class SourceParagraph(ControlFileParagraph):
     pass
 
 class PackageParagraph(ControlFileParagraph):
+    RELATION_FIELDS = ('depends', 'provides')
+
+    # relation indexes of ControlFile paragraph belongs to, see ControlFile.get_relation_index
+    _relation_indexes = None
+
+    def __init__(self, source, names=None):
+        """
+        names is dictionary shared by paragraphs of one file, so that the same package names
+        in large indexes are stored once (and released with the file)
+        """
+        if names is None:
+            names = {}
+        self._names = names
+        super(PackageParagraph, self).__init__(source)
+
+    def intern_names(self, relations):
+        """ Replace names of relations by shared copies; return relations """
+        for relation in iter_relations(relations):
+            relation.name = self._names.setdefault(relation.name, relation.name)
+        return relations
+
+    def __setitem__(self, name, value):
+        att_key = self._att_key(name)
+        if att_key in self.RELATION_FIELDS:
+            if not isinstance(value, RelationList) or value.paragraph is not self:
+                value = RelationList(value, self, att_key)
+            self.relations_changed(att_key)
+        super(PackageParagraph, self).__setitem__(name, value)
+
+    def relations_changed(self, field):
+        if self._relation_indexes is not None:
+            self._relation_indexes.pop(field, None)
+
     def parse_package(self, value):
-        return get_dependency(value)
+        return self.intern_names([get_dependency(value)])[0]
 
     def parse_provides(self, value):
-        package_name = Word(alphanums + '.-${}:')('name')
-        version = Word(nums + '.-')('version')
-        sign = Or(map(Literal, ('>', '<', '>=', '<=', '=',)))('sign')
-        provider = (
-                (
-                    package_name +
-                    Literal('(').suppress() +
-                    Optional(sign)('sign') +
-                    version +
-                    Literal(')').suppress()
-                ) | (
-                    package_name
-                )
-            ).setParseAction(lambda x: get_provider(x.name, x.sign, x.version))
-        providers = Optional(delimitedList(provider, ','))
-        return providers.parseString(value, True).asList()
+        providers = tokenize_relations(value, PROVIDES_PATTERN, get_provider, self.provides_delimiters, keep_delimiters=False)
+        if providers is None:
+            grammar = get_grammar(build_provides_grammar, tuple(self.provides_delimiters))
+            providers = grammar.parseString(value, True).asList()
+        return self.intern_names(providers)
 
     def parse_depends(self, value):
-        package_name = Word(alphanums + '.-${}:')('name')
-        version = Combine(
-            Word(nums + '.-') + Optional(Literal('~') + Word(alphanums + '+'))
-        )('version')
-
-        sign = Or(map(Literal, ('>', '<', '>=', '<=', '=',)))('sign')
-        dependency = (
-                (
-                    package_name +
-                    Literal('(').suppress() +
-                    Optional(sign)('sign') +
-                    version +
-                    Literal(')').suppress()
-                ) | (
-                    package_name
-                )
-            ).setParseAction(lambda x: get_dependency(x.name, x.sign, x.version))
-
-        delim = MatchFirst([])
-        for i in self.dependency_delimiters + self.dependency_interlimiters:
-            delim = delim | Literal(i)
-            
-        dlName = _ustr(dependency)+" ["+_ustr(delim)+" "+_ustr(dependency)+"]..."
-        dependencies = Optional((dependency + ZeroOrMore(delim + dependency)).setName(dlName))
-
-        return dependencies.parseString(value, True).asList()
+        """ Return list of Dependency objects, alternatives being grouped into Alternatives """
+        tokens = tokenize_relations(value, DEPENDS_PATTERN, get_dependency, self.dependency_delimiters, self.dependency_interlimiters)
+        if tokens is None:
+            grammar = get_grammar(build_depends_grammar, tuple(self.dependency_delimiters), tuple(self.dependency_interlimiters))
+            tokens = grammar.parseString(value, True).asList()
+        return self.intern_names(group_relations(tokens, self.dependency_interlimiters))
 
     def dump_depends(self, value):
-        out = ''
-        for v in value:
-            if v in self.dependency_delimiters:
-                out += '%s ' % v
-            elif v in self.dependency_interlimiters:
-                out += ' %s ' % v
-            else:
-                out += str(v)
-
-        return out
+        return ('%s ' % self.dependency_delimiters[0]).join([str(v) for v in value])
 
     def dump_provides(self, value):
-        out = ''
-        for v in value:
-            if v in self.provides_delimiters:
-                out += '%s ' % v
-            else:
-                out += str(v)
-        return out
+        return ('%s ' % self.provides_delimiters[0]).join([str(v) for v in value])
 
 class ControlFile(object):
     DEFAULT_SOURCE_PARAGRAPH = """Section: python
@@ -200,37 +486,70 @@ Standards-Version: 3.7.2
 Depends: python (>= 2.5.0)
 """
 
-    def __init__(self, source=None, filename=''):
+    def __init__(self, source=None, filename='', fileobj=None):
+        """
+        Parse control file given as source string, by filename or as file object;
+        file object is read paragraph by paragraph.
+        """
         if filename:
             f = open(filename)
             source = f.read()
-            f.close
+            f.close()
 
-        if source:
-            paragraphs = source.split('\n\n')
+        if fileobj is not None:
+            paragraphs = iter_paragraph_sources(fileobj)
+        elif source:
+            paragraphs = iter(source.split('\n\n'))
         else:
-            paragraphs = [self.DEFAULT_SOURCE_PARAGRAPH]
+            paragraphs = iter([self.DEFAULT_SOURCE_PARAGRAPH])
 
-        if not paragraphs:
+        try:
+            self.source = SourceParagraph(paragraphs.next())
+        except StopIteration:
             # FIXME - add some exception
             raise NotImplementedError()
-        self.source = SourceParagraph(paragraphs[0])
         self.packages = []
+        self._relation_indexes = {}
+        self._names = {}
 
-        for s in paragraphs[1:]:
+        for s in paragraphs:
             if s:
                 self.add_package(s)
 
     def add_package(self, source=None):
-        package = PackageParagraph(source or self.DEFAULT_PACKAGE_PARAGRAPH)
+        package = PackageParagraph(source or self.DEFAULT_PACKAGE_PARAGRAPH, names=self._names)
+        package._relation_indexes = self._relation_indexes
+        self._relation_indexes.clear()
         self.packages.append(package)
         return package
 
     def get_dependencies(self):
-        return chain(*([i for i in p.get('depends', []) if i not in DEPENDENCY_DELIMITERS+DEPENDENCY_INTERLIMITERS] for p in self.packages))
+        return chain(*[iter_relations(p.get('depends')) for p in self.packages])
 
     def get_provides(self):
-        return chain(*([i for i in p.get('provides', []) if i not in PROVIDES_DELIMITERS] for p in self.packages))
+        return chain(*[iter_relations(p.get('provides')) for p in self.packages])
+
+    def _get_indexed_relations(self, field):
+        """ Return (index, {id(relation) : position of relation in document}) for field """
+        if field not in self._relation_indexes:
+            index = {}
+            positions = {}
+            for package in self.packages:
+                for relation in iter_relations(package.get(field)):
+                    index.setdefault(relation.name, []).append(relation)
+                    positions[id(relation)] = len(positions)
+            self._relation_indexes[field] = (index, positions)
+        return self._relation_indexes[field]
+
+    def get_relation_index(self, field):
+        """
+        Return dictionary mapping package name to list of Dependency (or Provider)
+        objects referencing it in given field ('depends' or 'provides') of all packages.
+
+        Index is built on first use and dropped when package is added (by add_package)
+        or when relations of field change (by assignment or in place, see RelationList).
+        """
+        return self._get_indexed_relations(field)[0]
 
     def get_versioned_dependencies(self):
         return [d for d in self.get_dependencies() if d.is_versioned()]
@@ -241,45 +560,40 @@ Depends: python (>= 2.5.0)
     def check_downgrade(self, current_version, new_version):
         """
         Raise ValueError if new_version is lower then current_version
+        (or any of them is not valid Debian version)
         """
-        curr_tuple = map(int, current_version.split("."))
-        new_tuple = map(int, new_version.split("."))
-
-
-        for i in xrange(0, len(curr_tuple)):
-            if len(new_tuple) < (i+1):
-                raise ValueError("Attempt to downgrade %s to %s (%s)" % (
-                    current_version,
-                    new_version,
-                    self._pname,
-                ))
-            elif new_tuple[i] > curr_tuple[i]:
-                return True
-            elif (new_tuple[i] < curr_tuple[i]):
-                raise ValueError("Attempt to downgrade %s to %s (%s)" % (
-                    current_version,
-                    new_version,
-                    self._pname,
-                ))
+        if compare_versions(new_version, current_version) < 0:
+            raise ValueError("Attempt to downgrade %s to %s (%s)" % (
+                current_version,
+                new_version,
+                getattr(self, '_pname', None),
+            ))
         return True
 
-    def replace_dependencies(self, deps_from_repositories):
+    def _replace_versions(self, field, deps_from_repositories):
+        """
+        Set versions of relations in field to ones of same-named deps_from_repositories,
+        looking up only given names, in order of the document
+        """
         new_versions = dict((p.name, p.version) for p in deps_from_repositories)
-        for p in self.get_dependencies():
-            if p.name in new_versions:
-                self._pname = p.name
-                new_version = new_versions[p.name]
-                self.check_downgrade(p.version, new_version)
-                p.version = new_version
+        index, positions = self._get_indexed_relations(field)
+
+        relations = []
+        for name in new_versions:
+            relations.extend(index.get(name, []))
+        # in document order, so file is updated the same way up to failed downgrade check
+        relations.sort(key=lambda p: positions[id(p)])
+
+        for p in relations:
+            self._pname = p.name
+            self.check_downgrade(p.version, new_versions[p.name])
+            p.version = new_versions[p.name]
+
+    def replace_dependencies(self, deps_from_repositories):
+        self._replace_versions('depends', deps_from_repositories)
 
     def replace_provides(self, deps_from_repositories):
-        new_versions = dict((p.name, p.version) for p in deps_from_repositories)
-        for p in self.get_provides():
-            if p.name in new_versions:
-                self._pname = p.name
-                new_version = new_versions[p.name]
-                self.check_downgrade(p.version, new_version)
-                p.version = new_version
+        self._replace_versions('provides', deps_from_repositories)
 
     def replace_versioned_packages(self, version, old_version='0.0.0.0'):
         self.replace_versioned_dependencies(version, old_version)
@@ -309,3 +623,12 @@ Depends: python (>= 2.5.0)
             fout.write(out)
             fout.close()
         return out
+
+def iter_packages(fileobj, paragraph_class=PackageParagraph):
+    """
+    Generator yielding parsed paragraphs of file object with package stanzas only
+    (like apt Packages index), parsing one stanza at time
+    """
+    names = {}
+    for source in iter_paragraph_sources(fileobj):
+        yield paragraph_class(source, names=names)
@@ -0,0 +1,281 @@
+"""
+In-memory graph of binary packages from debian/control files of meta-package
+dependencies, to see which packages are affected by a change and in what
+order they shall be rebuilt.
+"""
+import heapq
+
+from citools.debian.control import Alternatives, compare_versions, iter_packages, iter_relations
+
+
+class DependencyCycleError(ValueError):
+    """ Packages depend on each other, so there is no order to build them in """
+    def __init__(self, cycles):
+        self.cycles = cycles
+        super(DependencyCycleError, self).__init__("Dependency cycles found: %s" % "; ".join([" -> ".join(cycle) for cycle in cycles]))
+
+
+def get_package_name(relation):
+    """ Return name of package relation refers to; versioned packages like ella-1.0 are packages of their own """
+    if relation.is_versioned():
+        return str(relation)
+    return relation.name
+
+
+class DependencyGraph(object):
+    """
+    Packages (by name) with their versions, Depends and Provides.
+
+    Package depends on every package of the graph that is named in it's Depends,
+    either directly or through Provides; all members of "a | b" alternatives
+    are considered, as change of any of them may change what package gets.
+    Packages outside of the graph (like python) are ignored.
+    """
+
+    # how constraint sign relates to compare_versions(available, required)
+    SIGN_CHECKS = {
+        '>=' : lambda result: result >= 0,
+        '<=' : lambda result: result <= 0,
+        '>' : lambda result: result > 0,
+        '<' : lambda result: result < 0,
+        '=' : lambda result: result == 0,
+    }
+
+    def __init__(self):
+        self.versions = {}
+        self.depends = {}
+        self.provides = {}
+        self.origins = {}
+        self._edges = None
+
+    def add_package(self, name, version='', depends=None, provides=None, origin=None):
+        """ Add package with it's list of relations (as parsed from Depends) and names it provides """
+        self.versions[name] = version or ''
+        self.depends[name] = list(depends or [])
+        self.provides[name] = sorted(provides or [])
+        self.origins[name] = origin
+        self._edges = None
+
+    def add_paragraph(self, paragraph, version=None, origin=None):
+        """ Add package from PackageParagraph; version is taken from Version field if not given """
+        self.add_package(
+            get_package_name(paragraph['package']),
+            version=version or paragraph.get('version', ''),
+            depends=paragraph.get('depends'),
+            provides=[provider.name for provider in iter_relations(paragraph.get('provides'))],
+            origin=origin,
+        )
+
+    def add_control_file(self, control_file, version=None, origin=None):
+        """ Add all binary packages from ControlFile, versioned by version of their repository if given """
+        for paragraph in control_file.packages:
+            self.add_paragraph(paragraph, version=version, origin=origin)
+
+    def get_providers(self):
+        """ Return dictionary mapping provided name to names of packages providing it """
+        providers = {}
+        for name, provided in self.provides.items():
+            for virtual in provided:
+                providers.setdefault(virtual, []).append(name)
+        return providers
+
+    def resolve(self, name, providers=None):
+        """ Return names of packages in graph satisfying dependency on name """
+        if name in self.versions:
+            return [name]
+        if providers is None:
+            providers = self.get_providers()
+        return sorted(providers.get(name, []))
+
+    def get_edges(self):
+        """ Return dictionary mapping package to set of packages it depends on """
+        if self._edges is None:
+            providers = self.get_providers()
+            self._edges = {}
+            for name, relations in self.depends.items():
+                self._edges[name] = set()
+                for relation in iter_relations(relations):
+                    self._edges[name].update(self.resolve(get_package_name(relation), providers))
+        return self._edges
+
+    def get_dependents(self, names):
+        """ Return set of packages depending on any of names, directly or transitively """
+        reverse = {}
+        for name, dependencies in self.get_edges().items():
+            for dependency in dependencies:
+                reverse.setdefault(dependency, set()).add(name)
+
+        dependents = set()
+        queue = list(names)
+        while queue:
+            for dependent in reverse.get(queue.pop(), ()):
+                if dependent not in dependents:
+                    dependents.add(dependent)
+                    queue.append(dependent)
+        return dependents
+
+    def find_cycles(self):
+        """
+        Return list of dependency cycles, each as sorted list of packages
+        depending on each other (strongly connected components of Tarjan's
+        algorithm, done without recursion as graphs may be deep)
+        """
+        edges = self.get_edges()
+        index, lowlink = {}, {}
+        stack, on_stack = [], set()
+        cycles = []
+
+        for root in sorted(edges):
+            if root in index:
+                continue
+
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(sorted(edges[root])))]
+
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(edges[child]))))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in edges[node]:
+                            cycles.append(sorted(component))
+
+        return sorted(cycles)
+
+    def get_topological_order(self, names=None):
+        """
+        Return packages (all or only names) ordered so that every package comes
+        after packages it depends on; ties are broken by name.
+        Raise DependencyCycleError if there is no such order.
+        """
+        edges = self.get_edges()
+        if names is None:
+            names = edges.keys()
+        names = set(names)
+
+        waiting_for = {}
+        dependents = {}
+        for name in names:
+            dependencies = edges.get(name, set()) & names
+            waiting_for[name] = len(dependencies)
+            for dependency in dependencies:
+                dependents.setdefault(dependency, []).append(name)
+
+        ready = [name for name, count in waiting_for.items() if count == 0]
+        heapq.heapify(ready)
+
+        order = []
+        while ready:
+            name = heapq.heappop(ready)
+            order.append(name)
+            for dependent in dependents.get(name, ()):
+                waiting_for[dependent] -= 1
+                if waiting_for[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+
+        if len(order) < len(names):
+            cycles = [cycle for cycle in self.find_cycles() if set(cycle) & names]
+            raise DependencyCycleError(cycles)
+
+        return order
+
+    def get_unsatisfied(self):
+        """
+        Return list of (package, dependency, available version) for versioned
+        dependencies on packages in graph that graph's version does not satisfy
+        """
+        unsatisfied = []
+        for name in sorted(self.depends):
+            for relation in self.depends[name]:
+                if isinstance(relation, Alternatives):
+                    alternatives = list(relation)
+                else:
+                    alternatives = [relation]
+
+                checked = [d for d in alternatives if d.sign in self.SIGN_CHECKS and self.versions.get(d.name)]
+                if checked and len(checked) == len(alternatives):
+                    if not [d for d in checked if self.SIGN_CHECKS[d.sign](compare_versions(self.versions[d.name], d.version))]:
+                        for d in checked:
+                            unsatisfied.append((name, d, self.versions[d.name]))
+        return unsatisfied
+
+    def get_signature(self, name):
+        """ Return what identifies package state: it's version, Depends and Provides """
+        return (self.versions[name], ", ".join([str(r) for r in self.depends[name]]), self.provides[name])
+
+    def get_changes(self, previous):
+        """
+        Compare graph with previous one and return dictionary with sorted lists
+        of 'added', 'removed' and 'changed' packages, and 'affected' packages
+        (added, changed and those depending on any changed or removed package),
+        in topological order.
+        """
+        added = sorted([name for name in self.versions if name not in previous.versions])
+        removed = sorted([name for name in previous.versions if name not in self.versions])
+        changed = sorted([
+            name for name in self.versions
+            if name in previous.versions and self.get_signature(name) != previous.get_signature(name)
+        ])
+
+        # packages depending on removed ones are known only to previous graph
+        affected = set(added + changed) | self.get_dependents(added + changed)
+        affected |= previous.get_dependents(removed) & set(self.versions)
+
+        return {
+            'added' : added,
+            'removed' : removed,
+            'changed' : changed,
+            'affected' : self.get_topological_order(affected),
+        }
+
+    def dump(self, filename=None):
+        """ Return graph as Packages-like file, loadable by load() """
+        stanzas = []
+        for name in sorted(self.versions):
+            lines = ["Package: %s" % name]
+            if self.versions[name]:
+                lines.append("Version: %s" % self.versions[name])
+            if self.depends[name]:
+                lines.append("Depends: %s" % ", ".join([str(r) for r in self.depends[name]]))
+            if self.provides[name]:
+                lines.append("Provides: %s" % ", ".join(self.provides[name]))
+            if self.origins[name]:
+                lines.append("X-Origin: %s" % self.origins[name])
+            stanzas.append("\n".join(lines))
+
+        out = "\n\n".join(stanzas) + "\n"
+        if filename:
+            fout = open(filename, 'w')
+            fout.write(out)
+            fout.close()
+        return out
+
+    def load(cls, fileobj):
+        """ Return graph read from file object with output of dump() """
+        graph = cls()
+        for paragraph in iter_packages(fileobj):
+            graph.add_paragraph(paragraph, origin=paragraph.get('x_origin'))
+        return graph
+    load = classmethod(load)
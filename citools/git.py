@@ -1,28 +1,288 @@
 from ConfigParser import SafeConfigParser
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta, tzinfo
 from distutils.core import Command
 from distutils.errors import DistutilsOptionError
-from locale import resetlocale, setlocale, LC_ALL
 from subprocess import CalledProcessError
+from shutil import rmtree
 from tempfile import mkdtemp
+import fcntl
 import os
 import re
 from subprocess import check_call, PIPE, Popen
 import logging
+import threading
+import time
 import traceback
 
+from citools.gitdb import md5
+from citools.pool import map_in_pool
+from citools.wildmatch import filter_matching
+
 log = logging.getLogger("citools.git")
 
 
 USED_GIT_PARSING_LOCALE = "en_US"
 
-def fetch_repository(repository, workdir=None, branch=None, cache_config_dir=None, cache_config_file_name="cached_repositories.ini", reference_repository=None):
+MONTHS = dict([(name, i+1) for i, name in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])])
+
+GIT_LOCAL_DATE_PATTERN = re.compile(r"^(?P<dow>\w+)\ {1}(?P<month>\w+)\ {1}(?P<day>\d{1,2})\ {1}(?P<hour>\d{1,2})\:{1}(?P<minute>\d{1,2})\:{1}(?P<second>\d{1,2})\ {1}(?P<year>\d+).*$", re.UNICODE)
+
+ZERO_TIMEDELTA = timedelta(0)
+
+# subcollection of metadata collection holding last ingested changeset per repository
+HIGH_WATER_MARKS_COLLECTION = "high_water_marks"
+
+# number of changesets stored into mongo at once
+DEFAULT_METADATA_BATCH_SIZE = 500
+
+# initial depth of shallow clones; doubled every time we need to look deeper for tag
+SHALLOW_CLONE_DEPTH = 10
+
+# fetches done by deepen_repository before it gives up and fetches whole history
+MAX_DEEPEN_FETCHES = 8
+
+# guards read-modify-write of repository cache file when fetching from multiple threads
+_repository_cache_lock = threading.Lock()
+
+# if set, dependency repositories are fetched through bare mirrors kept in this directory
+MIRROR_DIRECTORY_ENVIRONMENT_VARIABLE = "CITOOLS_MIRROR_DIRECTORY"
+
+def get_clean_git_environment():
+    """
+    Return copy of environment without GIT_DIR, as other threads may have
+    GIT_DIR set (see fix_environment in citools.version) while we're running git
+    """
+    env = dict(os.environ)
+    if 'GIT_DIR' in env:
+        del env['GIT_DIR']
+    return env
+
+def get_clone_url(repository):
+    """ git ignores --depth and --filter when cloning plain local path, so turn it into file:// url """
+    if os.path.isdir(repository):
+        return "file://%s" % os.path.abspath(repository)
+    return repository
+
+def get_remote_tags(repository, accepted_tag_pattern=None, env=None):
+    """
+    Return {tag name : commit hash} of annotated tags in remote repository
+    (only those are considered by git describe), listed by single git ls-remote call
+    without fetching any objects.
+    """
+    command = ["git", "ls-remote", "--tags", repository]
+    proc = Popen(command, stdout=PIPE, stderr=PIPE, env=env)
+    stdout, stderr = proc.communicate()
+
+    if proc.returncode != 0:
+        log.error("Cannot list remote tags: stdout: %s stderr: %s" % (stdout, stderr))
+        raise CalledProcessError(proc.returncode, command)
+
+    tags = {}
+    for line in stdout.splitlines():
+        parts = line.split()
+        if len(parts) != 2 or not parts[1].endswith("^{}"):
+            continue
+        tags[parts[1][len("refs/tags/"):-len("^{}")]] = parts[0]
+
+    if accepted_tag_pattern is not None:
+        tags = dict([(name, tags[name]) for name in filter_matching(accepted_tag_pattern, tags.keys())])
+
+    return tags
+
+def get_shallow_commits(dir):
+    """ Return set of boundary commits of shallow clone in dir; empty for complete history """
+    shallow_file = os.path.join(dir, ".git", "shallow")
+    if not os.path.exists(shallow_file):
+        return set()
+    f = open(shallow_file)
+    try:
+        return set([line.strip() for line in f if line.strip()])
+    finally:
+        f.close()
+
+def is_shallow_ancestor(dir, tag, commit, env=None):
+    """
+    Return True if remote tag (pointing to commit) is ancestor of HEAD in complete history
+    of shallow clone in dir, even if it's hidden behind shallow boundary.
+
+    History is fetched down to commits reachable from tag (git fetch --shallow-exclude);
+    then tag is an ancestor exactly if it is a parent of some of new boundary commits,
+    as their objects still name their real parents. If server cannot exclude history
+    this way, True is returned, as tag may be an ancestor.
+    """
+    proc = Popen(["git", "fetch", "--shallow-exclude=refs/tags/%s" % tag, "origin"], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        log.debug("Cannot fetch history excluding %s, assuming it's reachable: %s" % (tag, stderr))
+        return True
+
+    for boundary in get_shallow_commits(dir):
+        proc = Popen(["git", "cat-file", "commit", boundary], cwd=dir, stdout=PIPE, stderr=PIPE, env=env)
+        stdout = proc.communicate()[0]
+        headers = stdout.split("\n\n", 1)[0].splitlines()
+        if "parent %s" % commit in headers:
+            return True
+    return False
+
+def deepen_repository(dir, repository, accepted_tag_pattern, depth=SHALLOW_CLONE_DEPTH, env=None, max_fetches=MAX_DEEPEN_FETCHES):
+    """
+    Deepen shallow clone in dir (doubling fetched depth every round) until git describe
+    limited to accepted_tag_pattern computes the same result as it would on complete history.
+
+    Tags with higher version than highest reachable one are checked by is_shallow_ancestor
+    first (highest first), so tags on other branches, which never become reachable,
+    are ignored instead of deepening until whole history is fetched.
+    After max_fetches fetches, whole history is fetched at once.
+    """
+    from citools.version import get_git_ancestry, get_hidden_higher_tags, is_describe_complete
+
+    tags = get_remote_tags(repository, accepted_tag_pattern, env=env)
+    checked = set()
+    fetches = 0
+
+    while True:
+        shallow_commits = get_shallow_commits(dir)
+        if not shallow_commits:
+            return
+
+        head, parents = get_git_ancestry(repository_directory=dir)
+        hidden = [name for name in get_hidden_higher_tags(parents, tags) if name not in checked]
+        if not hidden and is_describe_complete(head, parents, shallow_commits, tags):
+            return
+
+        if fetches >= max_fetches:
+            log.debug("Cannot find tag matching %s in %s fetches, fetching whole history of %s" % (accepted_tag_pattern, fetches, repository))
+            break
+        fetches += 1
+
+        if hidden:
+            checked.add(hidden[0])
+            if not is_shallow_ancestor(dir, hidden[0], tags[hidden[0]], env=env):
+                log.debug("Tag %s is not reachable from HEAD of %s, ignoring it" % (hidden[0], repository))
+                del tags[hidden[0]]
+            continue
+
+        log.debug("Deepening %s by %s commits to find tag matching %s" % (repository, depth, accepted_tag_pattern))
+        check_call(["git", "fetch", "--deepen=%s" % depth, "origin"], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+
+        if get_shallow_commits(dir) == shallow_commits:
+            # server was not able to deepen us, give up and fetch everything
+            break
+
+        depth *= 2
+
+    check_call(["git", "fetch", "--unshallow", "origin"], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+
+def get_mirror_directory(mirror_directory=None):
+    """ Return directory of mirror pool: given one, or one from environment; None if mirrors are not used """
+    return mirror_directory or os.environ.get(MIRROR_DIRECTORY_ENVIRONMENT_VARIABLE) or None
+
+def get_mirror_path(repository, mirror_directory):
+    """ Return path of bare mirror for repository url inside mirror_directory """
+    name = repository.rstrip("/").split("/")[-1].split(":")[-1]
+    if name.endswith(".git"):
+        name = name[:-4]
+    return os.path.join(os.path.abspath(mirror_directory), "%s-%s.git" % (name or "repository", md5(repository).hexdigest()[:12]))
+
+class MirrorLock(object):
+    """
+    Advisory file lock for mirror, shared by concurrent builds (and threads, as every
+    lock uses it's own file descriptor). Exclusive lock is held while mirror is updated,
+    shared one while repositories are cloned from it.
+    """
+    def __init__(self, mirror_path):
+        self.path = "%s.lock" % mirror_path
+        self.file = None
+
+    def acquire(self, exclusive=True):
+        self.file = open(self.path, "a")
+        if exclusive:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_SH)
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+def update_mirror(repository, mirror_directory, env=None):
+    """
+    Create bare mirror of repository inside mirror_directory, or incrementally fetch
+    into existing one. Return path to mirror.
+    """
+    if not os.path.isdir(mirror_directory):
+        try:
+            os.makedirs(mirror_directory)
+        except OSError:
+            # created by concurrent build meanwhile
+            if not os.path.isdir(mirror_directory):
+                raise
+
+    mirror = get_mirror_path(repository, mirror_directory)
+    env = env or get_clean_git_environment()
+
+    lock = MirrorLock(mirror)
+    lock.acquire(exclusive=True)
+    try:
+        if os.path.exists(mirror):
+            log.debug("Updating mirror %s of %s" % (mirror, repository))
+            check_call(["git", "fetch", "--prune", "origin"], cwd=mirror, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+        else:
+            log.debug("Creating mirror %s of %s" % (mirror, repository))
+            # clone aside, so interrupted clone is never taken as a mirror
+            temporary_mirror = mkdtemp(dir=os.path.dirname(mirror), prefix=".%s-" % os.path.basename(mirror))
+            try:
+                check_call(["git", "clone", "--mirror", repository, temporary_mirror], stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+                os.rename(temporary_mirror, mirror)
+            except:
+                rmtree(temporary_mirror, ignore_errors=True)
+                raise
+    finally:
+        lock.release()
+
+    return mirror
+
+def clone_from_mirror(repository, mirror, dir, env=None):
+    """
+    Clone repository into dir from it's local mirror (hardlinking objects, without any
+    network traffic), with origin pointing back to repository url
+    """
+    env = env or get_clean_git_environment()
+
+    lock = MirrorLock(mirror)
+    lock.acquire(exclusive=False)
+    try:
+        check_call(["git", "clone", mirror, dir], stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+    finally:
+        lock.release()
+
+    check_call(["git", "remote", "set-url", "origin", repository], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+
+def fetch_repository(repository, workdir=None, branch=None, cache_config_dir=None, cache_config_file_name="cached_repositories.ini", reference_repository=None, shallow=False, accepted_tag_pattern=None, mirror_directory=None):
     """
     Fetch repository inside a workdir. Return filesystem path of newly created dir.
     if cache_config_dir is False, no attempt to use caching is used. If None, curdir is used, if string, it's taken as path to directory.
         If given directory is not writeable, warning is logged and fetch proceeds as if cache_config_dir would be False
+
+    If shallow is True, only given branch is cloned, without history and with file
+    contents fetched only for checked out revision (partial clone). When accepted_tag_pattern
+    is given too, history is deepened until describing with it gives the same version
+    as full clone would. Shallow clones are never stored in repository cache.
+
+    If mirror_directory is given (or set in CITOOLS_MIRROR_DIRECTORY environment variable),
+    bare mirror of repository kept there is updated by incremental fetch and repository
+    is cloned from it locally; repository cache is not used then and shallow is ignored,
+    as local clones are cheap.
     """
     write_repository_cache = False
+    mirror_directory = get_mirror_directory(mirror_directory)
+
+    if mirror_directory:
+        cache_config_dir = False
+        shallow = False
 
     if cache_config_dir is not False:
         if not cache_config_dir:
@@ -46,40 +306,79 @@ def fetch_repository(repository, workdir=None, branch=None, cache_config_dir=Non
     # so I'll make this create/remove workaround - patch welcomed ,)
     dir = os.path.abspath(os.path.join(mkdtemp(dir=workdir), "repository"))
 
-    clone = ["git", "clone", repository, dir]
+    env = get_clean_git_environment()
 
-    if reference_repository and os.path.exists(reference_repository):
-        clone.extend(["--reference", reference_repository])
+    if mirror_directory:
+        clone_from_mirror(repository, update_mirror(repository, mirror_directory, env=env), dir, env=env)
+        clone = None
+    elif shallow:
+        clone = ["git", "clone", "--depth", str(SHALLOW_CLONE_DEPTH), "--single-branch", "--filter=blob:none"]
+        if branch:
+            clone.extend(["--branch", branch])
+        clone.extend([get_clone_url(repository), dir])
+    else:
+        clone = ["git", "clone", repository, dir]
 
-    check_call(clone, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    if clone:
+        if reference_repository and os.path.exists(reference_repository):
+            clone.extend(["--reference", reference_repository])
 
-    if branch and branch != "master":
-        check_call(["git", "checkout", "-b", branch, "origin/%s" % branch], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        check_call(clone, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
 
-    if write_repository_cache:
-        if not parser.has_section(repository):
-            parser.add_section(repository)
-        parser.set(repository, "cache_dir", dir)
-        f = open(cache_file_path, "w")
-        parser.write(f)
-        f.close()
+    if shallow:
+        if accepted_tag_pattern:
+            deepen_repository(dir, get_clone_url(repository), accepted_tag_pattern, env=env)
+
+    elif branch and branch != "master":
+        check_call(["git", "checkout", "-b", branch, "origin/%s" % branch], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE, env=env)
+
+    if write_repository_cache and not shallow:
+        _repository_cache_lock.acquire()
+        try:
+            # re-read, other thread may have written it meanwhile
+            parser = SafeConfigParser()
+            parser.read([cache_file_path])
+            if not parser.has_section(repository):
+                parser.add_section(repository)
+            parser.set(repository, "cache_dir", dir)
+            f = open(cache_file_path, "w")
+            parser.write(f)
+            f.close()
+        finally:
+            _repository_cache_lock.release()
 
     return dir
 
 
 
+def get_high_water_marks(collection):
+    """
+    Return collection of per-repository high-water marks: documents with repository_uri as _id,
+    last ingested changeset hash and last assigned ingestion sequence
+    """
+    return collection[HIGH_WATER_MARKS_COLLECTION]
+
 def get_last_revision(collection, repository_uri=None):
     if not repository_uri:
         repository_uri = get_repository_uri()
 
     assert repository_uri
 
+    mark = get_high_water_marks(collection).find_one({"_id" : repository_uri})
+    if mark and mark.get('hash'):
+        return mark['hash']
+
     from pymongo import DESCENDING
-    result = collection.find({"repository_uri" : repository_uri}).sort([("$natural", DESCENDING),]).limit(1)
-    if result.count() == 0:
+
+    # stored without high-water mark; use sequence index, or insertion order for really old data
+    result = list(collection.find({"repository_uri" : repository_uri, "sequence" : {"$exists" : True}}).sort([("sequence", DESCENDING),]).limit(1))
+    if not result:
+        result = list(collection.find({"repository_uri" : repository_uri}).sort([("$natural", DESCENDING),]).limit(1))
+
+    if not result:
         return None
     else:
-        return list(result)[0]['hash']
+        return result[0]['hash']
 
 def get_revision_metadata_property(changeset, property, filter=None, encoding="utf-8"):
     default_filter = lambda x: x.decode(encoding)
@@ -96,110 +395,452 @@ def get_revision_metadata_property(changeset, property, filter=None, encoding="u
 
     return filter(stdout.strip())
 
+class FixedOffset(tzinfo):
+    """ Timezone with fixed offset from UTC, as git stores it with every date """
+
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+        sign = minutes < 0 and '-' or '+'
+        self.name = "%s%02d%02d" % (sign, abs(minutes) // 60, abs(minutes) % 60)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return ZERO_TIMEDELTA
+
+    def tzname(self, dt):
+        return self.name
+
+    def __repr__(self):
+        return "<FixedOffset %s>" % self.name
+
+_fixed_offsets = {}
+
+def get_fixed_offset(offset):
+    """ Return (shared) FixedOffset for git's "+HHMM" offset string """
+    if offset not in _fixed_offsets:
+        if len(offset) != 5 or offset[0] not in '+-' or not offset[1:].isdigit():
+            raise ValueError("Timezone offset '%s' is not in +HHMM format" % offset)
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        if offset[0] == '-':
+            minutes = -minutes
+        _fixed_offsets[offset] = FixedOffset(minutes)
+    return _fixed_offsets[offset]
+
+def parse_git_date(value):
+    """
+    Construct timezone-aware datetime from date in git's ISO-like format
+    (%ai / %ci, i.e. "2009-12-01 20:58:01 +0100"), without regexps, strptime or locale
+    """
+    parts = value.split(" ")
+    if len(parts) != 3 or len(parts[0]) != 10 or len(parts[1]) != 8:
+        raise ValueError("Date '%s' is not matching our format, please report bug" % str(value))
+    date, time, offset = parts
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+        int(time[0:2]), int(time[3:5]), int(time[6:8]), tzinfo=get_fixed_offset(offset))
+
+def parse_git_local_date(value):
+    """
+    Construct naive datetime in local time from date in format read by parse_git_date,
+    the same as git show --date=local printed (and filter_parse_date read) before.
+    Metadata are stored this way, so dates stored before and after are comparable.
+    """
+    return datetime.fromtimestamp(calendar.timegm(parse_git_date(value).utctimetuple()))
+
 def filter_parse_date(stdout, used_locale=None):
-    """ Construct a datetime object from local date string returned by git show """
+    """
+    Construct a datetime object from local date string returned by git show (--date=local).
+    Kept for compatibility; metadata are now retrieved in format read by parse_git_date.
+
+    git always prints english names of days and months, so they're parsed by table
+    instead of by strptime in given locale (used_locale is ignored now).
+    """
     # originally, we just passed this to strptime, but it turned out it's not exactly
     # working for some cases, such as single-digit days
     
-    setlocale(LC_ALL, used_locale or USED_GIT_PARSING_LOCALE)
-    
     # use regexp to sniff what we want, skipping things like TZ info
-    match = re.match(r"^(?P<dow>\w+)\ {1}(?P<month>\w+)\ {1}(?P<day>\d{1,2})\ {1}(?P<hour>\d{1,2})\:{1}(?P<minute>\d{1,2})\:{1}(?P<second>\d{1,2})\ {1}(?P<year>\d+).*$", stdout, re.UNICODE)
+    match = GIT_LOCAL_DATE_PATTERN.match(stdout)
     if not match:
         raise ValueError("Date '%s' is not matching our format, please report bug" % str(stdout))
     data = match.groupdict()
-    # to be able to provide zero-padded values, non-string values must be integers 
-    data.update(dict([(key, int(value)) for key, value in data.items() if key not in ["dow", "month"]]))
-    date = datetime.strptime("%(dow)s %(month)s %(day)02d %(hour)02d:%(minute)02d:%(second)02d %(year)04d" % data,
-        "%a %b %d %H:%M:%S %Y"
-    )
-    resetlocale()
-    return date
+    if data['month'] not in MONTHS:
+        raise ValueError("Date '%s' is not matching our format, please report bug" % str(stdout))
+
+    return datetime(int(data['year']), MONTHS[data['month']], int(data['day']),
+        int(data['hour']), int(data['minute']), int(data['second']))
     
-def get_repository_uri():
+def get_repository_uri(repository_directory=None):
     cmd = ["git", "config", "remote.origin.url"]
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    if repository_directory:
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=repository_directory, env=get_clean_git_environment())
+    else:
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
     stdout, stderr = proc.communicate()
     return stdout.strip()
 
-def get_revision_metadata(changeset, metadata_property_map=None, repository_uri=None, encoding="utf-8"):
-    """
-    Return dictionary of metadatas defined in metadata_property_map.
-
-    Uses slow solution (git log query per property) to avoid "delimiter inside result" problem.
-    """
-    
-    # it looks like git is displaying time in en_US locale even if, i.e. cs_CZ
-    # is set, which is bad when using with %a or %b...so hack it
-    
-    setlocale(LC_ALL, USED_GIT_PARSING_LOCALE)
-
-    metadata = {
-        "repository_uri" : repository_uri or get_repository_uri()
-    }
-
-    metadata_property_map = metadata_property_map or {
+def get_default_metadata_property_map():
+    return {
         "%h" : {'name' : "hash_abbrev"},
         "%H" : {'name' : "hash"},
         "%aN" : {'name' : "author_name"},
         "%ae" : {'name' : "author_email"},
-        "%ad" : {'name' : "author_date", 'filter' : filter_parse_date},
+        "%ai" : {'name' : "author_date", 'filter' : parse_git_local_date},
         "%cN" : {'name' : "commiter_name"},
         "%ce" : {'name' : "commiter_email"},
-        "%cd" : {'name' : "commiter_date", 'filter' : filter_parse_date},
+        "%ci" : {'name' : "commiter_date", 'filter' : parse_git_local_date},
         "%s" : {'name' : "subject"},
-
     }
 
-    for property in metadata_property_map:
-        if 'filter' in metadata_property_map[property]:
-            filter = metadata_property_map[property]['filter']
-        else:
-            filter = None
-        try:
-            metadata[metadata_property_map[property]['name']] = get_revision_metadata_property(changeset, property, filter)
-        except (CalledProcessError, ValueError):
-            metadata[metadata_property_map[property]['name']] = "[failed to retrieve]"
-            log.error("Error when parsing metadata: %s" % traceback.format_exc())
+def read_nul_separated(stream, chunk_size=65536):
+    """ Generator yielding NUL separated fields read from stream, without loading it whole """
+    remainder = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        fields = (remainder + chunk).split('\0')
+        remainder = fields.pop()
+        for field in fields:
+            yield field
+    if remainder:
+        yield remainder
+
+def iter_revision_metadata(revisions, metadata_property_map=None, repository_uri=None, encoding="utf-8", repository_directory=None):
+    """
+    Generator yielding dictionaries of metadatas defined in metadata_property_map
+    (as get_revision_metadata does) for every commit git log selects by revisions arguments,
+    oldest first. Commits always come after all their ancestors, so when consumer stops,
+    it may continue later with "last-consumed-commit.." revisions without missing anything.
+
+    All commits are read from single git log, with properties and commits NUL-separated
+    (neither of them can contain NUL), and parsed as they come.
+
+    If repository_directory is given, git is run inside it, ignoring GIT_DIR.
+    """
+    metadata_property_map = metadata_property_map or get_default_metadata_property_map()
+    repository_uri = repository_uri or get_repository_uri(repository_directory)
 
-    resetlocale()
+    properties = metadata_property_map.keys()
+
+    if repository_directory:
+        env = get_clean_git_environment()
+    else:
+        env = dict(os.environ)
+    env['LC_ALL'] = USED_GIT_PARSING_LOCALE
+
+    command = ["git", "log", "-z", "--reverse", "--topo-order", "--date=local", "--pretty=format:%s" % "%x00".join(properties)] + list(revisions)
+    proc = Popen(command, stdout=PIPE, stderr=PIPE, env=env, cwd=repository_directory)
+
+    try:
+        record = []
+        for field in read_nul_separated(proc.stdout):
+            record.append(field)
+            if len(record) == len(properties):
+                metadata = {
+                    "repository_uri" : repository_uri
+                }
+
+                for property, value in zip(properties, record):
+                    filter = metadata_property_map[property].get('filter') or (lambda x: x.decode(encoding))
+                    try:
+                        metadata[metadata_property_map[property]['name']] = filter(value.strip())
+                    except ValueError:
+                        metadata[metadata_property_map[property]['name']] = "[failed to retrieve]"
+                        log.error("Error when parsing metadata: %s" % traceback.format_exc())
+
+                record = []
+                yield metadata
+
+        stderr = proc.stderr.read()
+    finally:
+        # consumer may stop reading before we're at the end
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        log.error("Cannot retrieve log: stderr: %s" % stderr)
+        raise CalledProcessError(proc.returncode, command)
+
+def get_revision_metadata(changeset, metadata_property_map=None, repository_uri=None, encoding="utf-8"):
+    """
+    Return dictionary of metadatas defined in metadata_property_map.
+    """
+    metadata_property_map = metadata_property_map or get_default_metadata_property_map()
+    repository_uri = repository_uri or get_repository_uri()
+
+    try:
+        for metadata in iter_revision_metadata(["-1", changeset], metadata_property_map, repository_uri=repository_uri, encoding=encoding):
+            return metadata
+    except CalledProcessError:
+        log.error("Error when parsing metadata: %s" % traceback.format_exc())
+
+    metadata = {
+        "repository_uri" : repository_uri
+    }
+    for property in metadata_property_map:
+        metadata[metadata_property_map[property]['name']] = "[failed to retrieve]"
     return metadata
 
+def iter_repository_metadata(changeset, repository_uri=None, encoding="utf-8", metadata_property_map=None, repository_directory=None, head=None):
+    """
+    Generator yielding dictionaries with metadata about changesets since revision to current
+    (or to given head), oldest first
+    """
+    head = head or "HEAD"
+    if changeset:
+        revisions = ["%s..%s" % (changeset, head)]
+    else:
+        revisions = [head]
+    return iter_revision_metadata(revisions, metadata_property_map, repository_uri=repository_uri, encoding=encoding, repository_directory=repository_directory)
 
 def retrieve_repository_metadata(changeset, repository_uri=None, encoding="utf-8"):
     """
     Return list of dictionaris with metadata about changesets since revision to current
     """
-    command = ["git", "log", r'--pretty=format:%H']
-    if changeset:
-        command.append("%s.." % changeset)
-    proc = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
+    return list(iter_repository_metadata(changeset, repository_uri=repository_uri, encoding=encoding))
+
+def ensure_repository_metadata_indexes(collection):
+    """ Create unique index on (repository_uri, hash) and index on (repository_uri, sequence) if missing """
+    from pymongo import ASCENDING
+    from pymongo.errors import OperationFailure
+    try:
+        collection.ensure_index([("repository_uri", ASCENDING), ("hash", ASCENDING)], unique=True)
+    except OperationFailure:
+        # i.e. duplicates stored by older versions; storing works without index, only slower
+        log.warning("Cannot create unique index on repository metadata: %s" % traceback.format_exc())
+
+    collection.ensure_index([("repository_uri", ASCENDING), ("sequence", ASCENDING)])
+
+def iter_batches(iterable, batch_size):
+    """ Generator yielding lists of at most batch_size items from iterable """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def get_metadata_key(item):
+    return (item.get('repository_uri'), item['hash'])
+
+def _store_one_by_one(collection, items):
+    """ Slow path: merge every item into it's stored version separately """
+    for item in items:
+        query = {'hash' : item['hash'], 'repository_uri' : item.get('repository_uri')}
+        older_version = collection.find_one(query)
+        if older_version and older_version['_id'] != item.get('_id'):
+            item = dict([(k, v) for k, v in item.items() if k not in ('_id', 'sequence')])
+            older_version.update(item)
+            item = older_version
+        collection.save(item)
 
-    if not proc.returncode == 0:
-        log.error("Cannot retrieve log: stdout: %s stderr: %s" % (stdout, stderr))
-        raise CalledProcessError(proc.returncode, command)
+def reserve_sequences(collection, repository_uri, count):
+    """
+    Atomically reserve count ingestion sequence numbers for repository and
+    return first of them
+    """
+    mark = get_high_water_marks(collection).find_and_modify(
+        {"_id" : repository_uri},
+        {"$inc" : {"sequence" : count}},
+        upsert=True,
+        new=True
+    )
+    return mark['sequence'] - count + 1
 
-    metadata = []
-    hashes = stdout.splitlines()
-    hashes.reverse()
-    for hash in hashes:
-        metadata.append(get_revision_metadata(hash, repository_uri=repository_uri, encoding=encoding))
+def update_high_water_mark(collection, repository_uri, hash, sequence):
+    """ Point high-water mark of repository to changeset, unless newer one is already marked """
+    get_high_water_marks(collection).update(
+        {"_id" : repository_uri, "$or" : [{"hash_sequence" : {"$exists" : False}}, {"hash_sequence" : {"$lt" : sequence}}]},
+        {"$set" : {"hash" : hash, "hash_sequence" : sequence}}
+    )
 
-    return metadata
+def store_repository_metadata_batch(collection, batch):
+    """
+    Store list of changeset metadata (oldest first), updating already stored changesets
+    (identified by repository_uri and hash).
+    Stored versions are looked up by single $in query and new changesets
+    are inserted at once, numbered by ingestion sequence of their repository.
+    Then high-water mark of repository is moved to the last of them.
+    """
+    from pymongo.errors import DuplicateKeyError
 
-def store_repository_metadata(collection, data):
-    for item in data:
+    for item in batch:
         if 'hash' not in item:
             raise ValueError("Trying to store metadata for changeset without hash! %s" % str(item))
-        
-        if '_id' not in item:
-            older_version = collection.find_one({'hash' : item['hash']})
-            if older_version:
-                older_version.update(item)
-                item = older_version
 
-        collection.save(item)
+    older_versions = {}
+    hashes = [item['hash'] for item in batch if '_id' not in item]
+    if hashes:
+        for older_version in collection.find({'hash' : {'$in' : hashes}}):
+            older_versions[get_metadata_key(older_version)] = older_version
+
+    new_items = {}
+    new_keys = []
+    for item in batch:
+        key = get_metadata_key(item)
+        if '_id' in item:
+            collection.save(item)
+        elif key in older_versions:
+            older_versions[key].update(item)
+            collection.save(older_versions[key])
+        elif key in new_items:
+            # same changeset twice in one batch
+            new_items[key].update(item)
+        else:
+            new_items[key] = item
+            new_keys.append(key)
+
+    if new_keys:
+        new_batch = [new_items[key] for key in new_keys]
+
+        repositories = {}
+        for item in new_batch:
+            repositories.setdefault(item.get('repository_uri'), []).append(item)
+
+        for repository_uri, items in repositories.items():
+            sequence = reserve_sequences(collection, repository_uri, len(items))
+            for item in items:
+                item['sequence'] = sequence
+                sequence += 1
+
+        try:
+            collection.insert(new_batch)
+        except DuplicateKeyError:
+            # somebody else stored some of them meanwhile
+            _store_one_by_one(collection, new_batch)
+
+        for repository_uri, items in repositories.items():
+            update_high_water_mark(collection, repository_uri, items[-1]['hash'], items[-1]['sequence'])
+
+def store_repository_metadata(collection, data, batch_size=DEFAULT_METADATA_BATCH_SIZE, create_indexes=True, checkpoint=None):
+    """
+    Store changeset metadata from data (any iterable, i.e. generator from
+    iter_repository_metadata), batch_size changesets at once.
+
+    Every stored batch moves high-water mark of it's repository, so when storing is
+    interrupted, get_last_revision returns last changeset of last stored batch.
+    If checkpoint is given, it's called with every stored batch.
+    Return number of stored changesets.
+    """
+    if create_indexes:
+        ensure_repository_metadata_indexes(collection)
+
+    stored = 0
+    for batch in iter_batches(data, int(batch_size or DEFAULT_METADATA_BATCH_SIZE)):
+        store_repository_metadata_batch(collection, batch)
+        stored += len(batch)
+        if checkpoint:
+            checkpoint(batch)
+
+    return stored
+
+def read_repositories_config(filename, mirror_directory=None):
+    """
+    Return list of repositories to ingest, read from ini file with section per repository:
+
+        [ella]
+        url = git://github.com/ella/ella.git
+        uri = git://github.com/ella/ella.git
+        branch = master
+
+    Repository is read either from local "path", or from "url" through bare mirror
+    in mirror_directory. "uri" identifies repository in database (url or path by default),
+    "branch" is ingested head (HEAD by default).
+    """
+    parser = SafeConfigParser()
+    if not parser.read([filename]):
+        raise ValueError("Cannot read repositories config %s" % filename)
+
+    repositories = []
+    for section in parser.sections():
+        options = dict(parser.items(section))
+        if not options.get('path') and not options.get('url'):
+            raise ValueError("Repository %s in %s has neither path nor url" % (section, filename))
+        if options.get('url') and not get_mirror_directory(mirror_directory):
+            raise ValueError("Repository %s in %s is given by url, but no mirror directory is set" % (section, filename))
+
+        repositories.append({
+            'name' : section,
+            'path' : options.get('path'),
+            'url' : options.get('url'),
+            'uri' : options.get('uri') or options.get('url') or options.get('path'),
+            'branch' : options.get('branch'),
+        })
+    return repositories
+
+def ingest_repository(collection, repository, batch_size=DEFAULT_METADATA_BATCH_SIZE, mirror_directory=None):
+    """
+    Store metadata of all changesets not yet stored for repository
+    (dictionary as returned by read_repositories_config).
+
+    Return report dictionary with number of stored changesets, seconds spent,
+    throughput (changesets per second) and lag (age of oldest changeset that
+    was not stored before, as timedelta; None if database was up to date).
+    """
+    start = time.time()
+
+    if repository.get('url'):
+        directory = update_mirror(repository['url'], get_mirror_directory(mirror_directory))
+    else:
+        directory = repository['path']
+
+    changeset = get_last_revision(collection, repository_uri=repository['uri'])
+
+    report = {
+        'name' : repository.get('name', repository['uri']),
+        'repository_uri' : repository['uri'],
+        'lag' : None,
+    }
+
+    def measure_lag(data):
+        for metadata in data:
+            if report['lag'] is None and isinstance(metadata.get('commiter_date'), datetime):
+                report['lag'] = datetime.now() - metadata['commiter_date']
+            yield metadata
+
+    data = iter_repository_metadata(changeset, repository_uri=repository['uri'], repository_directory=directory, head=repository.get('branch'))
+    report['changesets'] = store_repository_metadata(collection, measure_lag(data), batch_size=batch_size, create_indexes=False)
+
+    report['seconds'] = time.time() - start
+    report['throughput'] = report['changesets'] / max(report['seconds'], 0.001)
+
+    return report
+
+def ingest_repositories(collection, repositories, workers=None, batch_size=DEFAULT_METADATA_BATCH_SIZE, mirror_directory=None):
+    """
+    Ingest all repositories concurrently by at most workers threads, sharing collection
+    (and thus single pooled mongo connection). Return list of reports (see ingest_repository)
+    in order of repositories; failure of one repository does not stop others, it's report
+    contains 'error' instead.
+    """
+    ensure_repository_metadata_indexes(collection)
+
+    def ingest(repository):
+        try:
+            return ingest_repository(collection, repository, batch_size=batch_size, mirror_directory=mirror_directory)
+        except Exception, e:
+            log.error("Cannot ingest repository %s: %s" % (repository['uri'], traceback.format_exc()))
+            return {
+                'name' : repository.get('name', repository['uri']),
+                'repository_uri' : repository['uri'],
+                'error' : str(e) or e.__class__.__name__,
+            }
+
+    return map_in_pool(ingest, repositories, workers=workers, pool_type="thread")
+
+def format_ingestion_report(report):
+    if 'error' in report:
+        return "%s: failed (%s)" % (report['name'], report['error'])
+
+    if report['lag'] is None:
+        lag = "up to date"
+    else:
+        lag = "lag %ss" % (report['lag'].days * 86400 + report['lag'].seconds)
+
+    return "%s: %s changesets in %.2fs (%.1f/s), %s" % (report['name'], report['changesets'], report['seconds'], report['throughput'], lag)
 
 class SaveRepositoryInformationGit(Command):
     """ Store repository metadata information in mongo database for cthulhubot usage """
@@ -214,6 +855,10 @@ class SaveRepositoryInformationGit(Command):
         ("mongodb-database=", None, "mongo database name"),
         ("mongodb-collection=", None, "mongo collection to store data to"),
         ("repository-uri=", None, "repository URL for identification"),
+        ("batch-size=", None, "number of changesets stored at once"),
+        ("repositories-config=", None, "ini file with repositories to store, instead of current one"),
+        ("workers=", None, "number of repositories from repositories-config stored concurrently"),
+        ("mirror-directory=", None, "directory with bare mirrors of repositories given by url"),
     ]
 
     def initialize_options(self):
@@ -224,6 +869,10 @@ class SaveRepositoryInformationGit(Command):
         self.mongodb_database = None
         self.mongodb_collection = None
         self.repository_uri = None
+        self.batch_size = None
+        self.repositories_config = None
+        self.workers = None
+        self.mirror_directory = None
 
     def finalize_options(self):
         self.mongodb_host = self.mongodb_host or "localhost"
@@ -231,6 +880,10 @@ class SaveRepositoryInformationGit(Command):
         self.mongodb_username = self.mongodb_username or None
         self.mongodb_password = self.mongodb_password or None
         self.repository_uri = self.repository_uri or None
+        self.batch_size = int(self.batch_size or DEFAULT_METADATA_BATCH_SIZE)
+        self.repositories_config = self.repositories_config or None
+        self.workers = self.workers and int(self.workers) or None
+        self.mirror_directory = self.mirror_directory or None
 
         if not self.mongodb_database:
             raise DistutilsOptionError("Mongodb database not given")
@@ -248,8 +901,24 @@ class SaveRepositoryInformationGit(Command):
             username=self.mongodb_username,
             password=self.mongodb_password
         )[self.mongodb_collection]
+
+        if self.repositories_config:
+            repositories = read_repositories_config(self.repositories_config, mirror_directory=self.mirror_directory)
+            reports = ingest_repositories(collection, repositories, workers=self.workers, batch_size=self.batch_size, mirror_directory=self.mirror_directory)
+            for report in reports:
+                print format_ingestion_report(report)
+            if [report for report in reports if 'error' in report]:
+                raise ValueError("Storing information failed for some repositories")
+            return
         
+        # resume after last stored batch; changesets are streamed from git
+        # and stored in batches, so memory use does not depend on history size
         changeset = get_last_revision(collection, repository_uri=self.repository_uri)
-        data = retrieve_repository_metadata(changeset, repository_uri=self.repository_uri)
-        store_repository_metadata(collection, data)
+        data = iter_repository_metadata(changeset, repository_uri=self.repository_uri)
+
+        def checkpoint(batch):
+            log.info("Stored %s changesets up to %s" % (len(batch), batch[-1]['hash']))
+
+        stored = store_repository_metadata(collection, data, batch_size=self.batch_size, checkpoint=checkpoint)
+        log.info("Stored %s changesets since %s" % (stored, changeset))
 
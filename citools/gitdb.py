@@ -0,0 +1,623 @@
+"""
+Read-only access to git repository straight from .git directory,
+without spawning git processes: refs, packed-refs, loose and packed objects
+and commit parsing.
+
+Everything here is best-effort: ref functions return None and Repository raises
+ObjectDatabaseError whenever they meet something they do not understand,
+and callers are expected to fall back to git command line then.
+Set CITOOLS_NO_GITDB environment variable to always use git command line.
+"""
+
+from binascii import hexlify, unhexlify
+import mmap
+import os
+import struct
+import zlib
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+MAX_SYMREF_DEPTH = 5
+
+OBJECT_TYPES = {
+    1 : 'commit',
+    2 : 'tree',
+    3 : 'blob',
+    4 : 'tag',
+}
+
+OFS_DELTA = 6
+REF_DELTA = 7
+
+MAX_DELTA_CHAIN = 512
+DELTA_BASE_CACHE_SIZE = 256
+
+
+class ObjectDatabaseError(ValueError):
+    """ Repository or object cannot be read by us; use git command line instead """
+
+
+def get_git_dir(repository_directory=None):
+    """
+    Return absolute path to git directory: $GIT_DIR if set, otherwise
+    .git found in repository_directory (or current directory) or any of it's parents.
+    Return None if no git directory is found.
+    """
+    if os.environ.get('GIT_DIR'):
+        return os.path.abspath(os.environ['GIT_DIR'])
+
+    directory = os.path.abspath(repository_directory or os.curdir)
+    while True:
+        candidate = os.path.join(directory, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        elif os.path.isfile(candidate):
+            # worktrees and submodules use "gitdir: <path>" file
+            f = open(candidate)
+            content = f.read().strip()
+            f.close()
+            if content.startswith('gitdir: '):
+                return os.path.normpath(os.path.join(directory, content[len('gitdir: '):]))
+            return None
+
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def get_common_dir(git_dir):
+    """ Return directory with shared refs and objects (differs from git_dir for worktrees) """
+    commondir_file = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_file):
+        f = open(commondir_file)
+        commondir = f.read().strip()
+        f.close()
+        return os.path.normpath(os.path.join(git_dir, commondir))
+    return git_dir
+
+def _read_file(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def read_packed_refs(git_dir):
+    """ Return dictionary {ref name : hash} from packed-refs file """
+    refs = {}
+    content = _read_file(os.path.join(get_common_dir(git_dir), 'packed-refs'))
+    if content:
+        for line in content.splitlines():
+            if not line or line[0] in '#^':
+                continue
+            parts = line.split(' ', 1)
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+    return refs
+
+def read_ref(git_dir, name, packed_refs=None):
+    """
+    Return content of given ref (hash or "ref: <name>" for symbolic ones),
+    looking into loose refs first and into packed-refs then.
+    """
+    # HEAD and other pseudorefs live in worktree-specific directory
+    if name.startswith('refs/'):
+        directory = get_common_dir(git_dir)
+    else:
+        directory = git_dir
+
+    content = _read_file(os.path.join(directory, *name.split('/')))
+    if content is not None:
+        return content.strip()
+
+    if packed_refs is None:
+        packed_refs = read_packed_refs(git_dir)
+    return packed_refs.get(name, None)
+
+def resolve_ref(git_dir, name="HEAD"):
+    """ Return hash given ref points to, following symbolic refs. None if not resolvable """
+    packed_refs = None
+    for i in xrange(0, MAX_SYMREF_DEPTH):
+        content = read_ref(git_dir, name, packed_refs)
+        if not content:
+            return None
+        if content.startswith('ref: '):
+            name = content[len('ref: '):].strip()
+            if packed_refs is None:
+                packed_refs = read_packed_refs(git_dir)
+        elif len(content) == 40:
+            return content
+        else:
+            return None
+    return None
+
+def get_refs_fingerprint(git_dir, prefix='refs/tags'):
+    """
+    Return string changing whenever any ref under prefix is added, removed or updated
+    (both as loose ref and in packed-refs).
+    """
+    common_dir = get_common_dir(git_dir)
+    fingerprint = md5()
+
+    packed = _read_file(os.path.join(common_dir, 'packed-refs')) or ''
+    for line in packed.splitlines():
+        # peeled lines belong to ref above them
+        if line.startswith('^') or line[41:].startswith(prefix + '/'):
+            fingerprint.update(line + '\n')
+
+    loose = []
+    for path, dirs, files in os.walk(os.path.join(common_dir, *prefix.split('/'))):
+        for name in files:
+            loose.append(os.path.join(path, name))
+    loose.sort()
+
+    for path in loose:
+        fingerprint.update('%s %s\n' % (path[len(common_dir):], (_read_file(path) or '').strip()))
+
+    return fingerprint.hexdigest()
+
+def read_refs(git_dir, prefix='refs/tags'):
+    """ Return dictionary {ref name : content} of all refs under prefix, loose ones taking precedence """
+    refs = {}
+    for name, value in read_packed_refs(git_dir).items():
+        if name.startswith(prefix + '/'):
+            refs[name] = value
+
+    common_dir = get_common_dir(git_dir)
+    for path, dirs, files in os.walk(os.path.join(common_dir, *prefix.split('/'))):
+        for name in files:
+            content = _read_file(os.path.join(path, name))
+            if content:
+                ref_name = '/'.join(os.path.join(path, name)[len(common_dir)+1:].split(os.sep))
+                refs[ref_name] = content.strip()
+    return refs
+
+def is_enabled():
+    """ Return False if reading repository by ourselves is disabled by CITOOLS_NO_GITDB """
+    return not os.environ.get('CITOOLS_NO_GITDB')
+
+def get_head_hash(repository_directory=None):
+    """ Return hash of HEAD commit for $GIT_DIR or given directory, or None if we cannot tell """
+    if not is_enabled():
+        return None
+    git_dir = get_git_dir(repository_directory)
+    if not git_dir:
+        return None
+    return resolve_ref(git_dir, "HEAD")
+
+def get_current_branch_name(git_dir):
+    """
+    Return name of branch HEAD points to, or None if it cannot be determined (or HEAD
+    is detached or branch has no commits yet) without git.
+    """
+    if not is_enabled():
+        return None
+    head = read_ref(git_dir, "HEAD")
+    if not head or not head.startswith('ref: refs/heads/'):
+        return None
+    if not resolve_ref(git_dir, "HEAD"):
+        return None
+    return head[len('ref: refs/heads/'):].strip()
+
+
+def parse_signature(line):
+    """ Parse "Name <email> timestamp timezone" into (name, email, timestamp, timezone) """
+    try:
+        identity, timestamp, timezone = line.rsplit(' ', 2)
+        name, email = identity.split(' <', 1)
+        return (name, email.rstrip('>'), int(timestamp), timezone)
+    except ValueError:
+        raise ObjectDatabaseError("Cannot parse signature %r" % line)
+
+def parse_headers(data):
+    """
+    Parse commit or tag object into (list of (header, value), message).
+    Continuation lines (i.e. in gpgsig) are folded into value of preceding header.
+    """
+    if '\n\n' in data:
+        header_data, message = data.split('\n\n', 1)
+    else:
+        header_data, message = data, ''
+
+    headers = []
+    for line in header_data.split('\n'):
+        if line.startswith(' ') and headers:
+            headers[-1] = (headers[-1][0], headers[-1][1] + '\n' + line[1:])
+        elif ' ' in line:
+            headers.append(tuple(line.split(' ', 1)))
+        elif line:
+            headers.append((line, ''))
+    return (headers, message)
+
+def parse_commit(data):
+    """ Return dictionary with tree, parents, author, committer (as parse_signature tuples) and message """
+    headers, message = parse_headers(data)
+    commit = {
+        'tree' : None,
+        'parents' : [],
+        'author' : None,
+        'committer' : None,
+        'encoding' : None,
+        'message' : message,
+    }
+    for key, value in headers:
+        if key == 'parent':
+            commit['parents'].append(value)
+        elif key in ('author', 'committer'):
+            commit[key] = parse_signature(value)
+        elif key in ('tree', 'encoding'):
+            commit[key] = value
+    return commit
+
+def parse_tag(data):
+    """ Return dictionary with object, type, tag and message of annotated tag """
+    headers, message = parse_headers(data)
+    tag = {'message' : message}
+    for key, value in headers:
+        if key in ('object', 'type', 'tag'):
+            tag[key] = value
+    return tag
+
+
+def _read_varint_size(data, position):
+    """ Read size as encoded in delta header, return (size, new position) """
+    size = 0
+    shift = 0
+    while True:
+        byte = ord(data[position])
+        position += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (size, position)
+
+def apply_delta(base, delta):
+    """ Reconstruct object from it's base and git delta data """
+    base_size, position = _read_varint_size(delta, 0)
+    result_size, position = _read_varint_size(delta, position)
+
+    if base_size != len(base):
+        raise ObjectDatabaseError("Delta base size mismatch")
+
+    out = []
+    delta_size = len(delta)
+    while position < delta_size:
+        opcode = ord(delta[position])
+        position += 1
+        if opcode & 0x80:
+            offset = size = 0
+            for i in xrange(0, 4):
+                if opcode & (1 << i):
+                    offset |= ord(delta[position]) << (8 * i)
+                    position += 1
+            for i in xrange(0, 3):
+                if opcode & (1 << (4 + i)):
+                    size |= ord(delta[position]) << (8 * i)
+                    position += 1
+            if size == 0:
+                size = 0x10000
+            out.append(base[offset:offset+size])
+        elif opcode:
+            out.append(delta[position:position+opcode])
+            position += opcode
+        else:
+            raise ObjectDatabaseError("Invalid delta opcode")
+
+    result = ''.join(out)
+    if len(result) != result_size:
+        raise ObjectDatabaseError("Delta result size mismatch")
+    return result
+
+
+def _map_file(path):
+    f = open(path, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+class PackIndex(object):
+    """ Memory-mapped pack .idx file (both version 1 and 2) """
+
+    def __init__(self, path):
+        self.path = path
+        self.map = _map_file(path)
+
+        if self.map[0:4] == '\377tOc':
+            self.version = struct.unpack('>L', self.map[4:8])[0]
+            if self.version != 2:
+                raise ObjectDatabaseError("Unsupported pack index version %s" % self.version)
+            fanout_start = 8
+        else:
+            self.version = 1
+            fanout_start = 0
+
+        self.fanout = struct.unpack('>256L', self.map[fanout_start:fanout_start+256*4])
+        self.count = self.fanout[255]
+        self.table_start = fanout_start + 256*4
+
+    def _sha(self, i):
+        if self.version == 2:
+            start = self.table_start + i*20
+        else:
+            start = self.table_start + i*24 + 4
+        return self.map[start:start+20]
+
+    def _offset(self, i):
+        if self.version == 1:
+            start = self.table_start + i*24
+            return struct.unpack('>L', self.map[start:start+4])[0]
+
+        offsets_start = self.table_start + self.count*24
+        offset = struct.unpack('>L', self.map[offsets_start+i*4:offsets_start+i*4+4])[0]
+        if offset & 0x80000000:
+            large_start = offsets_start + self.count*4 + (offset & 0x7fffffff)*8
+            offset = struct.unpack('>Q', self.map[large_start:large_start+8])[0]
+        return offset
+
+    def find(self, binsha):
+        """ Return offset of object in pack, or None if object is not present """
+        first = ord(binsha[0])
+        if first == 0:
+            low = 0
+        else:
+            low = self.fanout[first-1]
+        high = self.fanout[first]
+
+        while low < high:
+            middle = (low + high) // 2
+            sha = self._sha(middle)
+            if sha < binsha:
+                low = middle + 1
+            elif sha > binsha:
+                high = middle
+            else:
+                return self._offset(middle)
+        return None
+
+    def close(self):
+        self.map.close()
+
+class Pack(object):
+    """ Memory-mapped .pack file with it's index """
+
+    def __init__(self, path, repository):
+        self.path = path
+        self.repository = repository
+        self.index = PackIndex(path[:-len('.pack')] + '.idx')
+        self.map = _map_file(path)
+        self.base_cache = {}
+
+        if self.map[0:4] != 'PACK':
+            raise ObjectDatabaseError("%s is not a pack file" % path)
+
+    def _read_header(self, offset):
+        byte = ord(self.map[offset])
+        offset += 1
+        type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = ord(self.map[offset])
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return (type, size, offset)
+
+    def _inflate(self, offset, size):
+        decompressor = zlib.decompressobj()
+        out = []
+        length = 0
+        chunk = max(size, 4096)
+        while length < size and offset < len(self.map):
+            data = decompressor.decompress(self.map[offset:offset+chunk])
+            out.append(data)
+            length += len(data)
+            offset += chunk
+            chunk *= 2
+            if decompressor.unused_data:
+                break
+        out.append(decompressor.flush())
+        data = ''.join(out)
+        if len(data) != size:
+            raise ObjectDatabaseError("Object at %s in %s has unexpected size" % (offset, self.path))
+        return data
+
+    def read_at(self, offset, depth=0):
+        """ Return (type name, data) of object stored at given offset, resolving deltas """
+        if offset in self.base_cache:
+            return self.base_cache[offset]
+
+        if depth > MAX_DELTA_CHAIN:
+            raise ObjectDatabaseError("Delta chain too long in %s" % self.path)
+
+        type, size, data_offset = self._read_header(offset)
+
+        if type == OFS_DELTA:
+            byte = ord(self.map[data_offset])
+            data_offset += 1
+            base_distance = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(self.map[data_offset])
+                data_offset += 1
+                base_distance = ((base_distance + 1) << 7) | (byte & 0x7f)
+            base_type, base = self.read_at(offset - base_distance, depth+1)
+            result = (base_type, apply_delta(base, self._inflate(data_offset, size)))
+
+        elif type == REF_DELTA:
+            base_sha = self.map[data_offset:data_offset+20]
+            base_type, base = self.repository.read_object(hexlify(base_sha))
+            result = (base_type, apply_delta(base, self._inflate(data_offset+20, size)))
+
+        elif type in OBJECT_TYPES:
+            result = (OBJECT_TYPES[type], self._inflate(data_offset, size))
+
+        else:
+            raise ObjectDatabaseError("Unknown object type %s in %s" % (type, self.path))
+
+        if len(self.base_cache) >= DELTA_BASE_CACHE_SIZE:
+            self.base_cache.clear()
+        self.base_cache[offset] = result
+
+        return result
+
+    def close(self):
+        self.index.close()
+        self.map.close()
+
+
+class Repository(object):
+    """
+    Read-only view into git repository object database.
+    Use as short-lived object; packs are listed when repository is opened.
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.common_dir = get_common_dir(git_dir)
+
+        config = _read_file(os.path.join(self.common_dir, 'config')) or ''
+        if 'objectformat' in config.lower():
+            raise ObjectDatabaseError("Unsupported object format in %s" % git_dir)
+
+        # history rewriting mechanisms we do not emulate
+        if os.path.exists(os.path.join(self.common_dir, 'info', 'grafts')) or \
+            os.path.exists(os.path.join(self.common_dir, 'refs', 'replace')) or \
+            'refs/replace/' in (_read_file(os.path.join(self.common_dir, 'packed-refs')) or ''):
+            raise ObjectDatabaseError("Repository %s uses grafts or replace refs" % git_dir)
+
+        self.object_dirs = []
+        self._add_object_dir(os.path.join(self.common_dir, 'objects'))
+
+        self.packs = []
+        for object_dir in self.object_dirs:
+            pack_dir = os.path.join(object_dir, 'pack')
+            if os.path.isdir(pack_dir):
+                for name in sorted(os.listdir(pack_dir)):
+                    if name.endswith('.pack') and os.path.exists(os.path.join(pack_dir, name[:-len('.pack')] + '.idx')):
+                        try:
+                            self.packs.append(Pack(os.path.join(pack_dir, name), self))
+                        except (EnvironmentError, ValueError, struct.error, mmap.error), e:
+                            raise ObjectDatabaseError("Cannot open pack %s: %s" % (name, e))
+
+        self.shallow = set()
+        shallow = _read_file(os.path.join(self.common_dir, 'shallow'))
+        if shallow:
+            self.shallow = set(shallow.split())
+
+    def _add_object_dir(self, object_dir, depth=0):
+        if object_dir in self.object_dirs or depth > MAX_SYMREF_DEPTH:
+            return
+        self.object_dirs.append(object_dir)
+        # clones made with --reference borrow objects from other repositories
+        alternates = _read_file(os.path.join(object_dir, 'info', 'alternates'))
+        if alternates:
+            for line in alternates.splitlines():
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    self._add_object_dir(os.path.normpath(os.path.join(object_dir, line)), depth+1)
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+
+    def _read_loose_object(self, sha):
+        for object_dir in self.object_dirs:
+            content = _read_file(os.path.join(object_dir, sha[:2], sha[2:]))
+            if content is not None:
+                data = zlib.decompress(content)
+                header, data = data.split('\0', 1)
+                type, size = header.split(' ', 1)
+                if int(size) != len(data):
+                    raise ObjectDatabaseError("Loose object %s has unexpected size" % sha)
+                return (type, data)
+        return None
+
+    def read_object(self, sha):
+        """ Return tuple (type name, raw data) for object with given hex hash """
+        try:
+            binsha = unhexlify(sha)
+            if len(binsha) != 20:
+                raise ObjectDatabaseError("%s is not an object hash" % sha)
+
+            for pack in self.packs:
+                offset = pack.index.find(binsha)
+                if offset is not None:
+                    return pack.read_at(offset)
+
+            obj = self._read_loose_object(sha)
+        except (EnvironmentError, zlib.error, struct.error, IndexError, TypeError, ValueError), e:
+            if isinstance(e, ObjectDatabaseError):
+                raise
+            raise ObjectDatabaseError("Cannot read object %s: %s" % (sha, e))
+
+        if obj is None:
+            raise ObjectDatabaseError("Object %s not found" % sha)
+        return obj
+
+    def get_commit(self, sha):
+        type, data = self.read_object(sha)
+        if type != 'commit':
+            raise ObjectDatabaseError("%s is %s, not commit" % (sha, type))
+        commit = parse_commit(data)
+        if sha in self.shallow:
+            commit['parents'] = []
+        return commit
+
+    def peel(self, sha):
+        """ Follow annotated tags, return (type name, hash) of first non-tag object """
+        for i in xrange(0, MAX_SYMREF_DEPTH):
+            type, data = self.read_object(sha)
+            if type != 'tag':
+                return (type, sha)
+            sha = parse_tag(data)['object']
+        raise ObjectDatabaseError("Tag chain too long at %s" % sha)
+
+    def resolve(self, name="HEAD"):
+        """ Return hash of commit given ref points to """
+        sha = resolve_ref(self.git_dir, name)
+        if sha is None:
+            raise ObjectDatabaseError("Cannot resolve %s" % name)
+        return sha
+
+    def get_annotated_tags(self):
+        """
+        Return dictionary {tag name : commit hash} of annotated tags pointing to commits,
+        as considered by git describe.
+        """
+        tags = {}
+        for name, sha in read_refs(self.git_dir, 'refs/tags').items():
+            if len(sha) != 40:
+                continue
+            type, data = self.read_object(sha)
+            if type != 'tag':
+                continue
+            peeled_type, peeled_sha = self.peel(sha)
+            if peeled_type == 'commit':
+                tags[name[len('refs/tags/'):]] = peeled_sha
+        return tags
+
+def open_repository(repository_directory=None):
+    """
+    Return Repository for $GIT_DIR or given directory (current by default),
+    or None if git dir cannot be found, cannot be read by us or reader is disabled
+    using CITOOLS_NO_GITDB environment variable.
+    """
+    if not is_enabled():
+        return None
+
+    git_dir = get_git_dir(repository_directory)
+    if not git_dir or not os.path.isdir(git_dir):
+        return None
+
+    try:
+        return Repository(git_dir)
+    except ObjectDatabaseError:
+        return None
@@ -3,7 +3,7 @@ import os
 from os.path import join, exists
 from subprocess import check_call
 
-from citools.build import rename_template_files as _rename_template_files, replace_template_files, get_common_variables
+from citools.build import rename_template_files as _rename_template_files, replace_template_files, get_build_context
 
 from paver.easy import *
 from paver.setuputils import _get_distribution
@@ -219,13 +219,13 @@ def upload_debian_package(options):
 
 @task
 def rename_template_files():
-    _rename_template_files(root_directory=os.curdir, variables=get_common_variables(_get_distribution()))
+    _rename_template_files(root_directory=os.curdir, variables=get_build_context(_get_distribution()))
 
 @task
 def replace_templates():
     replace_template_files(
         root_directory=os.curdir,
-        variables=get_common_variables(_get_distribution()),
+        variables=get_build_context(_get_distribution()),
         subdirs=getattr(options, "template_files_directories", None)
     )
 
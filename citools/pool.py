@@ -0,0 +1,84 @@
+"""
+Small bounded worker pool, used to run independent per-repository steps concurrently.
+"""
+
+import sys
+import threading
+from Queue import Queue, Empty
+
+DEFAULT_WORKERS = 4
+
+POOL_TYPES = ("thread", "process")
+
+
+def _run_in_threads(function, items, workers):
+    tasks = Queue()
+    for i in xrange(0, len(items)):
+        tasks.put(i)
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    def worker():
+        while True:
+            try:
+                i = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = function(items[i])
+            except Exception:
+                errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for i in xrange(0, min(workers, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # re-raise first failure in order of items, as sequential loop would
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    return results
+
+def _run_in_processes(function, items, workers):
+    try:
+        from multiprocessing import Pool
+    except ImportError:
+        raise ValueError("Process pool requires multiprocessing module (python 2.6+)")
+
+    pool = Pool(processes=min(workers, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def map_in_pool(function, items, workers=None, pool_type="thread"):
+    """
+    Return [function(item) for item in items], computed by at most workers
+    concurrent threads or processes (as given by pool_type). Order of results
+    always follows order of items.
+
+    With workers=1, items are processed sequentially in current thread.
+    For process pool, function and items must be picklable.
+    """
+    items = list(items)
+    workers = int(workers or DEFAULT_WORKERS)
+
+    if pool_type not in POOL_TYPES:
+        raise ValueError("Unknown pool type %s, use one of %s" % (pool_type, ", ".join(POOL_TYPES)))
+
+    if workers < 1:
+        raise ValueError("Number of workers must be positive")
+
+    if workers == 1 or len(items) < 2:
+        return [function(item) for item in items]
+
+    if pool_type == "process":
+        return _run_in_processes(function, items, workers)
+    else:
+        return _run_in_threads(function, items, workers)
@@ -1,13 +1,23 @@
 from subprocess import CalledProcessError
+from ConfigParser import RawConfigParser
 from distutils.command.config import config
+import logging
 import re
 import os
+import threading
+import time
 from subprocess import Popen, PIPE, CalledProcessError
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 from unicodedata import normalize, combining
 from urlparse import urlsplit
 
-from citools.git import fetch_repository
+from citools.git import fetch_repository, get_clean_git_environment
+from citools.gitdb import (
+    get_git_dir, resolve_ref, get_refs_fingerprint, md5,
+    get_head_hash, get_current_branch_name, open_repository, ObjectDatabaseError,
+)
+from citools.pool import map_in_pool
+from citools.wildmatch import filter_matching
 
 """
 Help us handle continuous versioning. Idea is simple: We have n-number digits
@@ -17,9 +27,14 @@ n is then computed as number-of-commits since last version-setting tag (and we'r
 using git describe for it now)
 """
 
+log = logging.getLogger("citools.version")
+
 DEFAULT_TAG_VERSION = (0, 0)
 
-REVLIST_TAG_PATTERN = re.compile("^\ \((.*)\)$")
+VERSION_CACHE_FILE_NAME = "citools-version-cache.ini"
+
+# fix_environment changes process-wide GIT_DIR; threads describing repositories must hold this
+git_environment_lock = threading.RLock()
 
 def compute_version(string):
     """ Return VERSION tuple, computed from git describe output """
@@ -84,60 +99,18 @@ def sum_versions(version1, version2):
 
 
 def get_git_last_hash(commit="HEAD"):
-    p = Popen(["git", "rev-parse", commit], stdout=PIPE, stderr=PIPE)
-    stdout = p.communicate()[0]
-    if p.returncode == 0:
-        return stdout.strip()
-    else:
-        return ''
+    if commit == "HEAD":
+        head = get_head_hash()
+        if head:
+            return head
 
-def get_git_revlist_tags(commit="HEAD"):
-    p = Popen(["git", "rev-list", "--simplify-by-decoration", "--pretty=format:%d", commit], stdout=PIPE, stderr=PIPE)
+    p = Popen(["git", "rev-parse", commit], stdout=PIPE, stderr=PIPE)
     stdout = p.communicate()[0]
     if p.returncode == 0:
         return stdout.strip()
     else:
         return ''
 
-def get_tags_from_line(tagline):
-    tags = []
-    tagline = REVLIST_TAG_PATTERN.match(tagline)
-    if tagline:
-        line = tagline.groups()[0]
-        if ', ' in line:
-            candidates = line.split(', ')
-        else:
-            candidates = [line]
-
-        for candidate in candidates:
-            prefixes_to_strip = ['tag: ']
-            for prefix in prefixes_to_strip:
-                if candidate.startswith(prefix):
-                    candidate = candidate[len(prefix):]
-            tags.append(candidate)
-    return tags
-
-def get_tags_from_current_branch(revlist_output, accepted_tag_pattern):
-    lines = revlist_output.splitlines()
-
-    tags = []
-    # we could rely in line % 2 ? 0, but bad newline would mess up whole process,
-    # so just be simple and forgiving
-    for line in lines:
-        if not line.startswith("commit: "):
-            for tag in get_tags_from_line(line):
-                # now here is the thing: user provides accepted_tag_pattern in non-pythonic,
-                # git, shell-like syntax. Not to force user to provide details, we'll just
-                # validate it by running git.
-                # TODO: This may be optimized in future (shell module?), patches welcomed
-                proc = Popen(['git', 'describe', '--match=%s' % accepted_tag_pattern, tag], stdout=PIPE, stderr=PIPE)
-                verified_tag = proc.communicate()[0].strip()
-
-                if proc.returncode == 0 and tag == verified_tag:
-                    tags.append(tag)
-    return tags
-
-
 def get_highest_version(versions):
     """
     Get highest version for version slice strings
@@ -177,15 +150,296 @@ def get_highest_tag(tag_list):
             pass
 
     return version_map[get_highest_version(version_map.keys())]
-    
 
-def get_git_describe(fix_environment=False, repository_directory=None, accepted_tag_pattern=None, prefer_highest_version=True):
+
+def get_git_tag_refs(accepted_tag_pattern=None):
+    """
+    Return dictionary {tag name : commit hash} of all annotated tags
+    (only those are considered by git describe), using single git for-each-ref call.
+    If accepted_tag_pattern is given, only tags matching it are returned.
+    """
+    command = ["git", "for-each-ref", "--format=%(objecttype) %(*objecttype) %(*objectname) %(refname)", "refs/tags"]
+    proc = Popen(command, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, command)
+
+    tags = {}
+    for line in stdout.splitlines():
+        parts = line.split(' ', 3)
+        if len(parts) != 4:
+            continue
+        objecttype, peeled_type, peeled_hash, refname = parts
+        if objecttype != 'tag' or peeled_type != 'commit':
+            continue
+        tags[refname[len('refs/tags/'):]] = peeled_hash
+
+    return filter_tags(tags, accepted_tag_pattern)
+
+def filter_tags(tags, accepted_tag_pattern=None):
+    """ Return subset of {tag name : commit hash} dictionary with tags matching accepted_tag_pattern """
+    if accepted_tag_pattern is None:
+        return tags
+    return dict([(name, tags[name]) for name in filter_matching(accepted_tag_pattern, tags.keys())])
+
+def get_git_ancestry(commit="HEAD", repository_directory=None):
+    """
+    Return tuple (commit hash, {hash : [parent hashes]}) describing whole history
+    reachable from given commit, read by single git rev-list call.
+    Return (None, {}) when commit cannot be resolved (i.e. repository without commits).
+
+    If repository_directory is given, git is run inside it, ignoring GIT_DIR.
+    """
+    if repository_directory:
+        proc = Popen(["git", "rev-list", "--parents", commit], stdout=PIPE, stderr=PIPE, cwd=repository_directory, env=get_clean_git_environment())
+    else:
+        proc = Popen(["git", "rev-list", "--parents", commit], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+
+    if proc.returncode != 0:
+        return (None, {})
+
+    head = None
+    parents = {}
+    for line in stdout.splitlines():
+        hashes = line.split()
+        if not hashes:
+            continue
+        if head is None:
+            head = hashes[0]
+        parents[hashes[0]] = hashes[1:]
+
+    return (head, parents)
+
+def get_ancestors(commit, parents):
+    """ Return set of commits reachable from given commit (including it) in parents graph """
+    ancestors = set()
+    stack = [commit]
+    while stack:
+        current = stack.pop()
+        if current in ancestors:
+            continue
+        ancestors.add(current)
+        # shallow clones may have parents outside of known history
+        stack.extend([p for p in parents.get(current, []) if p in parents])
+    return ancestors
+
+def describe_highest_version(head, parents, tags):
+    """
+    Compute git describe-like output for highest version tag reachable from head.
+
+    head is commit hash, parents is ancestry graph as returned by get_git_ancestry
+    and tags is {tag name : commit hash} mapping. Distance is the number of commits
+    reachable from head, but not from tagged commit, as git describe counts it.
+
+    Return None if no usable tag is reachable.
+    """
+    version_map = {}
+    for name, commit in tags.items():
+        if commit not in parents:
+            continue
+        try:
+            version_map[compute_version(name)] = name
+        except ValueError:
+            # bad tag format -> shall not be considered
+            pass
+
+    if not version_map:
+        return None
+
+    tag = version_map[get_highest_version(version_map.keys())]
+
+    distance = len(parents) - len(get_ancestors(tags[tag], parents))
+
+    if distance == 0:
+        return tag
+    else:
+        return "%s-%s-g%s" % (tag, distance, head[:7])
+
+def get_hidden_higher_tags(parents, tags):
+    """
+    Return names of version tags from {tag name : commit hash} not reachable in parents
+    (history as returned by get_git_ancestry) with version higher than highest reachable
+    one (or all of them if no version tag is reachable), highest version first.
+    """
+    version_map = {}
+    for name, commit in tags.items():
+        try:
+            version_map[name] = compute_version(name)
+        except ValueError:
+            pass
+
+    reachable = [version_map[name] for name in version_map if tags[name] in parents]
+    hidden = [name for name in version_map if tags[name] not in parents]
+    if reachable:
+        highest = get_highest_version(reachable)
+        hidden = [name for name in hidden if version_map[name] > highest]
+
+    hidden.sort(key=lambda name: version_map[name], reverse=True)
+    return hidden
+
+def is_describe_complete(head, parents, shallow_commits, tags):
+    """
+    Return True if describe_highest_version on shallow history (as returned by get_git_ancestry
+    for clone with given boundary shallow_commits) gives the same result as on complete history.
+
+    tags is {tag name : commit hash} of all candidate tags, including those not fetched yet
+    (see citools.git.get_remote_tags). That is the case when highest reachable tag is not
+    beaten by any other tag (which may hide behind the boundary) and whole shallow
+    boundary lies behind it, so distance from it is counted right.
+    """
+    if not shallow_commits:
+        return True
+
+    version_map = {}
+    for name, commit in tags.items():
+        try:
+            version_map[name] = compute_version(name)
+        except ValueError:
+            pass
+
+    if not version_map:
+        # nothing to find, describe is going to fall back to default version anyway
+        return True
+
+    if get_hidden_higher_tags(parents, tags):
+        return False
+
+    reachable = [name for name in version_map if tags[name] in parents]
+    highest = get_highest_version([version_map[name] for name in reachable])
+    tag = [name for name in reachable if version_map[name] == highest][0]
+    ancestors = get_ancestors(tags[tag], parents)
+
+    for commit in shallow_commits:
+        if commit in parents and commit not in ancestors:
+            return False
+
+    return True
+
+def get_git_describe_highest(accepted_tag_pattern, commit="HEAD"):
+    """
+    Return git describe-like output for highest version tag matching accepted_tag_pattern.
+
+    Annotated tags are read directly from object database when possible, falling back
+    to git for-each-ref. History is always read by single git rev-list call: walking
+    every reachable commit object in Python is several times slower.
+    """
+    describe = None
+    tags = None
+
+    repository = open_repository()
+    if repository is not None:
+        try:
+            try:
+                tags = filter_tags(repository.get_annotated_tags(), accepted_tag_pattern)
+            except ObjectDatabaseError, e:
+                log.debug("Cannot read tags from object database, using git: %s" % e)
+        finally:
+            repository.close()
+
+    head, parents = get_git_ancestry(commit)
+
+    if head is not None:
+        if tags is None:
+            tags = get_git_tag_refs(accepted_tag_pattern)
+        describe = describe_highest_version(head, parents, tags)
+
+    return describe or '.'.join(map(str, DEFAULT_TAG_VERSION))
+
+_describe_cache = {}
+
+def get_describe_cache_key(accepted_tag_pattern=None, prefer_highest_version=True):
+    """
+    Return tuple (git dir, refs fingerprint, key) identifying describe output for current
+    state of repository (as selected by $GIT_DIR or current directory), read without running git.
+    Return None when state cannot be determined this way.
+    """
+    git_dir = get_git_dir()
+    if not git_dir:
+        return None
+
+    head = resolve_ref(git_dir, "HEAD")
+    if not head:
+        return None
+
+    fingerprint = get_refs_fingerprint(git_dir)
+
+    # deepening of shallow clone changes history without touching any ref
+    shallow = ''
+    if os.path.exists(os.path.join(git_dir, 'shallow')):
+        f = open(os.path.join(git_dir, 'shallow'))
+        shallow = f.read()
+        f.close()
+
+    key = md5('\n'.join([
+        git_dir, head, fingerprint, shallow,
+        repr(accepted_tag_pattern), repr(bool(prefer_highest_version))
+    ])).hexdigest()
+
+    return (git_dir, fingerprint, key)
+
+def get_cached_describe(cache_key):
+    """ Return describe output stored for given cache key (in memory or in .git directory) or None """
+    if cache_key in _describe_cache:
+        return _describe_cache[cache_key]
+
+    git_dir, fingerprint, key = cache_key
+    # describe is stored as it is; tag names may contain %, which must not be interpolated
+    parser = RawConfigParser()
+    parser.read([os.path.join(git_dir, VERSION_CACHE_FILE_NAME)])
+
+    if parser.has_section(key) and parser.has_option(key, "describe"):
+        describe = parser.get(key, "describe")
+        _describe_cache[cache_key] = describe
+        return describe
+    return None
+
+def store_cached_describe(cache_key, describe):
+    """
+    Remember describe output for given cache key. On-disk cache in .git directory is
+    rewritten atomically and entries for outdated tag refs are dropped from it.
+    Not being able to write the file is not an error, cache is kept in memory only then.
+    """
+    _describe_cache[cache_key] = describe
+
+    git_dir, fingerprint, key = cache_key
+    cache_file_path = os.path.join(git_dir, VERSION_CACHE_FILE_NAME)
+
+    parser = RawConfigParser()
+    parser.read([cache_file_path])
+
+    for section in parser.sections():
+        if not parser.has_option(section, "fingerprint") or parser.get(section, "fingerprint") != fingerprint:
+            parser.remove_section(section)
+
+    if not parser.has_section(key):
+        parser.add_section(key)
+    parser.set(key, "fingerprint", fingerprint)
+    parser.set(key, "describe", describe)
+
+    tmp_path = None
+    try:
+        handle, tmp_path = mkstemp(dir=git_dir, prefix=VERSION_CACHE_FILE_NAME)
+        f = os.fdopen(handle, "w")
+        parser.write(f)
+        f.close()
+        os.rename(tmp_path, cache_file_path)
+    except (IOError, OSError), e:
+        log.warning("Cannot write version cache %s: %s" % (cache_file_path, e))
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def get_git_describe(fix_environment=False, repository_directory=None, accepted_tag_pattern=None, prefer_highest_version=True, use_cache=True):
     """
     Return output of git describe. If no tag found, initial version is considered to be 0.0
 
     accepted_tag_pattern is used to filter tags only to 'project numbering ones'.
 
     if accepted_tag_given, prefer_hightest_version may be used. This will prefer tags matching accepted_tag_pattern, but with
+
+    Result is cached for current HEAD and tag refs (see get_describe_cache_key), so unchanged
+    repository is not described twice. Pass use_cache=False to always ask git.
     """
     if repository_directory and not fix_environment:
         raise ValueError("Both fix_environment and repository_directory or none of them must be given")
@@ -199,47 +453,21 @@ def get_git_describe(fix_environment=False, repository_directory=None, accepted_
 
         os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
 
-    command = ["git", "describe"]
-
-    if accepted_tag_pattern is not None:
-        if not prefer_highest_version:
-            command.append('--match="%s"' % accepted_tag_pattern)
-        else:
-            # git describe fails us on layout similar to:
-            #        o
-            #        | \
-            #        o  o (repo-1.1)
-            #        |
-            #        o (repo-1.2)
-            # where repo-1.1-1-<hash> will be reported, while we're interested in 1.2-2-<hash>
-
-            # to work around this, we will find "highest" tag matching accepted_tag_patterns and use it
-            # as a tag pattern for git describe output
-            available_tags = get_tags_from_current_branch(
-                revlist_output=get_git_revlist_tags(),
-                accepted_tag_pattern=accepted_tag_pattern
-            )
-
-            # if not tag available, just use default
-            if len(available_tags) < 1:
-                pattern = accepted_tag_pattern
-            else:
-                pattern = get_highest_tag(available_tags)
-
-            command.append('--match="%s"' % pattern)
-
     try:
-        proc = Popen(' '.join(command), stdout=PIPE, stderr=PIPE, shell=True)
-        stdout, stderr = proc.communicate()
-        
-        if proc.returncode == 0:
-            return stdout.strip()
+        cache_key = None
+        if use_cache:
+            cache_key = get_describe_cache_key(accepted_tag_pattern, prefer_highest_version)
+            if cache_key:
+                describe = get_cached_describe(cache_key)
+                if describe is not None:
+                    return describe
 
-        elif proc.returncode == 128:
-            return '.'.join(map(str, DEFAULT_TAG_VERSION))
+        describe = _get_git_describe(accepted_tag_pattern, prefer_highest_version)
 
-        else:
-            raise ValueError("Unknown return code %s" % proc.returncode)
+        if cache_key:
+            store_cached_describe(cache_key, describe)
+
+        return describe
 
     finally:
         if fix_environment:
@@ -248,6 +476,37 @@ def get_git_describe(fix_environment=False, repository_directory=None, accepted_
             else:
                 del os.environ['GIT_DIR']
 
+def _get_git_describe(accepted_tag_pattern=None, prefer_highest_version=True):
+    if accepted_tag_pattern is not None and prefer_highest_version:
+        # git describe fails us on layout similar to:
+        #        o
+        #        | \
+        #        o  o (repo-1.1)
+        #        |
+        #        o (repo-1.2)
+        # where repo-1.1-1-<hash> will be reported, while we're interested in 1.2-2-<hash>
+
+        # to work around this, we will find "highest" tag matching accepted_tag_patterns
+        # and compute distance to it ourselves, from tag refs and history read at once
+        return get_git_describe_highest(accepted_tag_pattern)
+
+    command = ["git", "describe"]
+
+    if accepted_tag_pattern is not None:
+        command.append('--match="%s"' % accepted_tag_pattern)
+
+    proc = Popen(' '.join(command), stdout=PIPE, stderr=PIPE, shell=True)
+    stdout, stderr = proc.communicate()
+
+    if proc.returncode == 0:
+        return stdout.strip()
+
+    elif proc.returncode == 128:
+        return '.'.join(map(str, DEFAULT_TAG_VERSION))
+
+    else:
+        raise ValueError("Unknown return code %s" % proc.returncode)
+
 def replace_version(source_file, version):
     content = []
     version_regexp = re.compile(r"^(VERSION){1}(\ )+(\=){1}(\ )+\({1}([0-9])+(\,{1}(\ )*[0-9]+)+(\)){1}")
@@ -271,6 +530,10 @@ def get_git_head_hash(fix_environment=False, repository_directory=None):
         os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
 
     try:
+        head = get_head_hash()
+        if head:
+            return head
+
         proc = Popen(["git", "rev-parse", "HEAD"], stdout=PIPE)
         return_code = proc.wait()
         if return_code == 0:
@@ -294,6 +557,16 @@ def get_git_head_tstamp(fix_environment=False, repository_directory=None):
         os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
 
     try:
+        repository = open_repository()
+        if repository is not None:
+            try:
+                try:
+                    return str(repository.get_commit(repository.resolve())['author'][2])
+                except ObjectDatabaseError, e:
+                    log.debug("Cannot read HEAD commit from object database, using git: %s" % e)
+            finally:
+                repository.close()
+
         proc = Popen(["git", "log", "-n1", "--pretty=format:%at"], stdout=PIPE)
         return_code = proc.wait()
         if return_code == 0:
@@ -371,6 +644,12 @@ def retrieve_current_branch(fix_environment=False, repository_directory=None, **
         os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
 
     try:
+        git_dir = get_git_dir()
+        if git_dir:
+            branch = get_current_branch_name(git_dir)
+            if branch:
+                return branch
+
         proc = Popen('git branch --no-color', stdout=PIPE, stderr=PIPE, shell=True)
         stdout, stderr = proc.communicate()
 
@@ -387,7 +666,183 @@ def retrieve_current_branch(fix_environment=False, repository_directory=None, **
                 del os.environ['GIT_DIR']
 
 
-def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pattern=None, cachedir=None, dependency_versions=None):
+def get_reference_repository(url, cachedir):
+    """ Return path to repository inside cachedir usable as --reference for given url, or None """
+    reponame = urlsplit(url)[2].split("/")[-1]
+    if reponame.endswith(".git"):
+        cachename = reponame[:-4]
+    else:
+        cachename = reponame
+
+    if os.path.exists(os.path.join(cachedir, cachename)):
+        return os.path.abspath(os.path.join(cachedir, cachename))
+
+    elif os.path.exists(os.path.join(cachedir, cachename+".git")):
+        return os.path.abspath(os.path.join(cachedir, cachename+".git"))
+
+    return None
+
+def get_dependency_pattern(repository_dict):
+    """ Return accepted tag pattern for dependency repository """
+    # this is pattern for dependency repo, NOT for for ourselves -> pattern of it, not ours
+    # now hardcoded, but shall be retrieved via egg_info or custom command
+    return "%s-[0-9]*" % repository_dict['package_name']
+
+def describe_dependency(repository_dict, workdir):
+    """
+    Return version tuple of dependency repository checked out in workdir.
+    Serialized, as describing needs GIT_DIR in environment.
+    """
+    git_environment_lock.acquire()
+    try:
+        return compute_version(get_git_describe(repository_directory=workdir, fix_environment=True, accepted_tag_pattern=get_dependency_pattern(repository_dict)))
+    finally:
+        git_environment_lock.release()
+
+def fetch_dependency_version(job):
+    """
+    Fetch dependency repository and compute it's version.
+    job is a tuple (repository dict, branch, directory to fetch into, dictionary of additional
+    fetch_repository arguments, i.e. reference_repository, shallow or mirror_directory).
+    Return tuple (package name, version tuple, seconds spent, directory with fetched repository).
+
+    Suitable for map_in_pool.
+    """
+    repository_dict, branch, repositories_dir, fetch_options = job
+    start = time.time()
+
+    workdir = fetch_repository(repository_dict['url'], branch=branch, workdir=repositories_dir,
+        accepted_tag_pattern=get_dependency_pattern(repository_dict), **fetch_options)
+
+    new_version = describe_dependency(repository_dict, workdir)
+
+    return (repository_dict['package_name'], new_version, time.time() - start, workdir)
+
+
+class DependencySession(object):
+    """
+    Registry of dependency repositories fetched during one build, so every dependency
+    (identified by url and branch) is fetched and described only once, no matter how many
+    steps need it (meta version, debian control, static files).
+
+    Repositories are fetched into temporary directory created inside workdir (curdir by default).
+    fetch_options are passed to citools.git.fetch_repository (shallow, mirror_directory);
+    if cachedir is given, repositories found there are used as --reference.
+
+    Session is not thread safe; it shall be filled from the thread running the build
+    (see compute_meta_version for fetching many repositories concurrently).
+    """
+
+    def __init__(self, workdir=None, cachedir=None, fetch_options=None):
+        self.workdir = workdir or os.curdir
+        self.cachedir = cachedir
+        self.fetch_options = fetch_options or {}
+        self.repositories_dir = None
+        self.directories = {}
+        self.versions = {}
+        self.values = {}
+
+    def get_key(self, repository_dict, branch):
+        return (repository_dict['url'], branch)
+
+    def get_repositories_dir(self):
+        if not self.repositories_dir:
+            self.repositories_dir = mkdtemp(dir=self.workdir, prefix="build-repository-dependencies-")
+        return self.repositories_dir
+
+    def get_fetch_options(self, repository_dict):
+        options = dict(self.fetch_options)
+        if self.cachedir:
+            options['reference_repository'] = get_reference_repository(repository_dict['url'], self.cachedir)
+        return options
+
+    def get_fetch_job(self, repository_dict, branch):
+        """ Return job for fetch_dependency_version; pass it's result to add_dependency """
+        return (repository_dict, branch, self.get_repositories_dir(), self.get_fetch_options(repository_dict))
+
+    def add_dependency(self, repository_dict, branch, directory, version=None):
+        key = self.get_key(repository_dict, branch)
+        self.directories[key] = directory
+        if version is not None:
+            self.versions[key] = version
+
+    def has_directory(self, repository_dict, branch):
+        return self.directories.has_key(self.get_key(repository_dict, branch))
+
+    def get_directory(self, repository_dict, branch):
+        """ Return directory with repository checked out at branch, fetching it if needed """
+        key = self.get_key(repository_dict, branch)
+        if not self.directories.has_key(key):
+            self.directories[key] = fetch_repository(repository_dict['url'], branch=branch, workdir=self.get_repositories_dir(),
+                accepted_tag_pattern=get_dependency_pattern(repository_dict), **self.get_fetch_options(repository_dict))
+        return self.directories[key]
+
+    def get_version(self, repository_dict, branch):
+        """ Return version tuple of repository at branch, fetching and describing it if needed """
+        key = self.get_key(repository_dict, branch)
+        if not self.versions.has_key(key):
+            self.versions[key] = describe_dependency(repository_dict, self.get_directory(repository_dict, branch))
+        return self.versions[key]
+
+    def get_value(self, name, repository_dict, branch, compute):
+        """
+        Return value derived from repository at branch (i.e. parsed control file),
+        computed by calling compute() only the first time it's asked for
+        """
+        key = (name,) + self.get_key(repository_dict, branch)
+        if not self.values.has_key(key):
+            self.values[key] = compute()
+        return self.values[key]
+
+def get_dependency_session(distribution, cachedir=None, fetch_options=None):
+    """
+    Return DependencySession shared by all commands run for distribution,
+    creating it with given options if this is the first command asking for it.
+
+    Options of later commands are merged into existing session when it has them unset
+    (repositories fetched before are kept as they are); options conflicting with
+    those already set are ignored with a warning.
+    """
+    session = getattr(distribution, 'dependency_session', None)
+    if session is None:
+        session = DependencySession(cachedir=cachedir, fetch_options=fetch_options)
+        distribution.dependency_session = session
+        return session
+
+    requested = [('cachedir', session.cachedir, cachedir)]
+    for name, value in (fetch_options or {}).items():
+        requested.append((name, session.fetch_options.get(name), value))
+
+    for name, current, value in requested:
+        if not value or value == current:
+            continue
+        if current:
+            log.warning("Dependency session already uses %s %s, ignoring %s" % (name, current, value))
+            continue
+
+        log.info("Using %s %s for dependencies fetched from now on, %s fetched before are kept" % (name, value, len(session.directories)))
+        if name == 'cachedir':
+            session.cachedir = value
+        else:
+            session.fetch_options[name] = value
+
+    return session
+
+def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pattern=None, cachedir=None, dependency_versions=None, workers=None, pool_type="thread", timings=None, shallow=False, mirror_directory=None, session=None):
+    """
+    Return meta version: my version summed with versions of all dependency repositories.
+    With shallow, dependencies are fetched as shallow clones, only as deep as needed
+    for describing them. With mirror_directory, they're cloned from bare mirrors kept
+    there (see citools.git.fetch_repository).
+
+    Dependencies are fetched and described concurrently by at most workers threads
+    or processes (see citools.pool.map_in_pool); versions are always summed in order
+    of dependency_repositories. If timings dictionary is given, it's filled with
+    seconds spent fetching and describing every dependency package.
+
+    If DependencySession is given, dependencies already fetched in it are reused (and
+    cachedir, shallow and mirror_directory are taken from it instead).
+    """
 
     kwargs = {}
 
@@ -406,36 +861,42 @@ def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pat
     meta_branch = retrieve_current_branch(**kwargs)
 
     version = compute_version(describe)
-    
-    repositories_dir = mkdtemp(dir=os.curdir, prefix="build-repository-dependencies-")
+
+    if session is None:
+        session = DependencySession(cachedir=cachedir, fetch_options={
+            'shallow' : shallow,
+            'mirror_directory' : mirror_directory,
+        })
+
+    branches = []
+    jobs = []
     for repository_dict in dependency_repositories:
         if repository_dict.has_key('branch'):
             branch = repository_dict['branch']
         else:
             branch = meta_branch
 
-        reference_repository = None
+        branches.append(branch)
 
-        if cachedir:
-            reponame = urlsplit(repository_dict['url'])[2].split("/")[-1]
-            if reponame.endswith(".git"):
-                cachename = reponame[:-4]
-            else:
-                cachename = reponame
-
-            if os.path.exists(os.path.join(cachedir, cachename)):
-                reference_repository = os.path.abspath(os.path.join(cachedir, cachename))
-                
-            elif os.path.exists(os.path.join(cachedir, cachename+".git")):
-                reference_repository = os.path.abspath(os.path.join(cachedir, cachename+".git"))
-
-        workdir = fetch_repository(repository_dict['url'], branch=branch, workdir=repositories_dir, reference_repository=reference_repository)
-        # this is pattern for dependency repo, NOT for for ourselves -> pattern of it, not ours
-        # now hardcoded, but shall be retrieved via egg_info or custom command
-        project_pattern = "%s-[0-9]*" % repository_dict['package_name']
-        new_version = compute_version(get_git_describe(repository_directory=workdir, fix_environment=True, accepted_tag_pattern=project_pattern))
+        if not session.has_directory(repository_dict, branch):
+            jobs.append(session.get_fetch_job(repository_dict, branch))
+
+    elapsed_map = {}
+
+    for job, (package_name, new_version, elapsed, directory) in zip(jobs, map_in_pool(fetch_dependency_version, jobs, workers=workers, pool_type=pool_type)):
+        log.info("Dependency %s fetched and described in %.2fs" % (package_name, elapsed))
+        session.add_dependency(job[0], job[1], directory, new_version)
+        elapsed_map[package_name] = elapsed
+
+    for repository_dict, branch in zip(dependency_repositories, branches):
+        start = time.time()
+        new_version = session.get_version(repository_dict, branch)
+        package_name = repository_dict['package_name']
+
+        if timings is not None:
+            timings[package_name] = elapsed_map.get(package_name, time.time() - start)
         if dependency_versions is not None:
-            dependency_versions[repository_dict['package_name']] = new_version
+            dependency_versions[package_name] = new_version
         version = sum_versions(version, new_version)
     return version
 
@@ -473,13 +934,25 @@ class GitSetMetaVersion(config):
 
     user_options = [
         ("cache-directory=", None, "Directory where dependent repositories are cached in"),
+        ("workers=", None, "Number of dependency repositories fetched concurrently"),
+        ("pool-type=", None, "Fetch dependencies using 'thread' (default) or 'process' pool"),
+        ("shallow", None, "Fetch only as much of dependencies history as needed for their versions"),
+        ("mirror-directory=", None, "Directory with shared bare mirrors of dependency repositories"),
     ]
 
+    boolean_options = ["shallow"]
+
     def initialize_options(self):
         self.cache_directory = None
+        self.workers = None
+        self.pool_type = None
+        self.shallow = False
+        self.mirror_directory = None
 
     def finalize_options(self):
         self.cache_directory = self.cache_directory or None
+        self.workers = self.workers and int(self.workers) or None
+        self.pool_type = self.pool_type or "thread"
 
     def run(self):
         """
@@ -490,14 +963,27 @@ class GitSetMetaVersion(config):
         try:
             format = "%s-[0-9]*" % self.distribution.metadata.get_name()
             dependency_versions = {}
+            timings = {}
             
+            session = get_dependency_session(self.distribution, cachedir=self.cache_directory, fetch_options={
+                'shallow' : self.shallow,
+                'mirror_directory' : self.mirror_directory,
+            })
+
             meta_version = compute_meta_version(
                 self.distribution.dependencies_git_repositories,
                 accepted_tag_pattern = format,
-                cachedir = self.cache_directory,
-                dependency_versions = dependency_versions
+                dependency_versions = dependency_versions,
+                workers = self.workers,
+                pool_type = self.pool_type,
+                timings = timings,
+                session = session
             )
 
+            for repository in self.distribution.dependencies_git_repositories:
+                name = repository['package_name']
+                print "Dependency %s fetched in %.2fs" % (name, timings[name])
+
             branch_suffix = get_branch_suffix(self.distribution.metadata, retrieve_current_branch())
 
 
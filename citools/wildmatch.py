@@ -0,0 +1,166 @@
+"""
+In-process implementation of git's wildmatch, as used by
+git describe --match, git tag -l and friends.
+
+Only the flag-less mode is supported (no WM_PATHNAME nor WM_CASEFOLD), which
+is what git uses for tag patterns: '*' and '?' match slashes as well.
+
+Patterns are translated to python regular expressions and cached, so
+matching thousands of tags against single pattern is cheap.
+"""
+
+import re
+
+CHARACTER_CLASSES = {
+    'alnum' : 'a-zA-Z0-9',
+    'alpha' : 'a-zA-Z',
+    'blank' : ' \\t',
+    'cntrl' : '\\x00-\\x1f\\x7f',
+    'digit' : '0-9',
+    'graph' : '\\x21-\\x7e',
+    'lower' : 'a-z',
+    'print' : '\\x20-\\x7e',
+    'punct' : '\\x21-\\x2f\\x3a-\\x40\\x5b-\\x60\\x7b-\\x7e',
+    'space' : ' \\t\\n\\r\\f\\v',
+    'upper' : 'A-Z',
+    'xdigit' : '0-9a-fA-F',
+}
+
+# regexp never matching anything; used for empty sets and broken patterns
+NEVER = '(?!)'
+
+_compiled_patterns = {}
+
+
+class InvalidPattern(ValueError):
+    """ Pattern git would abort on (and thus never match anything) """
+
+
+def _escape(char):
+    return '\\x%02x' % ord(char)
+
+def _translate_bracket(pattern, i):
+    """
+    Translate bracket expression starting after '[' at position i.
+    Return tuple (regexp, position after closing ']').
+    Mimics dowild() from git's wildmatch.c, including it's quirks
+    (']' as first member, '-' at the edges, ranges after classes).
+    """
+    n = len(pattern)
+    negated = False
+
+    if i < n and pattern[i] in '!^':
+        negated = True
+        i += 1
+
+    members = []
+    prev = None
+    first = True
+
+    while first or pattern[i] != ']':
+        first = False
+        if i >= n:
+            raise InvalidPattern("Unterminated bracket expression")
+
+        char = pattern[i]
+
+        if char == '\\':
+            i += 1
+            if i >= n:
+                raise InvalidPattern("Trailing backslash in bracket expression")
+            char = pattern[i]
+            members.append(_escape(char))
+
+        elif char == '-' and prev is not None and i+1 < n and pattern[i+1] != ']':
+            i += 1
+            high = pattern[i]
+            if high == '\\':
+                i += 1
+                if i >= n:
+                    raise InvalidPattern("Trailing backslash in bracket expression")
+                high = pattern[i]
+            if prev <= high:
+                members.append('%s-%s' % (_escape(prev), _escape(high)))
+            char = None
+
+        elif char == '[' and i+1 < n and pattern[i+1] == ':':
+            end = pattern.find(']', i+2)
+            if end == -1:
+                raise InvalidPattern("Unterminated character class")
+            if end - (i+2) < 1 or pattern[end-1] != ':':
+                # no ":]" found, '[' is just an ordinary member
+                members.append(_escape(char))
+            else:
+                name = pattern[i+2:end-1]
+                if name not in CHARACTER_CLASSES:
+                    raise InvalidPattern("Unknown character class %s" % name)
+                members.append(CHARACTER_CLASSES[name])
+                i = end
+                char = None
+        else:
+            members.append(_escape(char))
+
+        prev = char
+        i += 1
+
+        if i >= n:
+            raise InvalidPattern("Unterminated bracket expression")
+
+    if not members:
+        if negated:
+            return ('.', i+1)
+        else:
+            return (NEVER, i+1)
+
+    return ('[%s%s]' % (negated and '^' or '', ''.join(members)), i+1)
+
+def translate(pattern):
+    """ Translate git wildmatch pattern to python regexp string """
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            while i < n and pattern[i] == '*':
+                i += 1
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '[':
+            part, i = _translate_bracket(pattern, i)
+            parts.append(part)
+        elif char == '\\':
+            if i >= n:
+                raise InvalidPattern("Trailing backslash")
+            parts.append(_escape(pattern[i]))
+            i += 1
+        else:
+            parts.append(_escape(char))
+    return '(?s)%s\\Z' % ''.join(parts)
+
+def compile_pattern(pattern):
+    """
+    Return compiled regexp object for given pattern, or None if pattern
+    is broken in a way git refuses to match anything with it.
+    """
+    if pattern not in _compiled_patterns:
+        try:
+            _compiled_patterns[pattern] = re.compile(translate(pattern))
+        except InvalidPattern:
+            _compiled_patterns[pattern] = None
+    return _compiled_patterns[pattern]
+
+def wildmatch(pattern, text):
+    """ Return True if text is matched by git shell-like pattern """
+    compiled = compile_pattern(pattern)
+    if compiled is None:
+        return False
+    return compiled.match(text) is not None
+
+def filter_matching(pattern, names):
+    """ Return list of names matched by pattern, preserving order """
+    compiled = compile_pattern(pattern)
+    if compiled is None:
+        return []
+    return [name for name in names if compiled.match(name)]
@@ -0,0 +1,103 @@
+"""
+Benchmark of debian control file parsing on large generated control files.
+
+Compares parsing with grammars built once per process against building
+them again for every paragraph and field (as it used to be), optionally
+with pyparsing's packrat cache enabled, and pyparsing against the
+hand-written tokenizer used for well-formed input.
+
+Run as python tests/benchmark_control.py [number of packages] [repeats]
+"""
+from StringIO import StringIO
+import sys
+from timeit import Timer
+
+from pyparsing import ParserElement
+
+import citools.debian.control
+from citools.debian.control import ControlFile, iter_packages
+
+
+def get_control_source(packages, dependencies=10):
+    paragraphs = ["""\
+Source: benchmark
+Section: python
+Priority: optional
+Maintainer: John Doe <john@doe.com>
+Build-Depends: cdbs (>= 0.4.41), debhelper (>= 5.0.37.2), python-dev, python-support (>= 0.3), python-setuptools
+Standards-Version: 3.7.2"""]
+
+    for i in xrange(0, packages):
+        depends = ", ".join([
+            "benchmark-package-%s (>= 1.%s.0~bpo50+1) | benchmark-other-%s" % (j, i, j)
+            for j in xrange(0, dependencies)
+        ])
+        paragraphs.append("""\
+Package: benchmark-package-%(i)s
+Architecture: all
+Depends: %(depends)s, python (>= 2.5.0)
+Provides: benchmark-package-%(i)s-1.0.0, benchmark-slot-%(i)s
+Description: benchmark package %(i)s
+ with description on
+ more lines""" % {'i' : i, 'depends' : depends})
+
+    return "\n\n".join(paragraphs) + "\n"
+
+class UncachedGrammars(object):
+    """ Drop built grammars before every lookup, as if they were built on every call """
+    def __init__(self):
+        self.get_grammar = citools.debian.control.get_grammar
+
+    def __call__(self, builder, *args):
+        citools.debian.control._grammars.clear()
+        return self.get_grammar(builder, *args)
+
+class Patched(object):
+    """ Replace attributes of citools.debian.control between start() and stop() """
+    def __init__(self, **attributes):
+        self.attributes = attributes
+        self.original = {}
+
+    def start(self):
+        for name, value in self.attributes.items():
+            self.original[name] = getattr(citools.debian.control, name)
+            setattr(citools.debian.control, name, value)
+
+    def stop(self):
+        for name, value in self.original.items():
+            setattr(citools.debian.control, name, value)
+
+def pyparsing_only(*args, **kwargs):
+    return None
+
+def measure(source, repeats, patched=None):
+    if patched:
+        patched.start()
+    try:
+        return min(Timer(lambda: ControlFile(source)).repeat(repeats, 1))
+    finally:
+        if patched:
+            patched.stop()
+
+def main(packages=500, repeats=3):
+    source = get_control_source(packages)
+    print "Parsing control file with %s packages (%s bytes), best of %s" % (packages, len(source), repeats)
+
+    uncached = measure(source, repeats, Patched(get_grammar=UncachedGrammars(), tokenize_paragraph=pyparsing_only, tokenize_relations=pyparsing_only))
+    print "grammar built on every call: %.3fs" % uncached
+
+    cached = measure(source, repeats, Patched(tokenize_paragraph=pyparsing_only, tokenize_relations=pyparsing_only))
+    print "grammar built once:          %.3fs (%.1fx)" % (cached, uncached / cached)
+
+    tokenized = measure(source, repeats)
+    print "hand-written tokenizer:      %.3fs (%.1fx)" % (tokenized, uncached / tokenized)
+
+    streamed = min(Timer(lambda: len(list(iter_packages(StringIO(source))))).repeat(repeats, 1))
+    print "streamed from file object:   %.3fs (%.1fx)" % (streamed, uncached / streamed)
+
+    ParserElement.enablePackrat()
+    packrat = measure(source, repeats, Patched(tokenize_paragraph=pyparsing_only, tokenize_relations=pyparsing_only))
+    print "grammar built once, packrat: %.3fs (%.1fx)" % (packrat, uncached / packrat)
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
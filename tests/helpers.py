@@ -299,6 +299,19 @@ class GitTestCase(TestCase):
         stdout = self.do_piped_command_for_success(['git', 'rev-parse', 'HEAD'])[0]
         return stdout.strip()
 
+    def commit_file(self, content, tag=None, filename='test.txt'):
+        """ Write content to filename in repository, commit it and return commited revision; tag it if tag is given """
+        f = open(os.path.join(self.repo, filename), 'wb')
+        f.write(content)
+        f.close()
+
+        self.do_piped_command_for_success(['git', 'add', filename])
+        revision = self.commit()
+
+        if tag:
+            self.do_piped_command_for_success(['git', 'tag', '-a', '-m', '"tagging"', tag])
+        return revision
+
     def tearDown(self):
         TestCase.tearDown(self)
         # delete temporary repository and restore ENV vars after update
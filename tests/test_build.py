@@ -1,12 +1,15 @@
 from __future__ import with_statement
 import os
+import stat
+import sys
 from shutil import rmtree
-from subprocess import check_call, PIPE
+from subprocess import check_call, Popen, PIPE
 from tempfile import mkdtemp
 
 from nose.tools import assert_equals, assert_true
 
-from citools.build import copy_images, replace_template_files, rename_template_files
+import citools.build
+from citools.build import BuildContext, StaticStore, copy_images, get_blob_hash, get_tree_blob_hashes, sync_tree, get_build_context, get_common_variables, get_template_environment, get_template_manifest, get_template_variable_names, replace_template_files, rename_template_files
 
 from helpers import BuildTestCase
 
@@ -76,6 +79,162 @@ class TestCopyImages(object):
         assert_equals(self.file_content, open(os.path.join(self.tmp_static, self.package_name, 'images', 'test.txt')).read())
 
 
+    def get_repositories(self):
+        return [{
+            'url': os.path.abspath(self.repo),
+            'branch': 'master',
+            'package_name' : self.package_name,
+        }]
+
+    def test_blob_hash_same_as_git(self):
+        proc = Popen(['git', 'hash-object', self.filename], stdout=PIPE)
+        assert_equals(proc.communicate()[0].strip(), get_blob_hash(self.filename))
+
+    def test_images_linked_from_store(self):
+        store = os.path.join(self.tmp_static, 'store')
+        report = copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static, store_directory=store)
+
+        target = os.path.join(self.tmp_static, self.package_name, 'images', 'test.txt')
+        assert_equals(self.file_content, open(target).read())
+        assert_true(os.path.samefile(target, StaticStore(store).get_object_path(get_blob_hash(target))))
+        assert_equals({'files' : 1, 'copied' : len(self.file_content), 'linked' : len(self.file_content), 'unchanged' : 0, 'removed' : 0}, report)
+
+    def test_unchanged_images_not_copied_again(self):
+        store = os.path.join(self.tmp_static, 'store')
+        copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static, store_directory=store)
+        report = copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static, store_directory=store)
+
+        assert_equals({'files' : 1, 'copied' : 0, 'linked' : 0, 'unchanged' : len(self.file_content), 'removed' : 0}, report)
+
+    def test_existing_images_synchronized(self):
+        copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+
+        stale = os.path.join(self.tmp_static, self.package_name, 'images', 'stale.txt')
+        with open(stale, 'w') as f:
+            f.write("stale")
+
+        report = copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+
+        assert_equals({'files' : 1, 'copied' : 0, 'linked' : 0, 'unchanged' : len(self.file_content), 'removed' : 1}, report)
+        assert_true(not os.path.exists(stale))
+
+    def test_unchanged_images_not_read_again(self):
+        copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+
+        hashed = []
+        original_get_blob_hash = citools.build.get_blob_hash
+        def get_blob_hash(file_path):
+            hashed.append(file_path)
+            return original_get_blob_hash(file_path)
+        citools.build.get_blob_hash = get_blob_hash
+        try:
+            report = copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+        finally:
+            citools.build.get_blob_hash = original_get_blob_hash
+
+        assert_equals(len(self.file_content), report['unchanged'])
+        assert_equals([], hashed)
+        assert_equals([self.package_name], os.listdir(self.tmp_static))
+
+    def test_changed_images_copied_again(self):
+        target = os.path.join(self.tmp_static, self.package_name, 'images', 'test.txt')
+        copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+        with open(target, 'w') as f:
+            f.write("!!!ELIFFTW")
+
+        report = copy_images(repositories=self.get_repositories(), static_dir=self.tmp_static)
+
+        assert_equals(len(self.file_content), report['copied'])
+        assert_equals(self.file_content, open(target).read())
+
+    def test_sync_compares_modification_times(self):
+        source = os.path.join(self.package_name, 'static')
+        target = os.path.join(self.tmp_static, 'synced')
+        sync_tree(source, target)
+
+        with open(os.path.join(target, 'images', 'test.txt'), 'w') as f:
+            f.write("!!!ELIFFTW")
+        os.utime(os.path.join(target, 'images', 'test.txt'), (0, 0))
+        os.mkdir(os.path.join(target, 'stale'))
+        with open(os.path.join(target, 'stale', 'stale.txt'), 'w') as f:
+            f.write("stale")
+
+        report = sync_tree(source, target)
+
+        assert_equals({'files' : 1, 'copied' : len(self.file_content), 'linked' : 0, 'unchanged' : 0, 'removed' : 1}, report)
+        assert_equals(self.file_content, open(os.path.join(target, 'images', 'test.txt')).read())
+        assert_equals(['images'], os.listdir(target))
+
+    def test_symlinked_directories_followed(self):
+        os.mkdir(os.path.join(self.package_name, 'shared'))
+        with open(os.path.join(self.package_name, 'shared', 'a.png'), 'w') as f:
+            f.write(self.file_content)
+        os.symlink(os.path.join('..', 'shared'), os.path.join(self.package_name, 'static', 'img'))
+        os.symlink('.', os.path.join(self.package_name, 'static', 'loop'))
+
+        source = os.path.join(self.package_name, 'static')
+        sync_tree(source, os.path.join(self.tmp_static, 'synced'))
+        StaticStore(os.path.join(self.tmp_static, 'store')).materialize(source, os.path.join(self.tmp_static, 'linked'))
+
+        for target in ('synced', 'linked'):
+            assert_equals(self.file_content, open(os.path.join(self.tmp_static, target, 'img', 'a.png')).read())
+            assert_equals(['images', 'img'], sorted(os.listdir(os.path.join(self.tmp_static, target))))
+
+    def test_same_content_stored_once(self):
+        store = StaticStore(os.path.join(self.tmp_static, 'store'))
+        source = os.path.join(self.package_name, 'static')
+        store.materialize(source, os.path.join(self.tmp_static, 'first'))
+        report = store.materialize(source, os.path.join(self.tmp_static, 'second'))
+
+        assert_equals(0, report['copied'])
+        assert_equals(len(self.file_content), report['linked'])
+        assert_true(os.path.samefile(os.path.join(self.tmp_static, 'first', 'images', 'test.txt'), os.path.join(self.tmp_static, 'second', 'images', 'test.txt')))
+
+    def test_stored_content_not_copied_again(self):
+        store = StaticStore(os.path.join(self.tmp_static, 'store'))
+        source = os.path.join(self.package_name, 'static')
+        store.materialize(source, os.path.join(self.tmp_static, 'first'))
+
+        copied = []
+        original_copyfile = citools.build.copyfile
+        def copyfile(source, target):
+            copied.append(source)
+            return original_copyfile(source, target)
+        citools.build.copyfile = copyfile
+        try:
+            store.materialize(source, os.path.join(self.tmp_static, 'second'))
+        finally:
+            citools.build.copyfile = original_copyfile
+
+        assert_equals([], copied)
+
+    def test_executable_stays_executable_in_store(self):
+        store = StaticStore(os.path.join(self.tmp_static, 'store'))
+        script = os.path.join(self.package_name, 'static', 'run.sh')
+        for path in (script, self.filename):
+            with open(path, 'w') as f:
+                f.write(self.file_content)
+        os.chmod(script, 0755)
+
+        store.materialize(os.path.join(self.package_name, 'static'), os.path.join(self.tmp_static, 'first'))
+
+        assert_equals(0555, stat.S_IMODE(os.stat(os.path.join(self.tmp_static, 'first', 'run.sh')).st_mode))
+        assert_equals(0444, stat.S_IMODE(os.stat(os.path.join(self.tmp_static, 'first', 'images', 'test.txt')).st_mode))
+
+    def test_modified_checkout_not_stored_under_committed_id(self):
+        store = StaticStore(os.path.join(self.tmp_static, 'store'))
+        blobs = get_tree_blob_hashes(self.repo, "%s/static" % self.package_name)
+        committed = blobs['images/test.txt'][0]
+        with open(self.filename, 'w') as f:
+            f.write("!!!ELIFFTW")
+
+        store.materialize(os.path.join(self.package_name, 'static'), os.path.join(self.tmp_static, 'first'), blobs=blobs)
+
+        target = os.path.join(self.tmp_static, 'first', 'images', 'test.txt')
+        assert_equals("!!!ELIFFTW", open(target).read())
+        assert_true(not os.path.exists(store.get_object_path(committed)))
+        assert_true(os.path.samefile(target, store.get_object_path(get_blob_hash(target))))
+
     def tearDown(self):
         os.chdir(self.oldcwd)
 
@@ -102,6 +261,87 @@ class TestTemplateReplacement(object):
         
         assert_equals("dependency-test", open(req_fn).read())
 
+    def test_unchanged_file_not_rendered_again(self):
+        req_fn = os.path.join(self.tmp, 'requirements.txt')
+        with open(req_fn, 'w') as f:
+            f.write("dependency-{{ branch }}")
+
+        assert_equals(['requirements.txt'], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}))
+        assert_equals([], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}))
+
+        with open(req_fn, 'w') as f:
+            f.write("dependency-{{ branch }}-changed")
+        assert_equals(['requirements.txt'], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}))
+        assert_equals("dependency-test-changed", open(req_fn).read())
+
+    def test_unchanged_file_not_rendered_again_by_next_build(self):
+        req_fn = os.path.join(self.tmp, 'requirements.txt')
+        with open(req_fn, 'w') as f:
+            f.write("dependency-{{ '{{' }} branch }}")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(citools.build.__file__))))
+        check_call([sys.executable, '-c', "from citools.build import replace_template_files; replace_template_files(%r, {'branch' : 'test'})" % self.tmp], env=env)
+
+        environment = get_template_environment(self.tmp)
+        def fail(*args, **kwargs):
+            raise AssertionError("Template rendered again")
+        environment.get_template = environment.from_string = fail
+        try:
+            assert_equals([], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}))
+        finally:
+            del environment.get_template, environment.from_string
+        assert_equals("dependency-{{ branch }}", open(req_fn).read())
+
+    def test_absolute_template_rendered_from_content(self):
+        other = mkdtemp(prefix='test-build-other-')
+        try:
+            req_fn = os.path.join(other, 'requirements.txt')
+            with open(req_fn, 'w') as f:
+                f.write("dependency-{{ branch }}")
+
+            assert_equals([req_fn], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}, template_files=[req_fn]))
+            assert_equals("dependency-test", open(req_fn).read())
+        finally:
+            rmtree(other)
+
+    def test_file_rendered_again_with_other_variables(self):
+        req_fn = os.path.join(self.tmp, 'requirements.txt')
+        with open(req_fn, 'w') as f:
+            f.write("dependency-{{ '{{' }} branch }}")
+
+        replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'})
+        replace_template_files(root_directory=self.tmp, variables={'branch' : 'other'})
+        assert_equals("dependency-other", open(req_fn).read())
+
+    def test_subdirectory_files_rendered_in_parallel(self):
+        os.mkdir(os.path.join(self.tmp, 'debian'))
+        for i in xrange(0, 10):
+            with open(os.path.join(self.tmp, 'debian', 'file%s' % i), 'w') as f:
+                f.write("{{ branch }}-%s" % i)
+
+        rendered = replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}, template_files=['debian/file0'], workers=4)
+
+        assert_equals(10, len(rendered))
+        for i in xrange(0, 10):
+            assert_equals("test-%s" % i, open(os.path.join(self.tmp, 'debian', 'file%s' % i)).read())
+
+    def test_manifest_contains_only_templates(self):
+        os.mkdir(os.path.join(self.tmp, 'debian'))
+        for fn, content in [('setup.py', "version = '{{ version }}'"), ('pavement.py', "# no markup"), ('debian/rules', "{% if branch %}{% endif %}"), ('debian/compat', "")]:
+            with open(os.path.join(self.tmp, *fn.split('/')), 'w') as f:
+                f.write(content)
+
+        assert_equals(['setup.py', 'debian/rules'], get_template_manifest(self.tmp))
+
+    def test_file_without_markup_not_touched(self):
+        req_fn = os.path.join(self.tmp, 'requirements.txt')
+        with open(req_fn, 'w') as f:
+            f.write("dependency\n")
+        os.utime(req_fn, (0, 0))
+
+        assert_equals([], replace_template_files(root_directory=self.tmp, variables={'branch' : 'test'}))
+        assert_equals("dependency\n", open(req_fn).read())
+        assert_equals(0, os.stat(req_fn).st_mtime)
+
     def test_filename_replacement(self):
         req = "Example debian postinstall file"
         req_fn = os.path.join(self.tmp, 'debian-postinstal-for-package-branch-{{ branch }}.postinstall') 
@@ -122,6 +362,102 @@ class TestTemplateReplacement(object):
 
         rmtree(self.tmp)
 
+class TestBuildContext(object):
+    def setUp(self):
+        self.tmp = mkdtemp('test-build-')
+        self.calls = []
+
+    def get_revision(self):
+        self.calls.append('revision_key')
+        return 'abcdef'
+
+    def test_lazy_variables_computed_only_when_used(self):
+        with open(os.path.join(self.tmp, 'requirements.txt'), 'w') as f:
+            f.write("dependency-{{ version }}")
+
+        context = BuildContext({'version' : '1.0'})
+        context.set_lazy('revision_key', self.get_revision)
+
+        replace_template_files(root_directory=self.tmp, variables=context)
+
+        assert_equals("dependency-1.0", open(os.path.join(self.tmp, 'requirements.txt')).read())
+        assert_equals([], self.calls)
+        assert_equals(set(['version']), context.used_variables)
+
+    def test_lazy_variables_memoized(self):
+        os.mkdir(os.path.join(self.tmp, 'debian'))
+        for fn in ('changelog', 'control'):
+            with open(os.path.join(self.tmp, 'debian', fn), 'w') as f:
+                f.write("{{ revision_key }}")
+        with open(os.path.join(self.tmp, 'debian', 'package-{{ revision_key }}.install'), 'w') as f:
+            f.write("")
+
+        context = BuildContext()
+        context.set_lazy('revision_key', self.get_revision)
+
+        replace_template_files(root_directory=self.tmp, variables=context, workers=2)
+        rename_template_files(root_directory=self.tmp, variables=context)
+
+        assert_equals(['revision_key'], self.calls)
+        assert_equals("abcdef", open(os.path.join(self.tmp, 'debian', 'control')).read())
+        assert_true(os.path.exists(os.path.join(self.tmp, 'debian', 'package-abcdef.install')))
+
+    def test_template_parsed_for_variables_once(self):
+        environment = get_template_environment(self.tmp)
+        parsed = []
+        class CountingEnvironment(object):
+            def parse(self, source):
+                parsed.append(source)
+                return environment.parse(source)
+
+        source = u"{{ version }}-{{ revision_key }}-%s" % self.tmp
+        assert_equals(set(['version', 'revision_key']), get_template_variable_names(CountingEnvironment(), source))
+        assert_equals(set(['version', 'revision_key']), get_template_variable_names(CountingEnvironment(), source))
+        assert_equals(1, len(parsed))
+
+    def test_missing_metadata_attributes_undefined(self):
+        class Metadata(object):
+            branch_suffix = 'feature'
+
+        class Distribution(object):
+            version = '1.2'
+            metadata = Metadata()
+
+        distribution = Distribution()
+        context = get_build_context(distribution)
+
+        assert_equals({'version' : '1.2', 'branch_suffix' : 'feature'}, context.get_variables(['version', 'branch_suffix', 'dependency_versions']))
+        assert_equals(set(['version', 'branch_suffix']), context.used_variables)
+        assert_true(context is get_build_context(distribution))
+
+    def test_version_changed_later_in_build_rendered(self):
+        class Distribution(object):
+            version = '1.2'
+            metadata = object()
+
+        distribution = Distribution()
+        context = get_build_context(distribution)
+        assert_equals('1.2', context['version'])
+
+        distribution.version = '1.3'
+        assert_equals('1.3', context['version'])
+
+    def test_common_variables_are_dictionary(self):
+        class Metadata(object):
+            branch_suffix = 'feature'
+
+        class Distribution(object):
+            version = '1.2'
+            metadata = Metadata()
+
+        variables = get_common_variables(Distribution())
+        assert_equals(dict, type(variables))
+        assert_equals('1.2', variables.get('version'))
+        assert_equals('feature', variables['branch_suffix'])
+
+    def tearDown(self):
+        rmtree(self.tmp)
+
 class TestBuildtimeTemplateReplacements(BuildTestCase):
     PROJECT_VERSION_TAG = '1.1'
 
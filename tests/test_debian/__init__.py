@@ -13,6 +13,7 @@ from citools.debian.commands import (
     replace_versioned_debian_files,
     get_tzdiff,
 )
+from citools.version import DependencySession
 from citools.debian.control import ControlFile
 
 
@@ -117,6 +118,8 @@ class TestUpdateDependencyVersions(object):
         check_call(['git', 'commit', '-m', 'meta control file'], stdout=PIPE, stdin=PIPE)
         os.chdir(self.oldcwd)
 
+        self.session = DependencySession(workdir=mkdtemp(prefix='test_session_'), fetch_options={'cache_config_dir' : False})
+
     def create_repository(self, repository_dir, project_name, tag_number):
         os.chdir(repository_dir)
 
@@ -175,12 +178,55 @@ class TestUpdateDependencyVersions(object):
         assert_equals(expected_control_output.strip(), open(self.test_control).read().strip())
 
 
+    def test_every_dependency_fetched_once(self):
+        repositories = [
+            {
+                'url': self.repo1,
+                'branch': 'master',
+                'package_name': self.package1_name,
+            },
+            {
+                'url': self.repo2,
+                'branch': 'master',
+                'package_name': self.package2_name,
+            },
+        ]
+
+        update_dependency_versions(repositories, self.test_control, workdir=self.metarepo, session=self.session)
+
+        assert_equals(2, len(os.listdir(self.session.repositories_dir)))
+        assert_equals({(self.repo1, 'master') : (0, 1, 1), (self.repo2, 'master') : (0, 2, 1)}, self.session.versions)
+
+    def test_dependency_graph_changes_reported(self):
+        repositories = [
+            {
+                'url': self.repo1,
+                'branch': 'master',
+                'package_name': self.package1_name,
+            },
+            {
+                'url': self.repo2,
+                'branch': 'master',
+                'package_name': self.package2_name,
+            },
+        ]
+        graph_path = os.path.join(self.session.workdir, 'dependency-graph')
+
+        changes = update_dependency_versions(repositories, self.test_control, workdir=self.metarepo, session=self.session, graph_path=graph_path)
+
+        assert_equals(7, len(changes['added']))
+        assert_equals('centrum-python-metapackage-bbb', changes['affected'][-1])
+
+        changes = update_dependency_versions(repositories, self.test_control, workdir=self.metarepo, session=self.session, graph_path=graph_path)
+        assert_equals([], changes['affected'])
+
     def tearDown(self):
         os.chdir(self.oldcwd)
 
         rmtree(self.repo1)
         rmtree(self.repo2)
         rmtree(self.metarepo)
+        rmtree(self.session.workdir)
 
 
 class TestVersionedStatic(object):
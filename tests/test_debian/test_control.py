@@ -1,10 +1,14 @@
 from nose.tools import assert_equals, assert_raises, assert_true
+from pyparsing import ParserElement
 
 from citools.debian.control import (
     ControlFileParagraph, SourceParagraph,
     Dependency, ControlFile, PackageParagraph,
-    get_dependency,
+    get_dependency, get_grammar, build_paragraph_grammar,
+    tokenize_paragraph, iter_packages, Alternatives,
+    compare_versions, get_version_key,
 )
+from StringIO import StringIO
 
 # {{{  Test ControlFileParagraph generic parsing
 ##############################################################################
@@ -54,6 +58,23 @@ def test_comments_are_ignored():
     par = ControlFileParagraph(source)
     assert_equals('value1', par['key1'])
 
+def test_grammar_built_only_once():
+    assert get_grammar(build_paragraph_grammar) is get_grammar(build_paragraph_grammar)
+
+def test_tokenizer_matches_grammar():
+    source = '# comment\nkey1: value1\nkey2:   value  \n  on more\n lines\n#\nkey3:\n'
+    rows = get_grammar(build_paragraph_grammar).parseString(source, True)
+    assert_equals([(row.key, row.value) for row in rows], tokenize_paragraph(source))
+
+def test_odd_paragraph_left_for_grammar():
+    assert_equals(None, tokenize_paragraph('key1: value\n\tcontinued by tab'))
+    assert_equals('value        continued by tab', ControlFileParagraph('key1: value\n\tcontinued by tab')['key1'])
+
+def test_parsing_does_not_change_default_whitespace():
+    default = ParserElement.DEFAULT_WHITE_CHARS
+    ControlFileParagraph('key1: value1')
+    assert_equals(default, ParserElement.DEFAULT_WHITE_CHARS)
+
 ##############################################################################
 # }}}
 
@@ -162,6 +183,37 @@ def test_provides_parsed():
     parsed = PackageParagraph('').parse_provides(package)
     assert_equals(2, len(parsed))
 
+def test_dependency_alternatives_parsed_without_spaces():
+    parsed = PackageParagraph('').parse_depends('package(>=1.0~rc1)|other,${misc:Depends}')
+    assert_equals(['package (>= 1.0~rc1) | other', '${misc:Depends}'], [str(d) for d in parsed])
+
+def test_dependency_alternatives_grouped():
+    parsed = PackageParagraph('').parse_depends('a | b (>= 1.0) | c, d')
+    assert_equals(2, len(parsed))
+    assert isinstance(parsed[0], Alternatives)
+    assert_equals(['a', 'b', 'c'], [d.name for d in parsed[0]])
+    assert_equals('d', parsed[1].name)
+
+def test_dependency_alternatives_grouped_by_grammar():
+    # tab makes tokenizer give up
+    parsed = PackageParagraph('').parse_depends('a |\tb, c')
+    assert_equals(['a | b', 'c'], [str(d) for d in parsed])
+
+def test_relations_are_compact():
+    d = get_dependency('ella', '=', '1.0')
+    assert_raises(AttributeError, setattr, d, 'extra', 1)
+    assert d.name is get_dependency('ella').name
+    assert_raises(AttributeError, setattr, Alternatives([d]), 'extra', 1)
+
+def test_dump_round_trips_relations():
+    package = 'Package: package\nDepends: a (>= 1.0) | b, ${misc:Depends}, c-1.0\nProvides: d, e-2.0'
+    dumped = PackageParagraph(package).dump()
+    assert_equals(package, dumped)
+    assert_equals(dumped, PackageParagraph(dumped).dump())
+
+def test_malformed_dependency_rejected():
+    assert_raises(Exception, PackageParagraph('').parse_depends, 'package (>> 1.0)')
+
 ##############################################################################
 # }}}
 
@@ -318,10 +370,135 @@ Description: package with static files without version in path
     assert_equals([l.strip() for l in debian_control.splitlines()], [l.strip() for l in cfile.dump().splitlines()])
 
 
+def test_control_file_streamed_from_file_object():
+    cfile = master_control_content_pattern % {
+        'package1_name': 'package1',
+        'package2_name': 'package2',
+        'package1_version': '0.1.0',
+        'package2_version': '0.2.1',
+        'metapackage_version': '0.10.0',
+    }
+    cf = ControlFile(fileobj=StringIO(cfile))
+    assert_equals(cfile.strip(), cf.dump())
+
+def test_packages_index_streamed():
+    index = 'Package: first\nVersion: 1.0\n\n\nPackage: second\nDepends: first (>= 1.0)\n'
+    packages = iter_packages(StringIO(index))
+    assert_equals('first', packages.next()['package'].name)
+    assert_equals(['first (>= 1.0)'], [str(d) for d in packages.next()['depends']])
+    assert_raises(StopIteration, packages.next)
+
+def _get_master_control_file():
+    return ControlFile(master_control_content_pattern % {
+        'package1_name': 'package1',
+        'package2_name': 'package2',
+        'package1_version': '0.1.0',
+        'package2_version': '0.2.1',
+        'metapackage_version': '0.10.0',
+    })
+
+def test_same_names_shared_in_control_file():
+    cf = _get_master_control_file()
+    assert_true(cf.packages[0]['package'].name is cf.packages[1]['depends'][2].name)
+
+def test_relation_index_maps_names_to_all_references():
+    cf = _get_master_control_file()
+    index = cf.get_relation_index('depends')
+    assert_equals(5, len(index))
+    assert_equals(['centrum-python-metapackage-aaa (= 0.10.0)'], [str(d) for d in index['centrum-python-metapackage-aaa']])
+
+def test_relation_index_reused_until_relations_change():
+    cf = _get_master_control_file()
+    index = cf.get_relation_index('depends')
+    assert cf.get_relation_index('depends') is index
+
+    cf.packages[0]['depends'].append(get_dependency('appended'))
+    assert_equals(1, len(cf.get_relation_index('depends')['appended']))
+
+    cf.packages[1]['depends'] = [get_dependency('replaced')]
+    assert_equals(['replaced'], [str(d) for d in cf.get_relation_index('depends')['replaced']])
+    assert 'centrum-python-package1-bbb' not in cf.get_relation_index('depends')
+
+def test_relation_index_updated_after_relation_replaced_in_place():
+    cf = _get_master_control_file()
+    cf.get_relation_index('depends')
+    cf.packages[1]['depends'][0] = get_dependency('replaced')
+    assert_equals(['replaced'], [str(d) for d in cf.get_relation_index('depends')['replaced']])
+
+def test_relation_index_updated_after_relation_removed_in_place():
+    cf = _get_master_control_file()
+    cf.get_relation_index('depends')
+    del cf.packages[1]['depends'][:]
+    assert 'centrum-python-package1-bbb' not in cf.get_relation_index('depends')
+
+def test_relation_index_kept_after_versions_replaced():
+    cf = _get_master_control_file()
+    index = cf.get_relation_index('depends')
+    cf.replace_dependencies([get_dependency('centrum-python-package1-aaa', '=', '0.3.0')])
+    assert cf.get_relation_index('depends') is index
+
+def test_dependencies_replaced_in_document_order():
+    cf = _get_master_control_file()
+    before = cf.dump()
+    deps = [get_dependency('centrum-python-package2-bbb', '=', '0.0.1'), get_dependency('centrum-python-package1-bbb', '=', '0.3.0')]
+    assert_raises(ValueError, cf.replace_dependencies, deps)
+    assert_equals(before.replace('centrum-python-package1-bbb (= 0.1.0)', 'centrum-python-package1-bbb (= 0.3.0)', 1), cf.dump())
+
+def test_relation_index_updated_with_new_package():
+    cf = _get_master_control_file()
+    cf.get_relation_index('depends')
+    cf.add_package('Package: new\nDepends: centrum-python-package1-aaa (= 0.1.0)')
+    assert_equals(2, len(cf.get_relation_index('depends')['centrum-python-package1-aaa']))
+
+def test_dependencies_replaced_through_index():
+    cf = _get_master_control_file()
+    cf.replace_dependencies([get_dependency('centrum-python-package1-aaa', '=', '0.3.0'), get_dependency('unknown', '=', '1.0')])
+    assert_equals(
+        ['centrum-python-package1-aaa (= 0.3.0)', 'centrum-python-package2-aaa (= 0.2.1)'],
+        [str(d) for d in cf.get_dependencies()][:2]
+    )
+
 def test_upgrade_to_multicipher_version_passes_downgrade_check():
     cfile = ControlFile()
     assert_true(cfile.check_downgrade('0.5.0.0', '0.17.0.114'))
 
+def test_downgrade_detected():
+    cfile = ControlFile()
+    assert_raises(ValueError, cfile.check_downgrade, '0.17.0.114', '0.5.0.0')
+    assert_raises(ValueError, cfile.check_downgrade, '1.0.3', '1.0.3~bpo50+1')
+    assert_true(cfile.check_downgrade('1.0.3~bpo50+1', '1.0.3'))
+    assert_true(cfile.check_downgrade('1.0.3', '1.0.3'))
+
+def test_invalid_version_fails_downgrade_check():
+    assert_raises(ValueError, ControlFile().check_downgrade, '', '1.0')
+
+def test_versions_compared_like_dpkg():
+    for lower, higher in [
+        ('1.0', '1.0.0'),
+        ('1.0~rc1', '1.0'),
+        ('1.0~~', '1.0~'),
+        ('1.0', '1.0a'),
+        ('1.0a', '1.0+b1'),
+        ('2.0', '10.0'),
+        ('9.9', '1:0.1'),
+        ('1.0-1', '1.0-1+b1'),
+        ('1.0-1~bpo50+1', '1.0-1'),
+        ('1.0-9', '1.0.1-1'),
+    ]:
+        assert_true(compare_versions(lower, higher) < 0, "%s is not lower than %s" % (lower, higher))
+        assert_true(compare_versions(higher, lower) > 0, "%s is not higher than %s" % (higher, lower))
+
+def test_equal_versions():
+    for version, other in [('1.0', '1.00'), ('0:1.0', '1.0'), ('1.0-0', '1.0')]:
+        assert_equals(0, compare_versions(version, other))
+
+def test_versions_sorted_by_key():
+    assert_equals(['1:0.1', '1.0-1', '1.0~rc1', '0.9'][::-1], sorted(['1.0-1', '1:0.1', '0.9', '1.0~rc1'], key=get_version_key))
+
+def test_invalid_versions_rejected():
+    for version in ['', 'a:1.0', '1.0-', '1:', '1.0-1:1']:
+        assert_raises(ValueError, get_version_key, version)
+
 def test_versioned_package_in_provides_replaced():
     debian_control = '''\
 Source: versioned-package
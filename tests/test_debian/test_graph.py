@@ -0,0 +1,110 @@
+from StringIO import StringIO
+
+from nose.tools import assert_equals, assert_raises
+
+from citools.debian.control import ControlFile
+from citools.debian.graph import DependencyGraph, DependencyCycleError
+
+
+control_pattern = """\
+Source: %(name)s
+Section: python
+
+Package: %(name)s
+Architecture: all
+Depends: %(depends)s
+Provides: %(provides)s
+Description: %(name)s
+"""
+
+def get_graph(packages):
+    """ Return graph from {name : (version, depends, provides)} """
+    graph = DependencyGraph()
+    for name, (version, depends, provides) in packages.items():
+        graph.add_control_file(ControlFile(control_pattern % {'name' : name, 'depends' : depends, 'provides' : provides}), version=version, origin=name)
+    return graph
+
+PACKAGES = {
+    'base' : ('1.0', 'python (>= 2.5)', ''),
+    'lib' : ('1.0', 'base (>= 1.0)', 'virtual-lib'),
+    'app' : ('2.0', 'virtual-lib, other | base', ''),
+    'meta' : ('3.0', 'app (= 2.0)', ''),
+}
+
+# {{{  Test ordering
+##############################################################################
+
+def test_dependencies_ordered_first():
+    assert_equals(['base', 'lib', 'app', 'meta'], get_graph(PACKAGES).get_topological_order())
+
+def test_provides_and_alternatives_resolved():
+    assert_equals(set(['lib', 'base']), get_graph(PACKAGES).get_edges()['app'])
+
+def test_cycle_detected():
+    packages = dict(PACKAGES)
+    packages['base'] = ('1.0', 'meta', '')
+    graph = get_graph(packages)
+    assert_equals([['app', 'base', 'lib', 'meta']], graph.find_cycles())
+    assert_raises(DependencyCycleError, graph.get_topological_order)
+
+def test_self_dependency_is_cycle():
+    assert_equals([['base']], get_graph({'base' : ('1.0', 'base', '')}).find_cycles())
+
+def test_no_cycles_in_acyclic_graph():
+    assert_equals([], get_graph(PACKAGES).find_cycles())
+
+def test_versioned_packages_are_separate_packages():
+    graph = DependencyGraph()
+    graph.add_control_file(ControlFile("""\
+Source: static
+
+Package: static
+Depends: static-1.0
+
+Package: static-1.0
+Depends:
+"""))
+    assert_equals(['static-1.0', 'static'], graph.get_topological_order())
+
+##############################################################################
+# }}}
+
+
+# {{{  Test changes
+##############################################################################
+
+def test_dependents_affected_by_change():
+    packages = dict(PACKAGES)
+    packages['lib'] = ('1.1', 'base (>= 1.0)', 'virtual-lib')
+    changes = get_graph(packages).get_changes(get_graph(PACKAGES))
+    assert_equals(['lib'], changes['changed'])
+    assert_equals(['lib', 'app', 'meta'], changes['affected'])
+
+def test_removed_package_affects_dependents():
+    packages = dict(PACKAGES)
+    del packages['lib']
+    changes = get_graph(packages).get_changes(get_graph(PACKAGES))
+    assert_equals(['lib'], changes['removed'])
+    assert_equals(['app', 'meta'], changes['affected'])
+
+def test_nothing_affected_without_change():
+    changes = get_graph(PACKAGES).get_changes(get_graph(PACKAGES))
+    assert_equals({'added' : [], 'removed' : [], 'changed' : [], 'affected' : []}, changes)
+
+def test_everything_added_to_empty_graph():
+    assert_equals(['base', 'lib', 'app', 'meta'], get_graph(PACKAGES).get_changes(DependencyGraph())['affected'])
+
+def test_unsatisfied_versions_reported():
+    packages = dict(PACKAGES)
+    packages['meta'] = ('3.0', 'app (>= 2.0~rc1), base (> 1.0) | lib (= 1.0), base (> 1.0)', '')
+    assert_equals([('meta', 'base (> 1.0)', '1.0')], [(p, str(d), v) for p, d, v in get_graph(packages).get_unsatisfied()])
+
+def test_dumped_graph_loaded():
+    graph = get_graph(PACKAGES)
+    loaded = DependencyGraph.load(StringIO(graph.dump()))
+    assert_equals(graph.dump(), loaded.dump())
+    assert_equals('app', loaded.origins['app'])
+    assert_equals([], graph.get_changes(loaded)['affected'])
+
+##############################################################################
+# }}}
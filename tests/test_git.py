@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 from ConfigParser import SafeConfigParser
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 from subprocess import Popen, PIPE
 from shutil import rmtree
+from StringIO import StringIO
 from tempfile import mkdtemp, mkstemp
 from unittest import TestCase
 
 from nose.plugins.skip import SkipTest
 
-from citools.git import retrieve_repository_metadata, fetch_repository, filter_parse_date
-from citools.version import get_current_branch
+from citools.git import retrieve_repository_metadata, fetch_repository, filter_parse_date, parse_git_date, parse_git_local_date, get_remote_tags, get_shallow_commits, get_mirror_path, deepen_repository, get_clone_url
+from citools.git import iter_revision_metadata, get_revision_metadata, read_nul_separated, iter_batches
+from citools.git import iter_repository_metadata, read_repositories_config
+from citools.pool import map_in_pool
+from citools.version import get_current_branch, get_git_describe
 
 from helpers import GitTestCase
 
@@ -25,9 +29,44 @@ class TestDateParsing(TestCase):
     def test_tz_parsed(self):
         self.assertEquals(datetime(2009, 12, 1, 20, 58, 01), filter_parse_date('Tue Dec 1 20:58:01 2009 +0100'))
     
+    def test_month_names_parsed_without_locale(self):
+        self.assertEquals([datetime(2010, month, 9, 8, 7, 6) for month in xrange(1, 13)],
+            [filter_parse_date('Mon %s 9 08:07:06 2010' % name) for name in ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']])
+
+    def test_unknown_month_raises_error(self):
+        self.assertRaises(ValueError, filter_parse_date, 'Tue Pro 1 20:58:01 2009')
+
+    def test_iso_date_parsed_with_timezone(self):
+        date = parse_git_date('2009-12-01 20:58:01 +0100')
+        self.assertEquals(datetime(2009, 12, 1, 20, 58, 1), date.replace(tzinfo=None))
+        self.assertEquals(timedelta(hours=1), date.utcoffset())
+
+    def test_iso_dates_compared_in_utc(self):
+        self.assertEquals(parse_git_date('2009-12-01 19:58:01 +0000'), parse_git_date('2009-12-01 15:28:01 -0430'))
+
+    def test_offsets_shared(self):
+        self.assertTrue(parse_git_date('2009-12-01 19:58:01 +0200').tzinfo is parse_git_date('2010-01-01 00:00:00 +0200').tzinfo)
+
+    def test_local_date_naive_as_stored_before(self):
+        date = parse_git_local_date('2009-12-01 15:28:01 -0430')
+        self.assertEquals(None, date.tzinfo)
+        self.assertEquals(datetime.fromtimestamp(1259697481), date)
+
+    def test_malformed_iso_date_raises_error(self):
+        self.assertRaises(ValueError, parse_git_date, 'Tue Dec 1 20:58:01 2009 +0100')
+        self.assertRaises(ValueError, parse_git_date, '2009-12-01 20:58:01 0100')
+
     def tearDown(self):
         super(TestDateParsing, self).tearDown()
 
+class TestBatching(TestCase):
+
+    def test_last_batch_shorter(self):
+        self.assertEquals([[0, 1], [2, 3], [4]], list(iter_batches(xrange(0, 5), 2)))
+
+    def test_empty_input_yields_nothing(self):
+        self.assertEquals([], list(iter_batches([], 2)))
+
 class TestGitBranchParsing(TestCase):
 
     def test_no_branch_raises_error(self):
@@ -121,6 +160,157 @@ cache_dir = %s
         os.chdir(self.oldcwd)
 
 
+class TestShallowRepositoryFetching(GitTestCase):
+
+    def setUp(self):
+        super(TestShallowRepositoryFetching, self).setUp()
+        self._create_git_repository()
+        self.workdir = mkdtemp(prefix="test_git_")
+
+    def _get_describe(self, dir):
+        return get_git_describe(repository_directory=dir, fix_environment=True, accepted_tag_pattern="repo-[0-9]*", use_cache=False)
+
+    def _fetch_shallow(self):
+        return fetch_repository(repository=self.repo, workdir=self.workdir, cache_config_dir=False,
+            shallow=True, accepted_tag_pattern="repo-[0-9]*")
+
+    def test_shallow_clone_deepened_only_to_tag(self):
+        for i in xrange(0, 50):
+            self.commit_file("commit %s" % i, tag=(i == 25) and "repo-1.0" or None)
+
+        dir = self._fetch_shallow()
+
+        self.assertEquals(self._get_describe(self.repo), self._get_describe(dir))
+        self.assertEquals("repo-1.0-24-g", self._get_describe(dir)[:len("repo-1.0-24-g")])
+        self.assertTrue(get_shallow_commits(dir))
+
+    def test_shallow_clone_finds_higher_tag_behind_lower_one(self):
+        for i in xrange(0, 30):
+            tag = {2 : "repo-2.0", 25 : "repo-1.0"}.get(i)
+            self.commit_file("commit %s" % i, tag=tag)
+
+        dir = self._fetch_shallow()
+
+        self.assertEquals(self._get_describe(self.repo), self._get_describe(dir))
+        self.assertEquals("repo-2.0-27-g", self._get_describe(dir)[:len("repo-2.0-27-g")])
+
+    def test_shallow_clone_ignores_higher_tag_on_other_branch(self):
+        for i in xrange(0, 60):
+            self.commit_file("commit %s" % i, tag=(i == 30) and "repo-1.0" or None)
+            if i == 10:
+                self.do_piped_command_for_success(['git', 'branch', 'maintenance'])
+
+        self.do_piped_command_for_success(['git', 'checkout', 'maintenance'])
+        self.commit_file("maintenance", tag="repo-2.0")
+        self.do_piped_command_for_success(['git', 'checkout', 'master'])
+
+        dir = self._fetch_shallow()
+
+        self.assertEquals(self._get_describe(self.repo), self._get_describe(dir))
+        self.assertEquals("repo-1.0-29-g", self._get_describe(dir)[:len("repo-1.0-29-g")])
+        self.assertTrue(get_shallow_commits(dir))
+
+    def test_whole_history_fetched_after_too_many_fetches(self):
+        for i in xrange(0, 50):
+            self.commit_file("commit %s" % i, tag=(i == 5) and "repo-1.0" or None)
+
+        dir = fetch_repository(repository=self.repo, workdir=self.workdir, cache_config_dir=False, shallow=True)
+        deepen_repository(dir, get_clone_url(self.repo), "repo-[0-9]*", max_fetches=1)
+
+        self.assertEquals(set(), get_shallow_commits(dir))
+        self.assertEquals(self._get_describe(self.repo), self._get_describe(dir))
+
+    def test_shallow_clone_without_matching_tag(self):
+        for i in xrange(0, 20):
+            self.commit_file("commit %s" % i)
+
+        dir = self._fetch_shallow()
+
+        self.assertEquals('0.0', self._get_describe(dir))
+        self.assertTrue(get_shallow_commits(dir))
+
+    def test_shallow_clone_of_branch(self):
+        self.commit_file("master", tag="repo-1.0")
+        self.do_piped_command_for_success(['git', 'checkout', '-b', 'testomation'])
+        self.commit_file("testomation")
+        self.do_piped_command_for_success(['git', 'checkout', 'master'])
+
+        dir = fetch_repository(repository=self.repo, workdir=self.workdir, cache_config_dir=False, branch="testomation", shallow=True)
+
+        f = open(os.path.join(dir, 'test.txt'))
+        self.assertEquals("testomation", f.read())
+        f.close()
+
+    def test_remote_tags_listed_with_peeled_commits(self):
+        self.commit_file("first", tag="repo-1.0")
+        tagged = self.do_piped_command_for_success(['git', 'rev-parse', 'HEAD'])[0].strip()
+        self.do_piped_command_for_success(['git', 'tag', 'repo-2.0'])
+        self.do_piped_command_for_success(['git', 'tag', '-a', '-m', 'other', 'other-3.0'])
+
+        self.assertEquals({'repo-1.0' : tagged}, get_remote_tags(self.repo, "repo-[0-9]*"))
+
+    def tearDown(self):
+        rmtree(self.workdir)
+        super(TestShallowRepositoryFetching, self).tearDown()
+
+
+class TestMirrorFetching(GitTestCase):
+
+    def setUp(self):
+        super(TestMirrorFetching, self).setUp()
+        self._create_git_repository()
+        self.mirror_directory = os.path.join(mkdtemp(prefix="test_git_"), "mirrors")
+        self.workdir = mkdtemp(prefix="test_git_")
+        self.first = self.commit_file("first")
+
+    def _fetch(self, **kwargs):
+        return fetch_repository(repository=self.repo, workdir=self.workdir, mirror_directory=self.mirror_directory, **kwargs)
+
+    def _get_head(self, dir):
+        proc = Popen(['git', 'rev-parse', 'HEAD'], stdout=PIPE, cwd=dir)
+        return proc.communicate()[0].strip()
+
+    def test_mirror_created(self):
+        dir = self._fetch()
+        self.assertEquals(self.first, self._get_head(dir))
+        self.assertTrue(os.path.exists(os.path.join(get_mirror_path(self.repo, self.mirror_directory), "HEAD")))
+
+    def test_origin_points_to_repository(self):
+        dir = self._fetch()
+        proc = Popen(['git', 'config', 'remote.origin.url'], stdout=PIPE, cwd=dir)
+        self.assertEquals(self.repo, proc.communicate()[0].strip())
+
+    def test_mirror_updated_on_next_fetch(self):
+        self._fetch()
+        second = self.commit_file("second")
+        self.assertEquals(second, self._get_head(self._fetch()))
+
+    def test_branch_fetched_from_mirror(self):
+        self.do_piped_command_for_success(['git', 'checkout', '-b', 'testomation'])
+        branched = self.commit_file("testomation")
+        self.do_piped_command_for_success(['git', 'checkout', 'master'])
+
+        self.assertEquals(branched, self._get_head(self._fetch(branch="testomation")))
+
+    def test_repository_cache_not_used_with_mirrors(self):
+        cache_dir = mkdtemp(prefix="test_git_")
+        try:
+            self._fetch(cache_config_dir=cache_dir)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, "cached_repositories.ini")))
+        finally:
+            rmtree(cache_dir)
+
+    def test_concurrent_fetches_share_mirror(self):
+        dirs = map_in_pool(lambda i: self._fetch(), range(0, 4), workers=4)
+        self.assertEquals([self.first] * 4, [self._get_head(dir) for dir in dirs])
+        self.assertEquals(1, len([name for name in os.listdir(self.mirror_directory) if name.endswith(".git")]))
+
+    def tearDown(self):
+        rmtree(os.path.dirname(self.mirror_directory))
+        rmtree(self.workdir)
+        super(TestMirrorFetching, self).tearDown()
+
+
 class TestHistoryMetadataRetrieval(GitTestCase):
     def setUp(self):
         TestCase.setUp(self)
@@ -267,3 +457,128 @@ class TestHistoryMetadataRetrieval(GitTestCase):
         self.revisions.append(self.commit(message=u"你好, řeřicha".encode('utf-8')))
 
         self.assertEquals(u"你好, řeřicha", retrieve_repository_metadata(str(self.revisions[len(self.revisions)-1])+"^")[0]['subject'])
+
+class TestStreamingMetadataRetrieval(GitTestCase):
+    # no dates, as they're parsed in locale not necessarily available
+    PROPERTY_MAP = {
+        "%H" : {'name' : "hash"},
+        "%aN" : {'name' : "author_name"},
+        "%B" : {'name' : "body"},
+    }
+
+    def setUp(self):
+        super(TestStreamingMetadataRetrieval, self).setUp()
+        self._create_git_repository()
+
+        self.revisions = []
+        for i in xrange(0, 5):
+            f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+            f.write("change %s" % i)
+            f.close()
+            self.do_piped_command_for_success(["git", "add", "test.txt"])
+            self.revisions.append(self.commit(message="subject %s\n\nbody with\nmore lines and \x1e separators %s" % (i, i)))
+
+    def test_all_commits_streamed_oldest_first(self):
+        self.assertEquals(self.revisions, [m['hash'] for m in iter_revision_metadata([], self.PROPERTY_MAP, repository_uri="test")])
+
+    def test_multiline_properties_kept_together(self):
+        metadata = list(iter_revision_metadata([], self.PROPERTY_MAP, repository_uri="test"))
+        self.assertEquals(u"subject 3\n\nbody with\nmore lines and \x1e separators 3", metadata[3]['body'])
+        author = self.do_piped_command_for_success(["git", "log", "-1", "--format=%aN", self.revisions[3]])[0].strip()
+        self.assertEquals(author.decode("utf-8"), metadata[3]['author_name'])
+        self.assertEquals("test", metadata[3]['repository_uri'])
+
+    def test_range_streamed(self):
+        self.assertEquals(self.revisions[3:], [m['hash'] for m in iter_revision_metadata(["%s.." % self.revisions[2]], self.PROPERTY_MAP, repository_uri="test")])
+
+    def test_small_chunks_reassembled(self):
+        stream = StringIO("a\0bc\0\0d")
+        self.assertEquals(["a", "bc", "", "d"], list(read_nul_separated(stream, chunk_size=1)))
+
+    def test_unfinished_stream_does_not_block(self):
+        stream = iter_revision_metadata([], self.PROPERTY_MAP, repository_uri="test")
+        self.assertEquals(self.revisions[0], stream.next()['hash'])
+        stream.close()
+
+    def test_single_revision_metadata(self):
+        self.assertEquals(self.revisions[1], get_revision_metadata(self.revisions[1], self.PROPERTY_MAP, repository_uri="test")['hash'])
+
+    def test_failed_revision_metadata(self):
+        self.assertEquals("[failed to retrieve]", get_revision_metadata("nonexistent", self.PROPERTY_MAP, repository_uri="test")['hash'])
+
+    def _commit_at(self, content, timestamp):
+        f = open(os.path.join(self.repo, '%s.txt' % content), 'wb')
+        f.write(content)
+        f.close()
+        self.do_piped_command_for_success(["git", "add", "%s.txt" % content])
+        os.environ['GIT_COMMITTER_DATE'] = "%s +0000" % timestamp
+        try:
+            return self.commit(message=content)
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+
+    def test_resuming_after_any_commit_misses_nothing(self):
+        # commit dates are skewed so that date order puts branch tip before it's parent
+        base = self._commit_at("base", 1300000000)
+        self.do_piped_command_for_success(["git", "checkout", "-b", "skewed"])
+        self._commit_at("skewed", 1200000000)
+        self.do_piped_command_for_success(["git", "checkout", "master"])
+        self._commit_at("master", 1250000000)
+        self.do_piped_command_for_success(["git", "merge", "skewed", "-m", "merge"])
+
+        hashes = [m['hash'] for m in iter_revision_metadata([base + "^.."], self.PROPERTY_MAP, repository_uri="test")]
+        self.assertEquals(base, hashes[0])
+
+        for i in xrange(1, len(hashes)):
+            rest = [m['hash'] for m in iter_revision_metadata(["%s..%s" % (hashes[i-1], "HEAD"), "^%s^" % base], self.PROPERTY_MAP, repository_uri="test")]
+            missed = set(hashes) - set(hashes[:i]) - set(rest)
+            self.assertEquals(set(), missed)
+
+    def test_repository_directory_streamed_from_elsewhere(self):
+        os.chdir(self.oldcwd)
+        metadata = list(iter_repository_metadata(None, repository_uri="test", metadata_property_map=self.PROPERTY_MAP, repository_directory=self.repo))
+        self.assertEquals(self.revisions, [m['hash'] for m in metadata])
+
+    def test_repository_streamed_up_to_given_head(self):
+        os.chdir(self.oldcwd)
+        metadata = list(iter_repository_metadata(self.revisions[1], repository_uri="test", metadata_property_map=self.PROPERTY_MAP, repository_directory=self.repo, head=self.revisions[3]))
+        self.assertEquals(self.revisions[2:4], [m['hash'] for m in metadata])
+
+class TestRepositoriesConfig(TestCase):
+
+    def setUp(self):
+        self.config = mkstemp(suffix=".ini")[1]
+
+    def _write_config(self, content):
+        f = open(self.config, 'w')
+        f.write(content)
+        f.close()
+
+    def test_path_and_url_repositories_read(self):
+        self._write_config("[local]\npath = /srv/repo\nbranch = stable\n\n[remote]\nurl = git://example.com/repo.git\n")
+        repositories = dict([(r['name'], r) for r in read_repositories_config(self.config, mirror_directory="/tmp/mirrors")])
+
+        self.assertEquals("/srv/repo", repositories['local']['uri'])
+        self.assertEquals("stable", repositories['local']['branch'])
+        self.assertEquals("git://example.com/repo.git", repositories['remote']['uri'])
+        self.assertEquals(None, repositories['remote']['branch'])
+
+    def test_uri_overrides_location(self):
+        self._write_config("[local]\npath = /srv/repo\nuri = git://example.com/repo.git\n")
+        self.assertEquals("git://example.com/repo.git", read_repositories_config(self.config)[0]['uri'])
+
+    def test_repository_without_location_rejected(self):
+        self._write_config("[broken]\nbranch = master\n")
+        self.assertRaises(ValueError, read_repositories_config, self.config)
+
+    def test_url_without_mirror_directory_rejected(self):
+        self._write_config("[remote]\nurl = git://example.com/repo.git\n")
+        old = os.environ.pop('CITOOLS_MIRROR_DIRECTORY', None)
+        try:
+            self.assertRaises(ValueError, read_repositories_config, self.config)
+        finally:
+            if old is not None:
+                os.environ['CITOOLS_MIRROR_DIRECTORY'] = old
+
+    def tearDown(self):
+        os.remove(self.config)
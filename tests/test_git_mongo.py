@@ -1,9 +1,10 @@
 from datetime import datetime
+import os
 
-from citools.git import get_last_revision, store_repository_metadata
+from citools.git import get_last_revision, store_repository_metadata, get_high_water_marks, ingest_repositories
 
 from copy import deepcopy
-from helpers import MongoTestCase
+from helpers import MongoTestCase, GitTestCase
 
 class TestLastStoreRetrieval(MongoTestCase):
 
@@ -69,3 +70,167 @@ class TestLastStoreRetrieval(MongoTestCase):
         self.assertEquals('overrulled', self.collection.find_one({
             'hash_abbrev' : self.changeset['hash_abbrev']
         })['commiter_name'])
+
+class TestBulkStoring(MongoTestCase):
+
+    def setUp(self):
+        super(TestBulkStoring, self).setUp()
+        self.collection = self.database['repository_information']
+
+    def _get_changesets(self, count, repository_uri="repo"):
+        return [{
+            "hash" : "%040x" % i,
+            "repository_uri" : repository_uri,
+            "subject" : "subject %s" % i,
+        } for i in xrange(0, count)]
+
+    def test_all_batches_stored(self):
+        store_repository_metadata(self.collection, iter(self._get_changesets(25)), batch_size=10)
+        self.assertEquals(25, self.collection.find({'repository_uri' : 'repo'}).count())
+
+    def test_stored_changesets_updated(self):
+        store_repository_metadata(self.collection, self._get_changesets(5), batch_size=2)
+
+        changesets = self._get_changesets(10)
+        changesets[3]['subject'] = 'overrulled'
+        store_repository_metadata(self.collection, changesets, batch_size=4)
+
+        self.assertEquals(10, self.collection.find().count())
+        self.assertEquals('overrulled', self.collection.find_one({'hash' : changesets[3]['hash']})['subject'])
+
+    def test_same_changeset_in_one_batch_stored_once(self):
+        changesets = self._get_changesets(2) + self._get_changesets(1)
+        changesets[2]['subject'] = 'later'
+        store_repository_metadata(self.collection, changesets)
+
+        self.assertEquals(2, self.collection.find().count())
+        self.assertEquals('later', self.collection.find_one({'hash' : changesets[0]['hash']})['subject'])
+
+    def test_repositories_sharing_changeset_stored_separately(self):
+        store_repository_metadata(self.collection, self._get_changesets(3, repository_uri="repo"))
+        store_repository_metadata(self.collection, self._get_changesets(3, repository_uri="fork"))
+
+        self.assertEquals(3, self.collection.find({'repository_uri' : 'fork'}).count())
+        self.assertEquals(3, self.collection.find({'repository_uri' : 'repo'}).count())
+
+    def test_unique_index_created(self):
+        store_repository_metadata(self.collection, self._get_changesets(1))
+        keys = [index['key'] for index in self.collection.index_information().values()]
+        self.assertTrue([('repository_uri', 1), ('hash', 1)] in [list(key) for key in keys])
+
+class TestIndexedLastRevision(MongoTestCase):
+
+    def setUp(self):
+        super(TestIndexedLastRevision, self).setUp()
+        self.collection = self.database['repository_information']
+        self.changesets = [{
+            "hash" : "%040x" % i,
+            "repository_uri" : "repo",
+            "subject" : "subject %s" % i,
+        } for i in xrange(0, 7)]
+
+    def test_changesets_numbered_in_ingestion_order(self):
+        store_repository_metadata(self.collection, self.changesets, batch_size=3)
+        sequences = [self.collection.find_one({'hash' : c['hash']})['sequence'] for c in self.changesets]
+        self.assertEquals(range(1, 8), sequences)
+
+    def test_last_revision_taken_from_high_water_mark(self):
+        store_repository_metadata(self.collection, self.changesets, batch_size=3)
+        self.assertEquals(self.changesets[-1]['hash'], get_last_revision(self.collection, repository_uri="repo"))
+        self.assertEquals(self.changesets[-1]['hash'], get_high_water_marks(self.collection).find_one({'_id' : 'repo'})['hash'])
+
+    def test_updating_old_changeset_keeps_last_revision(self):
+        store_repository_metadata(self.collection, self.changesets)
+        store_repository_metadata(self.collection, [dict(self.changesets[2], subject='overrulled')])
+        self.assertEquals(self.changesets[-1]['hash'], get_last_revision(self.collection, repository_uri="repo"))
+
+    def test_last_revision_found_by_sequence_without_high_water_mark(self):
+        store_repository_metadata(self.collection, self.changesets)
+        get_high_water_marks(self.collection).remove({'_id' : 'repo'})
+        self.assertEquals(self.changesets[-1]['hash'], get_last_revision(self.collection, repository_uri="repo"))
+
+    def test_repositories_numbered_separately(self):
+        store_repository_metadata(self.collection, self.changesets)
+        store_repository_metadata(self.collection, [dict(self.changesets[0], repository_uri="fork")])
+        self.assertEquals(1, self.collection.find_one({'repository_uri' : 'fork'})['sequence'])
+        self.assertEquals(self.changesets[0]['hash'], get_last_revision(self.collection, repository_uri="fork"))
+
+class TestResumableStoring(MongoTestCase):
+
+    def setUp(self):
+        super(TestResumableStoring, self).setUp()
+        self.collection = self.database['repository_information']
+        self.changesets = [{
+            "hash" : "%040x" % i,
+            "repository_uri" : "repo",
+            "subject" : "subject %s" % i,
+        } for i in xrange(0, 10)]
+
+    def _interrupted_stream(self, count):
+        for changeset in self.changesets[:count]:
+            yield changeset
+        raise IOError("Connection to repository lost")
+
+    def test_interrupted_storing_keeps_finished_batches(self):
+        self.assertRaises(IOError, store_repository_metadata, self.collection, self._interrupted_stream(7), batch_size=3)
+
+        self.assertEquals(6, self.collection.find().count())
+        self.assertEquals(self.changesets[5]['hash'], get_last_revision(self.collection, repository_uri="repo"))
+
+    def test_resumed_storing_continues_after_checkpoint(self):
+        self.assertRaises(IOError, store_repository_metadata, self.collection, self._interrupted_stream(7), batch_size=3)
+
+        last = get_last_revision(self.collection, repository_uri="repo")
+        rest = self.changesets[[c['hash'] for c in self.changesets].index(last)+1:]
+
+        checkpoints = []
+        self.assertEquals(4, store_repository_metadata(self.collection, rest, batch_size=3, checkpoint=checkpoints.append))
+
+        self.assertEquals(10, self.collection.find().count())
+        self.assertEquals([3, 1], [len(batch) for batch in checkpoints])
+        self.assertEquals(self.changesets[-1]['hash'], get_last_revision(self.collection, repository_uri="repo"))
+
+class TestParallelIngestion(MongoTestCase, GitTestCase):
+
+    def setUp(self):
+        super(TestParallelIngestion, self).setUp()
+        self.collection = self.database['repository_information']
+        self._create_git_repository()
+        self.revisions = []
+        for i in xrange(0, 3):
+            f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+            f.write("change %s" % i)
+            f.close()
+            self.do_piped_command_for_success(["git", "add", "test.txt"])
+            self.revisions.append(self.commit(message="change %s" % i))
+        os.chdir(self.oldcwd)
+
+        self.repositories = [
+            {'name' : 'first', 'path' : self.repo, 'url' : None, 'uri' : 'first', 'branch' : None},
+            {'name' : 'second', 'path' : self.repo, 'url' : None, 'uri' : 'second', 'branch' : self.revisions[1]},
+        ]
+
+    def test_repositories_ingested_concurrently(self):
+        reports = ingest_repositories(self.collection, self.repositories, workers=2)
+
+        self.assertEquals([3, 2], [report['changesets'] for report in reports])
+        self.assertEquals(self.revisions[-1], get_last_revision(self.collection, repository_uri="first"))
+        self.assertEquals(self.revisions[1], get_last_revision(self.collection, repository_uri="second"))
+
+    def test_up_to_date_repository_has_no_lag(self):
+        ingest_repositories(self.collection, self.repositories, workers=2)
+        reports = ingest_repositories(self.collection, self.repositories, workers=2)
+
+        self.assertEquals([0, 0], [report['changesets'] for report in reports])
+        self.assertEquals([None, None], [report['lag'] for report in reports])
+
+    def test_failing_repository_does_not_stop_others(self):
+        self.repositories[0]['path'] = os.path.join(self.repo, 'nonexistent')
+        reports = ingest_repositories(self.collection, self.repositories, workers=2)
+
+        self.assertTrue('error' in reports[0])
+        self.assertEquals(2, reports[1]['changesets'])
+
+    def tearDown(self):
+        MongoTestCase.tearDown(self)
+        GitTestCase.tearDown(self)
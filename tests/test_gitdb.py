@@ -0,0 +1,171 @@
+import os
+from unittest import TestCase
+
+from citools.gitdb import (
+    get_git_dir, resolve_ref, get_refs_fingerprint,
+    open_repository, parse_commit, apply_delta,
+)
+from citools.version import (
+    get_git_head_tstamp, retrieve_current_branch, get_git_describe_highest,
+    get_git_tag_refs,
+)
+
+from helpers import GitTestCase
+
+class TestRefsReading(GitTestCase):
+
+    def setUp(self):
+        super(TestRefsReading, self).setUp()
+        self._create_git_repository()
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+
+        self.do_piped_command_for_success(['git', 'add', '*'])
+        self.revision = self.commit()
+        self.git_dir = os.path.join(os.path.realpath(self.repo), '.git')
+
+    def test_git_dir_found_from_subdirectory(self):
+        os.mkdir(os.path.join(self.repo, 'subdir'))
+        self.assertEquals(os.path.realpath(self.git_dir), os.path.realpath(get_git_dir(os.path.join(self.repo, 'subdir'))))
+
+    def test_head_resolved_from_loose_ref(self):
+        self.assertEquals(self.revision, resolve_ref(self.git_dir, "HEAD"))
+
+    def test_head_resolved_from_packed_refs(self):
+        self.do_piped_command_for_success(['git', 'pack-refs', '--all'])
+        self.assertEquals(self.revision, resolve_ref(self.git_dir, "HEAD"))
+
+    def test_detached_head_resolved(self):
+        self.do_piped_command_for_success(['git', 'checkout', self.revision])
+        self.assertEquals(self.revision, resolve_ref(self.git_dir, "HEAD"))
+
+    def test_unborn_branch_not_resolved(self):
+        self.do_piped_command_for_success(['git', 'checkout', '--orphan', 'empty'])
+        self.assertEquals(None, resolve_ref(self.git_dir, "HEAD"))
+
+    def test_fingerprint_changes_with_tags(self):
+        empty = get_refs_fingerprint(self.git_dir)
+        self.do_piped_command_for_success(['git', 'tag', 'tag-1.0'])
+        tagged = get_refs_fingerprint(self.git_dir)
+        self.assertNotEquals(empty, tagged)
+
+        self.do_piped_command_for_success(['git', 'pack-refs', '--all'])
+        self.assertNotEquals(tagged, get_refs_fingerprint(self.git_dir))
+
+    def test_fingerprint_ignores_branches(self):
+        fingerprint = get_refs_fingerprint(self.git_dir)
+        self.do_piped_command_for_success(['git', 'branch', 'new_branch'])
+        self.assertEquals(fingerprint, get_refs_fingerprint(self.git_dir))
+
+
+class TestCommitParsing(TestCase):
+    COMMIT = """tree 9bedf67800b2923982bdf60c89c57ce6b2d9c3d9
+parent 5ae35ebcbb0adc3660f0af891058e4e46dbdc14c
+parent 1754c3f1754c3f1754c3f1754c3f1754c3f1754c
+author Dummy Tester <dummy-tester@example.com> 1259697481 +0100
+committer Other Tester <other@example.com> 1259697482 -0500
+gpgsig -----BEGIN PGP SIGNATURE-----
+ 
+ abcdef
+ -----END PGP SIGNATURE-----
+
+Subject line
+
+Body
+"""
+
+    def test_parents_parsed(self):
+        self.assertEquals(['5ae35ebcbb0adc3660f0af891058e4e46dbdc14c', '1754c3f1754c3f1754c3f1754c3f1754c3f1754c'], parse_commit(self.COMMIT)['parents'])
+
+    def test_signatures_parsed(self):
+        commit = parse_commit(self.COMMIT)
+        self.assertEquals(('Dummy Tester', 'dummy-tester@example.com', 1259697481, '+0100'), commit['author'])
+        self.assertEquals(('Other Tester', 'other@example.com', 1259697482, '-0500'), commit['committer'])
+
+    def test_message_parsed(self):
+        self.assertEquals('Subject line\n\nBody\n', parse_commit(self.COMMIT)['message'])
+
+    def test_delta_applied(self):
+        # copy 5 bytes from offset 6 of base, insert "!"
+        delta = chr(11) + chr(6) + chr(0x80 | 0x01 | 0x10) + chr(6) + chr(5) + chr(1) + '!'
+        self.assertEquals('world!', apply_delta('hello world', delta))
+
+
+class TestObjectDatabase(GitTestCase):
+
+    def setUp(self):
+        super(TestObjectDatabase, self).setUp()
+        self._create_git_repository()
+
+        #        o (HEAD)
+        #        | \
+        #        o  o (repo-1.1)
+        #        |  |
+        #        o (repo-1.2)
+        for i in xrange(0, 3):
+            f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+            f.write("\n".join([str(n) for n in xrange(0, i*100)]))
+            f.close()
+            self.do_piped_command_for_success(['git', 'add', '*'])
+            self.commit(message="commit %s" % i)
+        self.do_piped_command_for_success(['git', 'tag', '-a', '-m', 'tagging', 'repo-1.2'])
+        self.do_piped_command_for_success(['git', 'tag', 'repo-1.5'])
+
+        self.do_piped_command_for_success(['git', 'checkout', '-b', 'branch'])
+        f = open(os.path.join(self.repo, 'branch.txt'), 'wb')
+        f.write("branch")
+        f.close()
+        self.do_piped_command_for_success(['git', 'add', '*'])
+        self.commit(message="branch")
+        self.do_piped_command_for_success(['git', 'tag', '-a', '-m', 'tagging', 'repo-1.1'])
+
+        self.do_piped_command_for_success(['git', 'checkout', 'master'])
+        f = open(os.path.join(self.repo, 'test.txt'), 'ab')
+        f.write("master")
+        f.close()
+        self.commit(message="master")
+        self.do_piped_command_for_success(['git', 'merge', 'branch'])
+
+    def _check_objects_same_as_in_git(self):
+        stdout = self.do_piped_command_for_success(['git', 'cat-file', '--batch-all-objects', '--batch-check'])[0]
+        repository = open_repository()
+        try:
+            for line in stdout.splitlines():
+                sha, type, size = line.split()
+                content = self.do_piped_command_for_success(['git', 'cat-file', type, sha])[0]
+                self.assertEquals((type, content), repository.read_object(sha))
+        finally:
+            repository.close()
+
+    def test_loose_objects_read(self):
+        self._check_objects_same_as_in_git()
+
+    def test_packed_objects_read(self):
+        self.do_piped_command_for_success(['git', 'gc', '--aggressive'])
+        self._check_objects_same_as_in_git()
+
+    def test_annotated_tags_same_as_from_git(self):
+        repository = open_repository()
+        try:
+            self.assertEquals(get_git_tag_refs(), repository.get_annotated_tags())
+        finally:
+            repository.close()
+
+    def _check_same_without_reader(self, function, *args):
+        result = function(*args)
+        os.environ['CITOOLS_NO_GITDB'] = '1'
+        try:
+            self.assertEquals(function(*args), result)
+        finally:
+            del os.environ['CITOOLS_NO_GITDB']
+
+    def test_describe_same_as_from_git(self):
+        self._check_same_without_reader(get_git_describe_highest, 'repo-*')
+
+    def test_timestamp_same_as_from_git(self):
+        self._check_same_without_reader(get_git_head_tstamp)
+
+    def test_branch_same_as_from_git(self):
+        self._check_same_without_reader(retrieve_current_branch)
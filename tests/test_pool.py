@@ -0,0 +1,34 @@
+from threading import currentThread
+from unittest import TestCase
+
+from citools.pool import map_in_pool
+
+def square(x):
+    return x * x
+
+def fail_on_odd(x):
+    if x % 2:
+        raise ValueError("Odd number %s" % x)
+    return x
+
+class TestWorkerPool(TestCase):
+
+    def test_order_of_results_preserved(self):
+        self.assertEquals([square(i) for i in xrange(0, 50)], map_in_pool(square, xrange(0, 50), workers=8))
+
+    def test_order_of_results_preserved_in_processes(self):
+        self.assertEquals([square(i) for i in xrange(0, 10)], map_in_pool(square, xrange(0, 10), workers=3, pool_type="process"))
+
+    def test_single_worker_runs_in_current_thread(self):
+        self.assertEquals([currentThread()] * 3, map_in_pool(lambda x: currentThread(), [1, 2, 3], workers=1))
+
+    def test_first_failure_reraised(self):
+        try:
+            map_in_pool(fail_on_odd, [0, 2, 3, 5], workers=4)
+        except ValueError, e:
+            self.assertEquals("Odd number 3", str(e))
+        else:
+            self.fail("ValueError not raised")
+
+    def test_unknown_pool_type_refused(self):
+        self.assertRaises(ValueError, map_in_pool, square, [1, 2], pool_type="fork")
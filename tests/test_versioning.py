@@ -11,9 +11,11 @@ from tempfile import mkdtemp
 from citools.version import (
     compute_version, get_git_describe, replace_version, compute_meta_version,
     sum_versions, fetch_repository,
-    get_highest_tag, get_tags_from_line,
-    get_branch_suffix,
+    get_highest_tag,
+    get_branch_suffix, describe_highest_version, is_describe_complete,
+    VERSION_CACHE_FILE_NAME, DependencySession, get_dependency_session,
 )
+from citools import version
 
 class TestVersioning(TestCase):
 
@@ -186,6 +188,46 @@ class TestGitVersionRetrieving(TestCase):
             search_pattern='project-[0-9]*',
             expected_result_start='project-0.1-1')
 
+    def test_lightweight_tags_ignored_as_by_git_describe(self):
+        self._check_filtering_works(tag='project-0.1', retag="xxxx",
+            search_pattern='project-[0-9]*',
+            expected_result_start='project-0.1-1')
+        check_call(['git', 'tag', 'project-0.2'])
+
+        self.assertTrue(get_git_describe(accepted_tag_pattern='project-[0-9]*').startswith('project-0.1-1'))
+
+    def test_describe_stored_in_git_directory(self):
+        self.prepare_tagged_repo_with_file(tag='0.1-lol')
+        get_git_describe()
+        self.assertTrue(os.path.exists(os.path.join(self.repo, '.git', VERSION_CACHE_FILE_NAME)))
+
+    def test_stored_describe_used_without_asking_git(self):
+        self.prepare_tagged_repo_with_file(tag='0.1-lol')
+        get_git_describe()
+
+        cache_file = os.path.join(self.repo, '.git', VERSION_CACHE_FILE_NAME)
+        content = open(cache_file).read()
+        f = open(cache_file, 'w')
+        f.write(content.replace('describe = 0.1-lol', 'describe = 0.2-cached'))
+        f.close()
+        version._describe_cache.clear()
+
+        self.assertEquals('0.2-cached', get_git_describe())
+        self.assertEquals('0.1-lol', get_git_describe(use_cache=False))
+
+    def test_describe_with_percent_sign_cached(self):
+        self.prepare_tagged_repo_with_file(tag='0.1%lol')
+        self.assertEquals('0.1%lol', get_git_describe())
+        version._describe_cache.clear()
+        self.assertEquals('0.1%lol', get_git_describe())
+
+    def test_new_tag_invalidates_cache(self):
+        self.prepare_tagged_repo_with_file(tag='0.1-lol')
+        self.assertEquals('0.1-lol', get_git_describe(accepted_tag_pattern='0.*'))
+
+        check_call(['git', 'tag', '-m', '"tagging"', '-a', '0.2-lol'], stdout=PIPE)
+        self.assertEquals('0.2-lol', get_git_describe(accepted_tag_pattern='0.*'))
+
     def tearDown(self):
         # delete temporary repository and restore ENV vars after update
         rmtree(self.repo)
@@ -297,6 +339,105 @@ class TestMetaRepository(TestCase):
             }
         ]))
 
+    def test_computing_meta_version_from_shallow_clones(self):
+        self.assertEquals((3, 1, 72, 2), compute_meta_version(dependency_repositories=[
+            {
+                'url':self.repo_one,
+                'branch' : 'testomation',
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'branch' : 'testomation',
+                'package_name' : 'secondproject',
+            }
+        ], shallow=True))
+
+    def test_computing_meta_version_through_mirrors(self):
+        mirror_directory = mkdtemp(prefix='test_git_')
+        try:
+            self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=[
+                {
+                    'url':self.repo_one,
+                    'package_name' : 'project',
+                },
+                {
+                    'url' : self.repo_two,
+                    'package_name' : 'secondproject',
+                }
+            ], mirror_directory=mirror_directory))
+            self.assertEquals(2, len([name for name in os.listdir(mirror_directory) if name.endswith(".git")]))
+        finally:
+            rmtree(mirror_directory)
+
+    def test_session_reused_between_computations(self):
+        session = DependencySession(fetch_options={'cache_config_dir' : False})
+        repositories = [
+            {
+                'url':self.repo_one,
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'package_name' : 'secondproject',
+            }
+        ]
+        self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=repositories, session=session))
+
+        timings = {}
+        self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=repositories, session=session, timings=timings))
+
+        self.assertEquals(2, len(os.listdir(session.repositories_dir)))
+        self.assertEquals(['project', 'secondproject'], sorted(timings.keys()))
+
+    def test_session_fetches_branches_separately(self):
+        session = DependencySession(fetch_options={'cache_config_dir' : False})
+        repository = {'url' : self.repo_one, 'package_name' : 'project'}
+
+        self.assertEquals((1, 0, 59, 1), session.get_version(repository, 'master'))
+        self.assertEquals((1, 0, 59, 2), session.get_version(repository, 'testomation'))
+        self.assertEquals(2, len(os.listdir(session.repositories_dir)))
+
+    def test_computing_meta_version_sequentially(self):
+        self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=[
+            {
+                'url':self.repo_one,
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'package_name' : 'secondproject',
+            }
+        ], workers=1))
+
+    def test_computing_meta_version_in_process_pool(self):
+        dependency_versions = {}
+        self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=[
+            {
+                'url':self.repo_one,
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'package_name' : 'secondproject',
+            }
+        ], pool_type="process", dependency_versions=dependency_versions))
+        self.assertEquals({'project' : (1, 0, 59, 1), 'secondproject' : (2, 0, 12)}, dependency_versions)
+
+    def test_dependency_timings_reported(self):
+        timings = {}
+        compute_meta_version(dependency_repositories=[
+            {
+                'url':self.repo_one,
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'package_name' : 'secondproject',
+            }
+        ], timings=timings)
+        self.assertEquals(['project', 'secondproject'], sorted(timings.keys()))
+
     def test_current_branch_is_default_for_deps(self):
         # 0.1.1 is my version
         # 1.0.59.2 is first child
@@ -350,27 +491,6 @@ class TestVersionNumberManipulations(TestCase):
     def test_sum_bad_number_in_first_version(self):
         self.assertRaises(ValueError, sum_versions, (-1, 2, 3), (0, 128, 0))
 
-class TestParsingRevlistOutput(TestCase):
-    def test_single_tag_parsed(self):
-        self.assertEquals(['repo-1.2'], get_tags_from_line(' (repo-1.2)'))
-
-    def test_multiple_tags_or_branches_parsed(self):
-        self.assertEquals(['repo-1.1', 'branch'], get_tags_from_line(' (repo-1.1, branch)'))
-
-    def test_multiple_tags_or_heads_parsed(self):
-        self.assertEquals(['HEAD', 'master'], get_tags_from_line(' (HEAD, master)'))
-
-    def test_multiple_tags_in_alternative_form_or_branches_parsed(self):
-        self.assertEquals(['repo-1.2', 'origin/master'], get_tags_from_line(' (tag: repo-1.2, origin/master)'))
-
-#commit 57242af1e05022103623780b66339346b7be4da9
-# (HEAD, master)
-#commit 4c0eaacf31f5ad13f56c4c21312f1719b0f04073
-# (repo-1.1, branch)
-#commit 3f989c837348ffaa5c7ff2fc8ebfef70cd0cf59c
-# (repo-1.2)
-
-
 class TestVersionRetrievingHigherVersion(TestCase):
 
     def prepare(self, tag_latest_version=False):
@@ -479,6 +599,87 @@ class TestVersionRetrievingHigherVersion(TestCase):
         self.assertEquals('citools-0.4', get_highest_tag(['citools-0.3.520', 'citools-0.2', 'citools-0.4']))
 
 
+class TestDescribingFromAncestry(TestCase):
+    #        e (HEAD)
+    #        | \
+    #        d  c (repo-1.1)
+    #        |  |
+    #        b (repo-1.2)
+    #        |
+    #        a (repo-1.0)
+    HEAD = 'e' * 40
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.parents = {
+            self.HEAD : ['d', 'c'],
+            'd' : ['b'],
+            'c' : ['b'],
+            'b' : ['a'],
+            'a' : [],
+        }
+
+    def test_tag_on_head_returns_tag_name(self):
+        self.assertEquals('repo-1.3', describe_highest_version(self.HEAD, self.parents, {'repo-1.3' : self.HEAD, 'repo-1.2' : 'b'}))
+
+    def test_highest_version_preferred_with_distance_through_merge(self):
+        self.assertEquals('repo-1.2-3-geeeeeee', describe_highest_version(self.HEAD, self.parents, {
+            'repo-1.0' : 'a',
+            'repo-1.2' : 'b',
+            'repo-1.1' : 'c',
+        }))
+
+    def test_unreachable_tags_ignored(self):
+        self.assertEquals('repo-1.0-4-geeeeeee', describe_highest_version(self.HEAD, self.parents, {
+            'repo-1.0' : 'a',
+            'repo-2.0' : 'f',
+        }))
+
+    def test_none_returned_without_usable_tags(self):
+        self.assertEquals(None, describe_highest_version(self.HEAD, self.parents, {'release' : 'a'}))
+
+    def test_complete_history_is_always_complete(self):
+        self.assertEquals(True, is_describe_complete(self.HEAD, self.parents, set(), {'repo-1.0' : 'x'}))
+
+    def test_incomplete_without_reachable_tag(self):
+        parents = {self.HEAD : ['d', 'c'], 'd' : ['b'], 'c' : ['b']}
+        self.assertEquals(False, is_describe_complete(self.HEAD, parents, set(['d', 'c']), {'repo-1.0' : 'a'}))
+
+    def test_complete_when_boundary_is_behind_highest_tag(self):
+        parents = {self.HEAD : ['d', 'c'], 'd' : ['b'], 'c' : ['b'], 'b' : ['a']}
+        self.assertEquals(True, is_describe_complete(self.HEAD, parents, set(['b']), {'repo-1.2' : 'b', 'repo-1.0' : 'a'}))
+
+    def test_incomplete_when_higher_tag_may_be_hidden(self):
+        parents = {self.HEAD : ['d', 'c'], 'd' : ['b'], 'c' : ['b'], 'b' : ['a']}
+        self.assertEquals(False, is_describe_complete(self.HEAD, parents, set(['b']), {'repo-1.1' : 'c', 'repo-1.2' : 'a'}))
+
+    def test_incomplete_when_boundary_is_not_behind_tag(self):
+        parents = {self.HEAD : ['d', 'c'], 'd' : ['b'], 'c' : ['b']}
+        self.assertEquals(False, is_describe_complete(self.HEAD, parents, set(['d']), {'repo-1.1' : 'c'}))
+
+    def test_complete_without_any_usable_tag(self):
+        parents = {self.HEAD : ['d', 'c']}
+        self.assertEquals(True, is_describe_complete(self.HEAD, parents, set(['d', 'c']), {'release' : 'a'}))
+
+
+class TestDependencySessionSharing(TestCase):
+    def setUp(self):
+        self.distribution = Mock(spec=[])
+        self.session = get_dependency_session(self.distribution, fetch_options={'shallow' : False, 'mirror_directory' : None})
+
+    def test_session_shared(self):
+        self.assertTrue(self.session is get_dependency_session(self.distribution))
+
+    def test_unset_options_merged(self):
+        get_dependency_session(self.distribution, cachedir='/tmp/cache', fetch_options={'shallow' : True, 'mirror_directory' : None})
+        self.assertEquals('/tmp/cache', self.session.cachedir)
+        self.assertEquals({'shallow' : True, 'mirror_directory' : None}, self.session.fetch_options)
+
+    def test_conflicting_options_ignored(self):
+        get_dependency_session(self.distribution, fetch_options={'mirror_directory' : '/tmp/mirrors'})
+        get_dependency_session(self.distribution, fetch_options={'mirror_directory' : '/tmp/other'})
+        self.assertEquals('/tmp/mirrors', self.session.fetch_options['mirror_directory'])
+
 class TestBranchSuffix(TestCase):
     def test_slash_just_dashed(self):
         self.assertEquals("story-123", get_branch_suffix(Mock(spec=[]), "story/123"))
@@ -0,0 +1,128 @@
+import os
+from unittest import TestCase
+
+from citools.wildmatch import wildmatch, filter_matching
+
+from helpers import GitTestCase
+
+# (pattern, text, expected result), taken mostly from git's t3070-wildmatch
+# "pathmatch" column (no WM_PATHNAME, which is what git describe --match uses)
+WILDMATCH_CORPUS = [
+    ('foo', 'foo', True),
+    ('bar', 'foo', False),
+    ('', '', True),
+    ('???', 'foo', True),
+    ('??', 'foo', False),
+    ('*', 'foo', True),
+    ('*', '', True),
+    ('f*', 'foo', True),
+    ('*f', 'foo', False),
+    ('*foo*', 'foo', True),
+    ('*ob*a*r*', 'foobar', True),
+    ('*ab', 'aaaaaaabababab', True),
+    ('foo\\*', 'foo*', True),
+    ('foo\\*bar', 'foobar', False),
+    ('f\\\\oo', 'f\\oo', True),
+    ('\\', '\\', False),
+    ('*[al]?', 'ball', True),
+    ('[ten]', 'ten', False),
+    ('**[!te]', 'ten', True),
+    ('**[!ten]', 'ten', False),
+    ('t[a-g]n', 'ten', True),
+    ('t[!a-g]n', 'ten', False),
+    ('t[!a-g]n', 'ton', True),
+    ('t[^a-g]n', 'ton', True),
+    ('a[]]b', 'a]b', True),
+    ('a[]-]b', 'a-b', True),
+    ('a[]-]b', 'a]b', True),
+    ('a[]-]b', 'aab', False),
+    ('a[]a-]b', 'aab', True),
+    (']', ']', True),
+    ('[a-]', '-', True),
+    ('[\\-_]', '-', True),
+    ('[\\]]', ']', True),
+    ('[\\]]', '\\]', False),
+    ('[!\\]]', '\\', True),
+    ('[\\\\]', '\\', True),
+    ('[!\\\\]', '\\', False),
+    ('[A-\\\\]', 'G', True),
+    ('[z-a]', 'q', False),
+    ('a[', 'a[', False),
+    ('[ab]', '[ab]', False),
+    ('[[]ab]', '[ab]', True),
+    ('[[:]ab]', '[ab]', True),
+    ('[[::]ab]', '[ab]', False),
+    ('[[:digit]ab]', '[ab]', True),
+    ('foo*bar', 'foo/baz/bar', True),
+    ('foo?bar', 'foo/bar', True),
+    ('foo[/]bar', 'foo/bar', True),
+    ('**/foo', 'foo', False),
+    ('[[:alpha:]][[:digit:]][[:upper:]]', 'a1B', True),
+    ('[[:digit:][:upper:][:space:]]', 'a', False),
+    ('[[:digit:][:upper:][:space:]]', 'A', True),
+    ('[[:digit:][:upper:][:space:]]', '1', True),
+    ('[[:digit:][:upper:][:spaci:]]', '1', False),
+    ('[[:xdigit:]]', '5', True),
+    ('[a-c[:digit:]x-z]', '5', True),
+    ('[a-c[:digit:]x-z]', 'q', False),
+    ('project-[0-9]*', 'project-0.1', True),
+    ('project-[0-9]*', 'myproject-0.1', False),
+    ('project-[0-9]*', 'project-meta-0.1', False),
+    ('release/project-[0-9]*', 'release/project-0.1', True),
+]
+
+# names usable as git tags (see git check-ref-format)
+TAG_NAMES = [
+    'repo-1.2', 'repo-1.10', 'repo-meta-1.0', 'REPO-2.0',
+    'release/project-0.1', 'project-0.1', 'myproject-0.1',
+    'v1.0-rc1', 'x]y', 'a-b', 'foo/bar/baz', 'x!y', 'under_score', '#hash',
+]
+
+TAG_PATTERNS = [
+    'repo-*', 'repo-[0-9]*', '*-[0-9]*', 'project-[0-9]*', 'release/*',
+    '*/*', '?epo-*', '[!r]*', '[^r]*', '[[:upper:]]*', '*[[:digit:]]',
+    'x[]]y', '[a-c]-?', '*[!0-9]', 'v[0-9].[0-9]-rc*', '*\\!*',
+    '[[:punct:]]*', 'repo-1.[1-9]', '*1.1*', '**', '*_*', 'nothing',
+]
+
+
+class TestWildmatch(TestCase):
+
+    def test_corpus(self):
+        for pattern, text, expected in WILDMATCH_CORPUS:
+            self.assertEquals(expected, wildmatch(pattern, text),
+                "Pattern %r on %r should return %s" % (pattern, text, expected))
+
+    def test_filtering_preserves_order(self):
+        self.assertEquals(['repo-1.2', 'repo-1.10'], filter_matching('repo-[0-9]*', ['repo-1.2', 'master', 'repo-1.10']))
+
+    def test_broken_pattern_filters_everything(self):
+        self.assertEquals([], filter_matching('repo-[', ['repo-[', 'repo-1.2']))
+
+
+class TestWildmatchGitCompatibility(GitTestCase):
+
+    def setUp(self):
+        super(TestWildmatchGitCompatibility, self).setUp()
+        self._create_git_repository()
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+
+        self.do_piped_command_for_success(['git', 'add', '*'])
+        self.do_piped_command_for_success(['git', 'commit', '-m', 'dummy'])
+
+        for tag in TAG_NAMES:
+            self.do_piped_command_for_success(['git', 'tag', tag])
+
+    def test_same_tags_matched_as_by_git(self):
+        for pattern in TAG_PATTERNS:
+            stdout = self.do_piped_command_for_success(['git', 'tag', '-l', pattern])[0]
+            git_tags = stdout.splitlines()
+            git_tags.sort()
+
+            our_tags = filter_matching(pattern, TAG_NAMES)
+            our_tags.sort()
+
+            self.assertEquals(git_tags, our_tags, "Pattern %r differs from git" % pattern)